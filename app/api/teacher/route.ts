@@ -3,14 +3,17 @@ import { NextResponse } from "next/server";
 export async function POST(req: Request) {
     try {
         const body = await req.json();
-        const { message, history, subject } = body;
+        const { message, history, subject, sessionId } = body;
 
-        // Use selected subject from the frontend; fallback to subject1
-        const backendSubject = subject && ["subject1", "subject2", "subject3"].includes(subject) ? subject : "subject1";
+        // Use selected subject from the frontend (any valid subject name); fallback to subject1
+        const backendSubject = typeof subject === "string" && /^[A-Za-z0-9][A-Za-z0-9_-]{0,63}$/.test(subject) ? subject : "subject1";
 
         const formData = new FormData();
         formData.append("subject", backendSubject);
         formData.append("question", message);
+        if (sessionId) {
+            formData.append("session_id", sessionId);
+        }
 
         const response = await fetch("http://127.0.0.1:8000/teacher_ask", {
             method: "POST",
@@ -99,8 +99,21 @@ export default function SubjectsPage() {
       })
 
       if (!response.ok) throw new Error("Upload failed")
+      const data = await response.json()
+      if (data.error) throw new Error(data.error)
 
-      const newFiles = files.map((f) => ({
+      // duplicates (same content already uploaded) and rejected files are not stored
+      const queued = new Set(
+        (data.files || []).filter((f: { status: string }) => f.status === "queued").map((f: { filename: string }) => f.filename)
+      )
+      const skipped = (data.files || []).filter((f: { status: string }) => f.status !== "queued")
+      if (skipped.length) {
+        alert(skipped.map((f: { filename: string; status: string; duplicate_of?: string; error?: string }) =>
+          f.status === "duplicate" ? `${f.filename}: already uploaded as ${f.duplicate_of}` : `${f.filename}: ${f.error}`
+        ).join("\n"))
+      }
+
+      const newFiles = files.filter((f) => queued.has(f.name)).map((f) => ({
         name: f.name,
         size: `${(f.size / 1024).toFixed(0)} KB`,
         type: f.name.split(".").pop()?.toUpperCase() || "FILE",
@@ -0,0 +1,110 @@
+"""ANN (IVF) vs exact scan: recall@k and query latency on synthetic corpora.
+
+Builds clustered synthetic embedding matrices, trains the IVF index exactly
+as the backend does, and compares each nprobe setting with the exact scan.
+
+Usage (from backend/):
+    python benchmarks/bench_ann.py --sizes 10000,100000,1000000 --dim 256
+    python benchmarks/bench_ann.py --sizes 10000 --dim 3072 --nprobe 4,16,64 --json ann.json
+
+Memory is sizes x dim x 4 bytes; 1M rows at the real 3072 dims needs ~12 GB,
+hence the smaller default --dim.
+"""
+import argparse
+import json
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from common import load_app, percentile
+
+
+def synthetic_corpus(n, dim, clusters, rng, noise):
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, n)
+    matrix = centers[labels] + noise * rng.normal(size=(n, dim)).astype(np.float32)
+    return centers, matrix
+
+
+def run_size(main, n, dim, nprobes, queries, top_k, rng, noise):
+    centers, raw = synthetic_corpus(n, dim, clusters=max(32, n // 500), rng=rng, noise=noise)
+    matrix = np.ascontiguousarray(main._normalize_rows(raw), dtype=np.float32)
+    del raw
+
+    started = time.perf_counter()
+    centroids = main.train_ivf(matrix)
+    ann = main.build_ivf(centroids, main.assign_ivf(matrix, centroids))
+    build_s = time.perf_counter() - started
+
+    index = {"matrix": matrix, "rows": np.arange(n), "chunks": range(n), "ann": None}
+    qs = centers[rng.integers(0, centers.shape[0], queries)] + noise * rng.normal(size=(queries, dim)).astype(np.float32)
+
+    def measure(idx, nprobe=None):
+        latencies, results = [], []
+        for q in qs:
+            t = time.perf_counter()
+            hits = main.score_query(q, idx, top_k, nprobe=nprobe)
+            latencies.append((time.perf_counter() - t) * 1000)
+            results.append({row for _, row in hits})
+        return latencies, results
+
+    exact_lat, exact_res = measure(index)
+    report = {
+        "rows": n,
+        "dim": dim,
+        "lists": int(centroids.shape[0]),
+        "build_s": round(build_s, 2),
+        "exact": {"p50_ms": round(percentile(exact_lat, 50), 3), "p95_ms": round(percentile(exact_lat, 95), 3)},
+        "ivf": [],
+    }
+    ann_index = dict(index, ann=ann)
+    for nprobe in nprobes:
+        lat, res = measure(ann_index, nprobe)
+        recall = sum(len(a & e) for a, e in zip(res, exact_res)) / (top_k * len(res))
+        report["ivf"].append({
+            "nprobe": nprobe,
+            f"recall@{top_k}": round(recall, 4),
+            "p50_ms": round(percentile(lat, 50), 3),
+            "p95_ms": round(percentile(lat, 95), 3),
+        })
+    return report
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--nprobe", default="4,8,16,32,64")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--noise", type=float, default=1.0, help="within-cluster spread (higher = harder)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        main = load_app(workdir)
+        # score_query only consults ANN above this size; the benchmark decides itself
+        main.ANN_MIN_ROWS = 0
+        rng = np.random.default_rng(args.seed)
+        nprobes = [int(x) for x in args.nprobe.split(",")]
+
+        reports = []
+        for n in (int(x) for x in args.sizes.split(",")):
+            r = run_size(main, n, args.dim, nprobes, args.queries, args.top_k, rng, args.noise)
+            reports.append(r)
+            print(f"\n{n:>9,} rows x {args.dim}d — {r['lists']} lists, built in {r['build_s']}s")
+            print(f"  exact        p50 {r['exact']['p50_ms']:8.3f} ms   p95 {r['exact']['p95_ms']:8.3f} ms")
+            for row in r["ivf"]:
+                print(f"  nprobe {row['nprobe']:>4}  p50 {row['p50_ms']:8.3f} ms   p95 {row['p95_ms']:8.3f} ms   "
+                      f"recall@{args.top_k} {row[f'recall@{args.top_k}']:.3f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"benchmark": "ann", "results": reports}, f, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,143 @@
+"""Chunker throughput and index size: legacy sentence-overlap chunker vs the streaming one.
+
+Generates a synthetic multi-thousand-page corpus, chunks it with both the
+original create_smart_chunks (overlap applied as 50 *sentences*, word count
+recomputed after every flush) and the current streaming chunker, and reports
+pages/s, chunk count, duplicated words and the estimated index size
+(chunk text + one float32 embedding per chunk). For re-ingestion it also
+edits one page in the middle and reports how many chunks keep their exact
+text, and so their stored embedding: the streaming chunker re-synchronises
+its boundaries within a few chunks of an edit.
+
+Usage (from backend/):
+    python benchmarks/bench_chunking.py --pages 5000
+    python benchmarks/bench_chunking.py --pages 5000 --json chunking.json
+"""
+import argparse
+import json
+import random
+import re
+import sys
+import tempfile
+import time
+
+from common import load_app
+
+WORDS = (
+    "cell membrane energy protein enzyme reaction gradient transport molecule "
+    "structure function process system signal pathway model theory data result "
+    "analysis method network layer input output value rate change force field"
+).split()
+
+
+def synthetic_pages(n, rng, words_per_page):
+    pages = []
+    for page in range(1, n + 1):
+        sentences, total = [], 0
+        while total < words_per_page:
+            length = rng.randint(6, 28)
+            sentences.append(" ".join(rng.choice(WORDS) for _ in range(length)).capitalize() + ".")
+            total += length
+        pages.append({"page": page, "text": " ".join(sentences)})
+    return pages
+
+
+def legacy_create_smart_chunks(pages, source_name, chunk_size=400, overlap=50):
+    """The chunker as it was before the streaming rewrite, kept for comparison."""
+    chunks = []
+    chunk_counter = 0
+    for page_obj in pages:
+        page_num = page_obj["page"]
+        sentences = re.split(r'(?<=[.!?])\s+', page_obj["text"])
+        current_chunk = []
+        current_words = 0
+        for sentence in sentences:
+            word_count = len(sentence.split())
+            if current_words + word_count > chunk_size:
+                chunks.append({
+                    "chunk_id": f"{source_name}_{chunk_counter}",
+                    "page": page_num,
+                    "source": source_name,
+                    "text": " ".join(current_chunk)
+                })
+                chunk_counter += 1
+                current_chunk = current_chunk[-overlap:]
+                current_words = len(" ".join(current_chunk).split())
+            current_chunk.append(sentence)
+            current_words += word_count
+        if current_chunk:
+            chunks.append({
+                "chunk_id": f"{source_name}_{chunk_counter}",
+                "page": page_num,
+                "source": source_name,
+                "text": " ".join(current_chunk)
+            })
+            chunk_counter += 1
+    return chunks
+
+
+def edit_reuse(fn, pages, rng, words_per_page):
+    """Share of chunks whose text survives an edit of the middle page."""
+    edited = [dict(p) for p in pages]
+    middle = len(edited) // 2
+    edited[middle]["text"] = synthetic_pages(1, rng, words_per_page)[0]["text"]
+    before = {c["text"] for c in fn(pages)}
+    after = fn(edited)
+    return sum(1 for c in after if c["text"] in before) / len(after)
+
+
+def measure(name, fn, pages, source_words, dim):
+    started = time.perf_counter()
+    chunks = fn(pages)
+    elapsed = time.perf_counter() - started
+    chunk_words = [len(c["text"].split()) for c in chunks]
+    text_bytes = sum(len(c["text"].encode("utf-8")) for c in chunks)
+    vector_bytes = len(chunks) * dim * 4
+    return {
+        "chunker": name,
+        "seconds": round(elapsed, 3),
+        "pages_per_s": round(len(pages) / elapsed, 1),
+        "chunks": len(chunks),
+        "max_chunk_words": max(chunk_words),
+        "duplication": round(sum(chunk_words) / source_words, 3),
+        "index_mb": round((text_bytes + vector_bytes) / 1e6, 1),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=5000)
+    parser.add_argument("--words-per-page", type=int, default=450)
+    parser.add_argument("--dim", type=int, default=3072, help="embedding dim used for the size estimate")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        main = load_app(workdir)
+        pages = synthetic_pages(args.pages, random.Random(args.seed), args.words_per_page)
+        source_words = sum(len(p["text"].split()) for p in pages)
+
+        results = [
+            measure("legacy", lambda p: legacy_create_smart_chunks(p, "bench.pdf"), pages, source_words, args.dim),
+            measure("streaming", lambda p: main.create_smart_chunks(p, "bench.pdf"), pages, source_words, args.dim),
+            measure("streaming (per page)", lambda p: main.create_smart_chunks(p, "bench.pdf", cross_pages=False),
+                    pages, source_words, args.dim),
+        ]
+        results[1]["reused_after_edit"] = round(edit_reuse(
+            lambda p: main.create_smart_chunks(p, "bench.pdf"), pages,
+            random.Random(args.seed + 1), args.words_per_page), 4)
+
+    print(f"\n{args.pages:,} pages, {source_words:,} words")
+    for r in results:
+        reused = f"   {r['reused_after_edit']:.1%} reused after 1-page edit" if "reused_after_edit" in r else ""
+        print(f"  {r['chunker']:<21} {r['pages_per_s']:>9,.0f} pages/s   {r['chunks']:>6,} chunks   "
+              f"max {r['max_chunk_words']:>5} words   x{r['duplication']:.2f} words   {r['index_mb']:>8,.1f} MB{reused}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"benchmark": "chunking", "pages": args.pages, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
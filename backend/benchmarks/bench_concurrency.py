@@ -0,0 +1,80 @@
+"""Concurrency check for /ask_v2 against slow local stubs.
+
+Fires N parallel /ask_v2 requests while the embedder and Groq are replaced by
+local stubs that sleep. With the blocking SDK calls off the event loop, the
+batch should finish in roughly the time of one request, not N times it.
+
+Usage (from backend/):
+    python benchmarks/bench_concurrency.py --requests 20 --llm-delay 1.0
+
+Exits non-zero if the parallel batch takes more than --max-ratio times a
+single request.
+"""
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+
+from common import install_stubs, load_app
+
+
+def install_bench_stubs(main, embed_delay, llm_delay):
+    install_stubs(main, embed_delay=embed_delay, llm_delay=llm_delay, dim=64)
+    main.ANSWER_CACHE_MAX_ENTRIES = 0
+    main.answer_cache.max_entries = 0
+    main.EMBED_CACHE_MAX_ENTRIES = 0
+    # every request must reach the (stub) LLM; a reranker early exit would skew the timings
+    main.RERANKER = "none"
+
+
+async def ask(client, question):
+    response = await client.post("/ask_v2", data={"subject": "subject1", "question": question})
+    response.raise_for_status()
+    return response.json()
+
+
+async def run(main, n):
+    import httpx
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        start = time.perf_counter()
+        await ask(client, "warm-up question")
+        single = time.perf_counter() - start
+
+        start = time.perf_counter()
+        await asyncio.gather(*(ask(client, f"question {i}") for i in range(n)))
+        parallel = time.perf_counter() - start
+
+    return single, parallel
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--embed-delay", type=float, default=0.05)
+    parser.add_argument("--llm-delay", type=float, default=1.0)
+    parser.add_argument("--max-ratio", type=float, default=2.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        main = load_app(workdir)
+        install_bench_stubs(main, args.embed_delay, args.llm_delay)
+        main.save_chunks_to_index("subject1", [
+            {"chunk_id": f"bench_{i}", "page": i + 1, "source": "bench.pdf", "text": f"synthetic chunk {i}"}
+            for i in range(50)
+        ])
+        # make every stub query pass the score threshold
+        main.MIN_SCORE_THRESHOLD = -1.0
+
+        single, parallel = asyncio.run(run(main, args.requests))
+
+    ratio = parallel / single
+    print(f"single request: {single:.2f}s")
+    print(f"{args.requests} parallel:  {parallel:.2f}s  ({ratio:.2f}x single)")
+    sys.exit(0 if ratio <= args.max_ratio else 1)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,138 @@
+"""Compressed search (Matryoshka truncation + int8 / binary): recall vs memory.
+
+For every EMBED_SEARCH_DIM x EMBED_QUANTIZATION combination, builds the search
+copy exactly as the backend does and reports:
+
+  * bytes per vector and total MB of the search copy vs the float32 matrix
+  * recall@k of the compressed scores alone, and after the full-precision
+    rescoring pass the backend runs (EMBED_RESCORE_FACTOR / EMBED_RESCORE_MIN),
+    both against the exact float32 top k
+  * p50 query latency with rescoring, next to the exact float32 scan
+
+Queries are rows of the matrix itself, with the query row excluded from both
+the exact and the compressed results.
+
+Point --subject at a real subject index to measure real embeddings: the
+Gemini embeddings are Matryoshka-trained, the synthetic fallback vectors are
+not, so on synthetic data truncation looks far worse than it is.
+
+Usage (from backend/):
+    python benchmarks/bench_quantization.py --subject biology
+    python benchmarks/bench_quantization.py --rows 50000 --dim 768 --dims 0,384,192 --json quant.json
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from common import BACKEND_DIR, load_app, percentile
+
+
+def synthetic_matrix(main, n, dim, rng, noise):
+    centers = rng.normal(size=(max(32, n // 500), dim)).astype(np.float32)
+    raw = centers[rng.integers(0, centers.shape[0], n)] + noise * rng.normal(size=(n, dim)).astype(np.float32)
+    return np.ascontiguousarray(main._normalize_rows(raw), dtype=np.float32)
+
+
+def top_rows_excluding(scores, ids, k, self_row):
+    order = ids[np.argsort(-scores, kind="stable")]
+    return [int(r) for r in order[:k + 1] if r != self_row][:k]
+
+
+def run_config(main, matrix, dim, quantization, query_rows, top_k, exact):
+    started = time.perf_counter()
+    search = main.build_search_matrix(matrix, dim, quantization)
+    build_s = time.perf_counter() - started
+    index = {"matrix": matrix, "search": search}
+
+    hits_raw = hits_rescored = 0
+    latencies = []
+    for q_row, truth in zip(query_rows, exact):
+        query = np.asarray(matrix[q_row], dtype=np.float32)
+        rows, _ = main.compressed_top_rows(index, query, top_k + 1, rescore=False)
+        hits_raw += len(truth & set([int(r) for r in rows if r != q_row][:top_k]))
+        t = time.perf_counter()
+        rows, _ = main.compressed_top_rows(index, query, top_k + 1)
+        latencies.append((time.perf_counter() - t) * 1000)
+        hits_rescored += len(truth & set([int(r) for r in rows if r != q_row][:top_k]))
+
+    nbytes = main.search_matrix_nbytes(search)
+    total = top_k * len(exact)
+    return {
+        "dim": search["dim"],
+        "quantization": quantization,
+        "bytes_per_vector": round(nbytes / matrix.shape[0], 1),
+        "search_mb": round(nbytes / 1024 / 1024, 2),
+        "compression": round(matrix.shape[0] * matrix.shape[1] * 4 / nbytes, 1),
+        f"recall@{top_k}": round(hits_raw / total, 4),
+        f"recall@{top_k}_rescored": round(hits_rescored / total, 4),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "build_s": round(build_s, 2),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--subject", help="measure this subject's index instead of synthetic vectors")
+    parser.add_argument("--root", default=BACKEND_DIR, help="directory holding index/ (with --subject)")
+    parser.add_argument("--rows", type=int, default=20000, help="synthetic rows")
+    parser.add_argument("--dim", type=int, default=768, help="synthetic dimension")
+    parser.add_argument("--noise", type=float, default=1.0)
+    parser.add_argument("--dims", default="0,1536,768,256", help="search dims to try (0 = full)")
+    parser.add_argument("--quantization", default="none,int8,binary")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    with tempfile.TemporaryDirectory() as workdir:
+        main = load_app(os.path.abspath(args.root) if args.subject else workdir)
+        main.EMBED_SEARCH_DIM, main.EMBED_QUANTIZATION = 0, "none"
+        if args.subject:
+            matrix = main.get_subject_index(args.subject)["matrix"]
+            if not matrix.shape[0]:
+                sys.exit(f"subject {args.subject!r} has no embeddings under {args.root}")
+        else:
+            matrix = synthetic_matrix(main, args.rows, args.dim, rng, args.noise)
+
+        n, full_dim = matrix.shape
+        query_rows = rng.choice(n, min(args.queries, n), replace=False)
+        all_rows = np.arange(n)
+        exact, latencies = [], []
+        for r in query_rows:
+            t = time.perf_counter()
+            scores = np.asarray(matrix @ np.asarray(matrix[r], dtype=np.float32))
+            latencies.append((time.perf_counter() - t) * 1000)
+            exact.append(set(top_rows_excluding(scores, all_rows, args.top_k, r)))
+        exact_p50 = round(percentile(latencies, 50), 3)
+
+        print(f"{n:,} vectors x {full_dim}d, float32 matrix {n * full_dim * 4 / 1024 / 1024:.1f} MB, "
+              f"rescoring the best max({args.top_k + 1} x {main.EMBED_RESCORE_FACTOR}, {main.EMBED_RESCORE_MIN}); exact scan p50 {exact_p50:.3f} ms")
+        reports = []
+        for dim in (int(x) for x in args.dims.split(",")):
+            if dim >= full_dim:
+                continue  # same as 0
+            for quantization in args.quantization.split(","):
+                if not main.compressed_search_enabled(dim, quantization):
+                    continue
+                r = run_config(main, matrix, dim, quantization, query_rows, args.top_k, exact)
+                reports.append(r)
+                print(f"  {r['dim']:>5}d {quantization:<7} {r['bytes_per_vector']:>8.1f} B/vec "
+                      f"{r['search_mb']:>9.2f} MB ({r['compression']:>5.1f}x)   "
+                      f"recall@{args.top_k} {r[f'recall@{args.top_k}']:.3f} -> "
+                      f"{r[f'recall@{args.top_k}_rescored']:.3f} rescored   p50 {r['p50_ms']:.3f} ms")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"benchmark": "quantization", "rows": n, "dim": full_dim,
+                       "subject": args.subject, "exact_p50_ms": exact_p50, "results": reports}, f, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
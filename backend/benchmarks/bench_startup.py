@@ -0,0 +1,146 @@
+"""Cold-start cost: import of main.py and uvicorn import-to-first-request.
+
+Each measurement runs in a fresh interpreter from a scratch working directory,
+with the provider API keys either set (dummy values) or unset, and reports the
+median over --runs:
+
+  * import_ms        time to `import main`
+  * first_request_ms uvicorn worker start until GET / first answers 200
+  * provider_init_ms cost of building each provider client on first use
+  * deferred imports fitz / google.generativeai / groq import cost, i.e. what
+                     main.py no longer pays at import time
+
+Usage (from backend/):
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --runs 10 --json startup.json
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from common import BACKEND_DIR
+
+IMPORT_SNIPPET = """
+import sys, time
+sys.path.insert(0, {backend!r})
+started = time.perf_counter()
+import main
+print((time.perf_counter() - started) * 1000)
+"""
+
+PROVIDER_SNIPPET = """
+import json, sys, time
+sys.path.insert(0, {backend!r})
+import main
+out = {{}}
+for provider in (main.genai, main.gemini_model, main.groq_client):
+    started = time.perf_counter()
+    provider.get()
+    out[provider.name] = (time.perf_counter() - started) * 1000
+print(json.dumps(out))
+"""
+
+MODULE_SNIPPET = """
+import time
+started = time.perf_counter()
+import {module}
+print((time.perf_counter() - started) * 1000)
+"""
+
+
+def provider_env(configured):
+    env = dict(os.environ)
+    # an empty value wins over backend/.env (load_dotenv never overrides) and reads as unset
+    for var in ("GEMINI_API_KEY", "GROQ_API_KEY"):
+        env[var] = "bench" if configured else ""
+    env.setdefault("LOG_LEVEL", "WARNING")
+    return env
+
+
+def run_snippet(snippet, env, workdir):
+    result = subprocess.run([sys.executable, "-c", snippet], env=env, cwd=workdir,
+                            capture_output=True, text=True, check=True)
+    return result.stdout.strip().splitlines()[-1]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def first_request_ms(env, workdir, timeout=60.0):
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", BACKEND_DIR,
+         "--port", str(port), "--log-level", "warning"],
+        env=env, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1) as response:
+                    if response.status == 200:
+                        return (time.perf_counter() - started) * 1000
+            except OSError:
+                if server.poll() is not None:
+                    raise RuntimeError("uvicorn exited before serving a request")
+                time.sleep(0.005)
+        raise TimeoutError(f"no response from uvicorn within {timeout}s")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def median_ms(samples):
+    return round(statistics.median(samples), 1)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for configured in (True, False):
+            env = provider_env(configured)
+            label = "keys_set" if configured else "keys_unset"
+            imports = [float(run_snippet(IMPORT_SNIPPET.format(backend=BACKEND_DIR), env, workdir))
+                       for _ in range(args.runs)]
+            requests = [first_request_ms(env, workdir) for _ in range(args.runs)]
+            results[label] = {"import_ms": median_ms(imports), "first_request_ms": median_ms(requests)}
+            print(f"{label:<11} import main {results[label]['import_ms']:>8.1f} ms   "
+                  f"uvicorn first request {results[label]['first_request_ms']:>8.1f} ms")
+
+        env = provider_env(True)
+        inits = [json.loads(run_snippet(PROVIDER_SNIPPET.format(backend=BACKEND_DIR), env, workdir))
+                 for _ in range(args.runs)]
+        results["provider_init_ms"] = {name: median_ms([run[name] for run in inits]) for name in inits[0]}
+        print("provider init on first use: " + "  ".join(
+            f"{name} {ms:.1f} ms" for name, ms in results["provider_init_ms"].items()))
+
+        results["deferred_imports_ms"] = {}
+        for module in ("fitz", "google.generativeai", "groq"):
+            samples = [float(run_snippet(MODULE_SNIPPET.format(module=module), env, workdir))
+                       for _ in range(args.runs)]
+            results["deferred_imports_ms"][module] = median_ms(samples)
+        print("deferred imports: " + "  ".join(
+            f"{module} {ms:.1f} ms" for module, ms in results["deferred_imports_ms"].items()))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"benchmark": "startup", "runs": args.runs, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,249 @@
+"""End-to-end benchmark suite: ingest, retrieval and /ask_v2 against local stub providers.
+
+Generates synthetic PDFs (optionally with "scanned" image-only pages that go
+through the OCR path), ingests them with Gemini and Groq replaced by
+deterministic fakes of configurable latency, then measures:
+
+  * ingest pages/s and chunks/s per PDF size
+  * retrieval p50/p95/p99 per mode (vector / hybrid / lexical) per index size
+  * rerank p50/p95/p99 over the top RERANK_CANDIDATES hits, and the share of
+    queries that exit early (no LLM call)
+  * end-to-end /ask_v2 p50/p95/p99 through the ASGI app
+  * peak RSS of the process and its extraction workers
+
+Results are written as JSON; pass --compare with an earlier file to print the
+change of every metric.
+
+Usage (from backend/):
+    python benchmarks/bench_suite.py --pages 20,200 --json bench.json
+    python benchmarks/bench_suite.py --pages 20,200 --index-chunks 20000 --compare bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import fitz
+
+from common import install_stubs, load_app, peak_rss_mb, percentile
+
+TOPICS = {
+    "biology": "cell membrane protein enzyme mitochondria energy gradient transport receptor signal",
+    "physics": "force mass acceleration momentum energy field charge wave frequency velocity",
+    "history": "empire treaty revolution trade dynasty colony reform war parliament census",
+    "computing": "algorithm memory cache thread process network compiler index query latency",
+}
+FILLER = "the of and in to a is that for as with by on this which from are".split()
+
+
+def synthetic_sentence(rng, topic):
+    words = TOPICS[topic].split()
+    return " ".join(rng.choice(words) if rng.random() < 0.4 else rng.choice(FILLER)
+                    for _ in range(rng.randint(8, 22))).capitalize() + "."
+
+
+def synthetic_page_text(rng, words=330):
+    topic = rng.choice(list(TOPICS))
+    sentences, total = [], 0
+    while total < words:
+        sentence = synthetic_sentence(rng, topic)
+        sentences.append(sentence)
+        total += len(sentence.split())
+    return " ".join(sentences)
+
+
+def write_synthetic_pdf(path, pages, rng, scanned_every=0):
+    """Text pages, with every scanned_every-th page left image-only (OCR path)."""
+    doc = fitz.open()
+    for n in range(pages):
+        page = doc.new_page()
+        if scanned_every and (n + 1) % scanned_every == 0:
+            page.draw_rect(fitz.Rect(72, 72, 300, 200), color=(0, 0, 0), fill=(0.8, 0.8, 0.8))
+            continue
+        page.insert_textbox(fitz.Rect(50, 50, page.rect.width - 50, page.rect.height - 50),
+                            synthetic_page_text(rng), fontsize=8)
+    doc.save(path)
+    doc.close()
+
+
+def latency_summary(samples_ms):
+    return {
+        "p50_ms": round(percentile(samples_ms, 50), 3),
+        "p95_ms": round(percentile(samples_ms, 95), 3),
+        "p99_ms": round(percentile(samples_ms, 99), 3),
+    }
+
+
+def bench_ingest(main, workdir, pages, rng, scanned_every):
+    subject = f"bench-pdf-{pages}"
+    main.ensure_subject(subject)
+    filename = f"synthetic_{pages}p.pdf"
+    path = os.path.join(main.UPLOAD_DIR, subject, filename)
+    write_synthetic_pdf(path, pages, rng, scanned_every)
+
+    started = time.perf_counter()
+    result = main.ingest_saved_file(subject, path, filename)
+    elapsed = time.perf_counter() - started
+
+    chunks = len(main.get_subject_index(subject)["chunks"])
+    return subject, {
+        "pages": pages,
+        "chunks": chunks,
+        "failed_chunks": len(result["failed_chunks"]),
+        "seconds": round(elapsed, 3),
+        "pages_per_s": round(pages / elapsed, 1),
+        "chunks_per_s": round(chunks / elapsed, 1),
+    }
+
+
+def build_synthetic_index(main, size, rng):
+    """Large indexes without the PDF path: synthetic chunks straight into the index."""
+    subject = f"bench-index-{size}"
+    chunks = [
+        {"chunk_id": f"synthetic_{i}", "page": i // 3 + 1, "source": "synthetic.pdf",
+         "text": " ".join(synthetic_sentence(rng, rng.choice(list(TOPICS))) for _ in range(4))}
+        for i in range(size)
+    ]
+    for start in range(0, size, 5000):
+        main.save_chunks_to_index(subject, chunks[start:start + 5000])
+    return subject
+
+
+def bench_retrieval(main, subject, queries):
+    index = main.get_subject_index(subject)
+    report = {"chunks": len(index["chunks"])}
+    for mode in main.RETRIEVAL_MODES:
+        samples = []
+        for q in queries:
+            started = time.perf_counter()
+            main.rank_chunks(q, index, 5, mode)
+            samples.append((time.perf_counter() - started) * 1000)
+        report[mode] = latency_summary(samples)
+
+    samples, early_exits = [], 0
+    for q in queries:
+        candidates = main.retrieve_relevant_chunks_with_scores(q, index, main.RERANK_CANDIDATES)
+        started = time.perf_counter()
+        passing, _ = main.rerank_chunks(q, candidates, index)
+        samples.append((time.perf_counter() - started) * 1000)
+        early_exits += not passing
+    report["rerank"] = {**latency_summary(samples), "early_exit_rate": round(early_exits / len(queries), 3)}
+    return report
+
+
+async def bench_ask(main, subject, queries):
+    import httpx
+
+    transport = httpx.ASGITransport(app=main.app)
+    samples = []
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for q in queries:
+            started = time.perf_counter()
+            response = await client.post("/ask_v2", data={"subject": subject, "question": q})
+            response.raise_for_status()
+            samples.append((time.perf_counter() - started) * 1000)
+    return {"subject": subject, "requests": len(samples), **latency_summary(samples)}
+
+
+def flatten(prefix, value, out):
+    if isinstance(value, dict):
+        for k, v in value.items():
+            flatten(f"{prefix}.{k}" if prefix else k, v, out)
+    elif isinstance(value, list):
+        for item in value:
+            label = item.get("pages") or item.get("chunks") if isinstance(item, dict) else None
+            flatten(f"{prefix}[{label}]", item, out)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        out[prefix] = value
+    return out
+
+
+def print_comparison(old, new):
+    before = flatten("", old["results"], {})
+    after = flatten("", new["results"], {})
+    print("\nChange vs baseline:")
+    for key in sorted(before.keys() & after.keys()):
+        if before[key]:
+            change = (after[key] - before[key]) / before[key] * 100
+            print(f"  {key:<45} {before[key]:>12,.3f} → {after[key]:>12,.3f}  ({change:+.1f}%)")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", default="20,200", help="synthetic PDF sizes to ingest")
+    parser.add_argument("--scanned-every", type=int, default=10, help="every Nth page is image-only (0 = none)")
+    parser.add_argument("--index-chunks", default="", help="extra synthetic index sizes, e.g. 20000,100000")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--ask-requests", type=int, default=50)
+    parser.add_argument("--dim", type=int, default=256, help="stub embedding dimension")
+    parser.add_argument("--embed-delay", type=float, default=0.0, help="seconds per stub embedding batch")
+    parser.add_argument("--llm-delay", type=float, default=0.0, help="seconds per stub Groq call")
+    parser.add_argument("--ocr-delay", type=float, default=0.0, help="seconds per stub OCR call")
+    parser.add_argument("--reranker", default="lexical", help="reranker measured (see RERANKERS in main.py)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="baseline JSON from an earlier run")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    queries = [synthetic_sentence(rng, rng.choice(list(TOPICS))) for _ in range(args.queries)]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        main = load_app(workdir)
+        install_stubs(main, embed_delay=args.embed_delay, llm_delay=args.llm_delay,
+                      ocr_delay=args.ocr_delay, dim=args.dim)
+        # measure the pipeline, not the caches
+        main.answer_cache.max_entries = 0
+        main.retrieval_cache.max_entries = 0
+        main.EMBED_CACHE_MAX_ENTRIES = 0
+        # the answer threshold is meaningless for stub embeddings; always answer
+        main.MIN_SCORE_THRESHOLD = -1.0
+        main.RERANKER = args.reranker
+
+        results = {"ingest": [], "retrieval": [], "ask_v2": None}
+        subjects = []
+        for pages in (int(x) for x in args.pages.split(",") if x):
+            subject, report = bench_ingest(main, workdir, pages, rng, args.scanned_every)
+            subjects.append(subject)
+            results["ingest"].append(report)
+            print(f"ingest {pages:>6} pages: {report['pages_per_s']:>8,.1f} pages/s  "
+                  f"{report['chunks_per_s']:>8,.1f} chunks/s  ({report['chunks']} chunks, {report['seconds']}s)")
+
+        for size in (int(x) for x in args.index_chunks.split(",") if x):
+            subjects.append(build_synthetic_index(main, size, rng))
+
+        for subject in subjects:
+            report = bench_retrieval(main, subject, queries)
+            results["retrieval"].append(report)
+            print(f"retrieval {report['chunks']:>7,} chunks: " + "  ".join(
+                f"{mode} p50 {report[mode]['p50_ms']:.2f} / p95 {report[mode]['p95_ms']:.2f} / p99 {report[mode]['p99_ms']:.2f} ms"
+                for mode in (*main.RETRIEVAL_MODES, "rerank")))
+
+        if subjects:
+            results["ask_v2"] = asyncio.run(bench_ask(main, subjects[-1], queries[:args.ask_requests]))
+            r = results["ask_v2"]
+            print(f"/ask_v2 end-to-end ({r['requests']} requests): "
+                  f"p50 {r['p50_ms']:.2f} / p95 {r['p95_ms']:.2f} / p99 {r['p99_ms']:.2f} ms")
+
+        results["peak_rss_mb"] = peak_rss_mb()
+        print(f"peak RSS: {results['peak_rss_mb']['self']} MB (extraction workers: {results['peak_rss_mb']['children']} MB)")
+
+    output = {
+        "benchmark": "suite",
+        "config": {k: v for k, v in vars(args).items() if k not in ("json", "compare")},
+        "results": results,
+    }
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print_comparison(json.load(f), output)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(output, f, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,117 @@
+"""Shared helpers for the backend benchmarks.
+
+Benchmarks import backend/main.py with dummy API keys from a scratch working
+directory, so they never touch the real index/ or uploads/ folders and never
+need live Gemini or Groq credentials.
+"""
+import json
+import os
+import re
+import sys
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_app(workdir):
+    """Import main with dummy keys, rooted in a scratch directory."""
+    os.environ.setdefault("GEMINI_API_KEY", "bench")
+    os.environ.setdefault("GROQ_API_KEY", "bench")
+    os.chdir(workdir)
+    if BACKEND_DIR not in sys.path:
+        sys.path.insert(0, BACKEND_DIR)
+    import main
+    return main
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    idx = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def install_stubs(main, embed_delay=0.0, llm_delay=0.0, ocr_delay=0.0, dim=256, answer="stub answer"):
+    """Swap Gemini (embeddings, OCR) and Groq for deterministic local fakes.
+
+    Embeddings are hashed bag-of-words vectors, so texts sharing words are
+    similar and retrieval results are meaningful. Each fake sleeps for its
+    configured latency per call to stand in for the network round trip.
+    """
+
+    token_vectors = {}
+    token_lock = threading.Lock()
+
+    def token_vector(token):
+        vector = token_vectors.get(token)
+        if vector is None:
+            vector = np.random.default_rng(zlib.crc32(token.encode("utf-8"))).standard_normal(dim).astype(np.float32)
+            with token_lock:
+                token_vectors[token] = vector
+        return vector
+
+    def fake_embed(texts, task_type="retrieval_document"):
+        if embed_delay:
+            time.sleep(embed_delay)
+        vectors = []
+        for text in texts:
+            tokens = re.findall(r"[a-z0-9]+", text.lower()) or ["<empty>"]
+            vectors.append(np.sum([token_vector(t) for t in tokens], axis=0).tolist())
+        return vectors
+
+    def fake_ocr(image_bytes, mime_type="image/png"):
+        if ocr_delay:
+            time.sleep(ocr_delay)
+        return f"Scanned page text recognised from {len(image_bytes)} bytes of {mime_type}."
+
+    def fake_ocr_file(image_path):
+        with open(image_path, "rb") as f:
+            return fake_ocr(f.read(), "image/" + image_path.rsplit(".", 1)[-1].lower())
+
+    def fake_completion(**kwargs):
+        if llm_delay:
+            time.sleep(llm_delay)
+        if kwargs.get("stream"):
+            return (
+                SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=word))])
+                for word in re.findall(r"\S+\s*", answer)
+            )
+        content = answer
+        if kwargs.get("response_format", {}).get("type") == "json_object":
+            content = json.dumps(fake_quiz_section(kwargs["messages"][0]["content"]))
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    main.embed_batch_fn = fake_embed
+    main.extract_text_from_image_bytes = fake_ocr
+    main.extract_text_with_gemini = fake_ocr_file
+    main.groq_client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=fake_completion)))
+
+
+def fake_quiz_section(system_prompt):
+    if "multiple-choice" in system_prompt:
+        return {"mcqs": [
+            {"q": f"Stub question {i}?", "options": ["A", "B", "C", "D"], "answer": i % 4,
+             "explanation": "Stub explanation.", "citation": "bench.pdf"}
+            for i in range(5)
+        ]}
+    return {"short": [
+        {"q": f"Stub short question {i}?", "answer": "Stub model answer.", "citation": "bench.pdf"}
+        for i in range(3)
+    ]}
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process and of its reaped children, in MB."""
+    import resource
+
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return {"self": round(own / 1e6, 1), "children": round(children / 1e6, 1)}
@@ -1,17 +1,27 @@
 from fastapi import FastAPI, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.openapi.utils import get_openapi
 import os
+import asyncio
+import contextlib
+import logging
+import functools
 import json
-import math
-import shutil
-import fitz
+import numpy as np
 import re
-import google.generativeai as genai
-from groq import Groq
+import threading
+import time
+import random
+import concurrent.futures
+import hashlib
+import sqlite3
+import uuid
+import math
+import multiprocessing
 from dotenv import load_dotenv
 from typing import List, Annotated
-from collections import deque
+from collections import deque, OrderedDict, Counter
 
 
 # =============================
@@ -19,20 +29,231 @@ from collections import deque
 # =============================
 load_dotenv()
 
-API_KEY = os.getenv("GEMINI_API_KEY")
-GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+# =============================
+# OBSERVABILITY (LOGGING + METRICS)
+# =============================
+# Logs are structured: an event name plus key=value fields (logfmt), or one
+# JSON object per line with LOG_FORMAT=json. Pipeline stages are timed into
+# Prometheus histograms and exposed, with cache and failure counters, on /metrics.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+
+
+class _JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        payload = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "event": getattr(record, "event", record.getMessage()),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, default=str, ensure_ascii=False)
+
+
+logger = logging.getLogger("askmynotes")
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(
+        _JsonLogFormatter() if LOG_FORMAT == "json"
+        else logging.Formatter("%(asctime)s %(levelname)s %(message)s")
+    )
+    logger.addHandler(_log_handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+
+def _logfmt(value):
+    text = str(value)
+    if not text or any(c in text for c in ' "='):
+        return json.dumps(text, ensure_ascii=False)
+    return text
+
+
+def log_event(level, event, **fields):
+    """Log one structured event: `event key=value ...`."""
+    if logger.isEnabledFor(level):
+        message = " ".join([event] + [f"{k}={_logfmt(v)}" for k, v in fields.items()])
+        logger.log(level, message, extra={"event": event, "fields": fields})
+
+
+def _label_text(labelnames, values, extra=""):
+    pairs = [f'{k}="{v}"' for k, v in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class CounterMetric:
+    """Minimal thread-safe Prometheus counter with labels."""
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[k]) for k in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_text(self.labelnames, key)} {value}")
+        return lines
+
+
+class HistogramMetric:
+    """Minimal thread-safe Prometheus histogram with labels (seconds)."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._series = {}  # labels -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[k]) for k in self.labelnames)
+        with self._lock:
+            series = self._series.setdefault(key, [[0] * len(self.BUCKETS), 0.0, 0])
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (buckets, total, count) in sorted(self._series.items()):
+                for bound, n in zip(self.BUCKETS, buckets):
+                    le = 'le="%s"' % bound
+                    lines.append(f"{self.name}_bucket{_label_text(self.labelnames, key, le)} {n}")
+                le = 'le="+Inf"'
+                lines.append(f"{self.name}_bucket{_label_text(self.labelnames, key, le)} {count}")
+                lines.append(f"{self.name}_sum{_label_text(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{_label_text(self.labelnames, key)} {count}")
+        return lines
+
+
+STAGE_SECONDS = HistogramMetric(
+    "askmynotes_stage_seconds",
+    "Latency of pipeline stages (index_load, query_embedding, scoring, rerank, context_build, llm, "
+    "llm_first_token, pdf_extract, ocr, document_embedding, index_write).",
+    ("stage",),
+)
+HTTP_REQUEST_SECONDS = HistogramMetric(
+    "askmynotes_http_request_seconds", "HTTP request latency until the response starts.", ("method", "route", "status")
+)
+CACHE_REQUESTS = CounterMetric(
+    "askmynotes_cache_requests_total", "Cache lookups by cache and result (hit/miss).", ("cache", "result")
+)
+CACHE_EVICTIONS = CounterMetric("askmynotes_cache_evictions_total", "Entries evicted from a cache.", ("cache",))
+EMBEDDING_FAILURES = CounterMetric("askmynotes_embedding_failures_total", "Texts whose embedding failed after retries.")
+EMBEDDING_RETRIES = CounterMetric("askmynotes_embedding_retries_total", "Embedding batch retries after an error.")
+LLM_FAILURES = CounterMetric("askmynotes_llm_failures_total", "Groq calls that failed.", ("route",))
+LLM_SKIPPED = CounterMetric(
+    "askmynotes_llm_skipped_total", "Questions answered 'not found' because no candidate passed reranking.", ("route",)
+)
+METRICS = [STAGE_SECONDS, HTTP_REQUEST_SECONDS, CACHE_REQUESTS, CACHE_EVICTIONS,
+           EMBEDDING_FAILURES, EMBEDDING_RETRIES, LLM_FAILURES, LLM_SKIPPED]
+
+
+@contextlib.contextmanager
+def timed(stage):
+    """Record the duration of the enclosed block in the stage histogram."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage)
+
+
+# =============================
+# PROVIDER CLIENTS (LAZY)
+# =============================
+# The Gemini and Groq SDKs are slow to import and their clients are only
+# needed once a request actually embeds, OCRs or generates. Each provider is
+# built on first use and the client (with its HTTP connection pool) is reused
+# afterwards, so importing this module, spawned extraction workers and routes
+# that never call a provider stay fast. A missing API key is reported when the
+# provider is first used instead of failing the whole process at import.
+class ProviderNotConfigured(RuntimeError):
+    pass
+
+
+class LazyProvider:
+    """A provider client built by factory() on first use and shared afterwards.
+
+    Attribute access is forwarded to the client, so a LazyProvider can stand in
+    wherever the client itself was used (e.g. groq_client.chat.completions).
+    """
+
+    def __init__(self, name, env_var, factory):
+        self.name = name
+        self.env_var = env_var
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def configured(self):
+        return bool(os.getenv(self.env_var))
+
+    @property
+    def initialized(self):
+        return self._client is not None
+
+    def get(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    api_key = os.getenv(self.env_var)
+                    if not api_key:
+                        raise ProviderNotConfigured(f"{self.env_var} not found in .env")
+                    started = time.perf_counter()
+                    self._client = self._factory(api_key)
+                    log_event(logging.INFO, "provider_initialized", provider=self.name,
+                              ms=round((time.perf_counter() - started) * 1000, 1))
+        return self._client
+
+    def __getattr__(self, attr):
+        return getattr(self.get(), attr)
+
+
+def _build_genai(api_key):
+    import google.generativeai as genai
+
+    genai.configure(api_key=api_key)
+    return genai
+
+
+def _build_groq(api_key):
+    from groq import Groq
+
+    return Groq(api_key=api_key)
 
-if not API_KEY:
-    raise ValueError("GEMINI_API_KEY not found in .env")
-if not GROQ_API_KEY:
-    raise ValueError("GROQ_API_KEY not found in .env")
 
 # Gemini — used for embeddings and image extraction
-genai.configure(api_key=API_KEY)
-gemini_model = genai.GenerativeModel("gemini-2.5-flash-lite")
+genai = LazyProvider("gemini", "GEMINI_API_KEY", _build_genai)
+gemini_model = LazyProvider("gemini_vision", "GEMINI_API_KEY",
+                            lambda _: genai.GenerativeModel("gemini-2.5-flash-lite"))
 
 # Groq — used for LLM answer generation
-groq_client = Groq(api_key=GROQ_API_KEY)
+groq_client = LazyProvider("groq", "GROQ_API_KEY", _build_groq)
+PROVIDERS = [genai, gemini_model, groq_client]
+
+for _provider in (genai, groq_client):
+    if not _provider.configured:
+        log_event(logging.WARNING, "provider_not_configured", provider=_provider.name, env=_provider.env_var)
 
 
 # =============================
@@ -47,20 +268,15 @@ def clean_text(text):
 # =============================
 # GEMINI IMAGE EXTRACTION
 # =============================
-def extract_text_with_gemini(image_path):
-
-    ext = image_path.lower().split(".")[-1]
+IMAGE_MIME_TYPES = {
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg"
+}
 
-    mime_map = {
-        "png": "image/png",
-        "jpg": "image/jpeg",
-        "jpeg": "image/jpeg"
-    }
 
-    mime_type = mime_map.get(ext, "image/png")
-
-    with open(image_path, "rb") as f:
-        image_bytes = f.read()
+def extract_text_from_image_bytes(image_bytes, mime_type="image/png"):
+    """OCR an in-memory image with Gemini Vision."""
 
     response = gemini_model.generate_content(
         [
@@ -80,52 +296,148 @@ def extract_text_with_gemini(image_path):
     return response.text
 
 
-# =============================
-# PDF PAGE → IMAGE (SCANNED PDF)
-# =============================
-def convert_page_to_image(page, page_num):
+def extract_text_with_gemini(image_path):
 
-    pix = page.get_pixmap(dpi=200)
+    ext = image_path.lower().split(".")[-1]
+    mime_type = IMAGE_MIME_TYPES.get(ext, "image/png")
 
-    image_path = f"temp_page_{page_num}.png"
-    pix.save(image_path)
+    with open(image_path, "rb") as f:
+        image_bytes = f.read()
 
-    return image_path
+    return extract_text_from_image_bytes(image_bytes, mime_type)
 
 
 # =============================
 # PDF EXTRACTION
 # =============================
-def extract_pdf_pages(file_path):
+SCANNED_PAGE_MIN_CHARS = 40
+OCR_DPI = 200
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "4"))
+EXTRACT_PROCESSES = int(os.getenv("EXTRACT_PROCESSES", str(min(4, os.cpu_count() or 1))))
+# below this many pages the process pool costs more than it saves
+PARALLEL_EXTRACT_MIN_PAGES = int(os.getenv("PARALLEL_EXTRACT_MIN_PAGES", "16"))
+
+_ocr_pool = concurrent.futures.ThreadPoolExecutor(
+    max_workers=OCR_WORKERS, thread_name_prefix="ocr"
+)
+_extract_pool = None
+_extract_pool_lock = threading.Lock()
+
+
+def _extract_process_pool():
+    global _extract_pool
+    with _extract_pool_lock:
+        if _extract_pool is None:
+            # spawn, not fork: the parent is full of live worker threads
+            _extract_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=EXTRACT_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _extract_pool
 
-    doc = fitz.open(file_path)
-    pages = []
 
-    for page_num, page in enumerate(doc):
+def _extract_page(page):
+    """Return (cleaned_text, scanned); scanned pages are rasterized later, by their OCR task."""
 
-        raw_text = page.get_text("text")
-        cleaned = clean_text(raw_text)
+    cleaned = clean_text(page.get_text("text"))
+    return cleaned, len(cleaned.strip()) < SCANNED_PAGE_MIN_CHARS
 
-        # scanned page detection
-        if len(cleaned.strip()) < 40:
 
-            print(f"⚠️ Page {page_num+1} appears scanned → using Gemini")
+def _extract_page_range(file_path, start, stop):
+    """Process-pool worker: extract pages [start, stop) of a PDF."""
+    import fitz
 
-            image_path = convert_page_to_image(page, page_num)
+    with fitz.open(file_path) as doc:
+        return [(n, *_extract_page(doc[n])) for n in range(start, stop)]
+
+
+def _ocr_page(page_num, png_bytes):
+    log_event(logging.INFO, "ocr_scanned_page", page=page_num + 1)
+    with timed("ocr"):
+        return extract_text_from_image_bytes(png_bytes, "image/png")
+
+
+def _ocr_scanned_page(file_path, page_num, known_ocr):
+    """Rasterize, fingerprint and (unless known_ocr has it) OCR one scanned page.
+
+    Runs on the OCR pool, so at most OCR_WORKERS rendered pages are in memory
+    at once; the PNG is dropped as soon as the page's text is back.
+    Returns (text, fingerprint).
+    """
+    import fitz
+
+    with fitz.open(file_path) as doc:
+        png_bytes = doc[page_num].get_pixmap(dpi=OCR_DPI).tobytes("png")
+    fingerprint = page_fingerprint(png_bytes)
+    if fingerprint in known_ocr:
+        return known_ocr[fingerprint], fingerprint
+    return _ocr_page(page_num, png_bytes), fingerprint
+
+
+def page_fingerprint(content):
+    """sha256 of a page's text (text pages) or rendered PNG (scanned pages)."""
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
 
-            try:
-                cleaned = extract_text_with_gemini(image_path)
-            finally:
-                if os.path.exists(image_path):
-                    os.remove(image_path)
-
-        pages.append({
-            "page": page_num + 1,
-            "text": cleaned
-        })
 
-    doc.close()
-    return pages
+def extract_pdf_pages(file_path, on_page=None, parallel=None, known_ocr=None):
+    """Return [{"page", "text", "hash", "ocr"}] for every page; on_page(done, total) reports progress.
+
+    Scanned pages are rasterized in memory and OCR'd concurrently on the OCR
+    pool, one page per task, so memory does not grow with the number of
+    scanned pages. With parallel=True (default: PDFs of
+    PARALLEL_EXTRACT_MIN_PAGES or more) text extraction fans out over a
+    process pool.
+    known_ocr maps a scanned page's fingerprint to text recognised earlier;
+    those pages are not sent to OCR again.
+    """
+    import fitz
+
+    with fitz.open(file_path) as doc:
+        total = doc.page_count
+        if parallel is None:
+            parallel = total >= PARALLEL_EXTRACT_MIN_PAGES and EXTRACT_PROCESSES > 1
+        if not parallel:
+            extracted = [(n, *_extract_page(doc[n])) for n in range(total)]
+
+    if parallel:
+        step = max(1, math.ceil(total / (EXTRACT_PROCESSES * 4)))
+        pool = _extract_process_pool()
+        futures = [
+            pool.submit(_extract_page_range, file_path, start, min(start + step, total))
+            for start in range(0, total, step)
+        ]
+        extracted = [item for f in futures for item in f.result()]
+
+    known_ocr = known_ocr or {}
+    texts = [None] * total
+    hashes = [None] * total
+    scanned = set()
+    ocr_futures = {}
+    done = 0
+    for page_num, cleaned, is_scanned in extracted:
+        if is_scanned:
+            scanned.add(page_num)
+            ocr_futures[_ocr_pool.submit(_ocr_scanned_page, file_path, page_num, known_ocr)] = page_num
+            continue
+        texts[page_num] = cleaned
+        hashes[page_num] = page_fingerprint(cleaned)
+        done += 1
+        if on_page:
+            on_page(done, total)
+
+    for future in concurrent.futures.as_completed(ocr_futures):
+        page_num = ocr_futures[future]
+        texts[page_num], hashes[page_num] = future.result()
+        done += 1
+        if on_page:
+            on_page(done, total)
+
+    return [
+        {"page": n + 1, "text": text, "hash": hashes[n], "ocr": n in scanned}
+        for n, text in enumerate(texts)
+    ]
 
 
 # =============================
@@ -135,94 +447,802 @@ def split_into_sentences(text):
     return re.split(r'(?<=[.!?])\s+', text)
 
 
-def create_smart_chunks(pages, source_name, chunk_size=400, overlap=50):
+def _sentence_units(text, chunk_size):
+    """Yield (text, word_count) per sentence; over-long sentences are cut into
+    chunk_size-word pieces so no single unit can overflow a chunk."""
+    for sentence in split_into_sentences(text):
+        words = sentence.split()
+        if not words:
+            continue
+        if len(words) <= chunk_size:
+            yield sentence, len(words)
+            continue
+        for start in range(0, len(words), chunk_size):
+            piece = words[start:start + chunk_size]
+            yield " ".join(piece), len(piece)
+
+
+def iter_smart_chunks(pages, source_name, chunk_size=400, overlap=50, cross_pages=True):
+    """Stream chunks of at most ~chunk_size words with ~overlap words of overlap.
+
+    Runs in linear time: sentences are split once and word counts are kept
+    running, never recomputed from the joined text. The overlap carried into
+    the next chunk is the longest run of whole trailing sentences that fits
+    in `overlap` words. With cross_pages=True a chunk may continue onto the
+    next page; its span is recorded as page (first) .. page_end (last).
+    """
 
-    chunks = []
     chunk_counter = 0
+    window = deque()  # (sentence, word_count, page)
+    window_words = 0
+
+    def emit():
+        first_page = window[0][2]
+        last_page = window[-1][2]
+        chunk = {
+            "chunk_id": f"{source_name}_{chunk_counter}",
+            "page": first_page,
+            "source": source_name,
+            "text": " ".join(sentence for sentence, _, _ in window)
+        }
+        if last_page != first_page:
+            chunk["page_end"] = last_page
+        return chunk
 
     for page_obj in pages:
 
         page_num = page_obj["page"]
-        text = page_obj["text"]
 
-        sentences = split_into_sentences(text)
+        if not cross_pages and window:
+            yield emit()
+            chunk_counter += 1
+            window.clear()
+            window_words = 0
 
-        current_chunk = []
-        current_words = 0
+        for sentence, word_count in _sentence_units(page_obj["text"], chunk_size):
 
-        for sentence in sentences:
+            if window and window_words + word_count > chunk_size:
 
-            words = sentence.split()
-            word_count = len(words)
+                yield emit()
+                chunk_counter += 1
 
-            if current_words + word_count > chunk_size:
+                # keep whole trailing sentences worth at most `overlap` words
+                carried = 0
+                keep = 0
+                for _, count, _ in reversed(window):
+                    if carried + count > overlap:
+                        break
+                    carried += count
+                    keep += 1
+                if carried + word_count > chunk_size:
+                    # overlap plus this sentence would overflow: start clean
+                    keep, carried = 0, 0
+                while len(window) > keep:
+                    window.popleft()
+                window_words = carried
 
-                chunk_text = " ".join(current_chunk)
+            window.append((sentence, word_count, page_num))
+            window_words += word_count
 
-                chunks.append({
-                    "chunk_id": f"{source_name}_{chunk_counter}",
-                    "page": page_num,
-                    "source": source_name,
-                    "text": chunk_text
-                })
+    if window:
+        yield emit()
 
-                chunk_counter += 1
 
-                # overlap
-                current_chunk = current_chunk[-overlap:]
-                current_words = len(" ".join(current_chunk).split())
+def create_smart_chunks(pages, source_name, chunk_size=400, overlap=50, cross_pages=True):
+    return list(iter_smart_chunks(pages, source_name, chunk_size, overlap, cross_pages))
 
-            current_chunk.append(sentence)
-            current_words += word_count
 
-        if current_chunk:
-            chunks.append({
-                "chunk_id": f"{source_name}_{chunk_counter}",
-                "page": page_num,
-                "source": source_name,
-                "text": " ".join(current_chunk)
-            })
-            chunk_counter += 1
+# =============================
+# EMBEDDINGS (GEMINI)
+# =============================
+EMBEDDING_MODEL = "models/gemini-embedding-001"
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "4"))
+EMBED_TIMEOUT = float(os.getenv("EMBED_TIMEOUT", "15"))
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "4"))
+EMBED_BACKOFF_BASE = float(os.getenv("EMBED_BACKOFF_BASE", "1.0"))
+
+# One long-lived, bounded pool for every embedding request in the process.
+_embedding_pool = concurrent.futures.ThreadPoolExecutor(
+    max_workers=EMBED_WORKERS, thread_name_prefix="embed"
+)
+
+
+def gemini_embed_batch(texts, task_type):
+    """Embed a list of texts in one Gemini request; returns one vector per text."""
+
+    result = genai.embed_content(
+        model=EMBEDDING_MODEL,
+        content=texts,
+        task_type=task_type,
+        request_options={"timeout": EMBED_TIMEOUT},
+    )
+    vectors = result["embedding"]
+    if len(vectors) != len(texts):
+        raise ValueError(f"expected {len(texts)} embeddings, got {len(vectors)}")
+    return vectors
+
+
+# Swappable so local fakes can stand in for Gemini (fn(texts, task_type) -> vectors).
+embed_batch_fn = gemini_embed_batch
+
+
+def _error_status(error):
+    """HTTP status of a provider error: google.api_core (.code) or groq / httpx (.status_code)."""
+    for value in (getattr(error, "code", None), getattr(error, "status_code", None)):
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+    return None
+
 
-    return chunks
+def _is_rate_limited(error):
+    if _error_status(error) == 429:
+        return True
+    text = f"{type(error).__name__} {error}"
+    return "ResourceExhausted" in text or "rate limit" in text.lower()
+
+
+def _is_auth_error(error):
+    """Missing or rejected credentials: every request will fail the same way."""
+    if isinstance(error, ProviderNotConfigured):
+        return True
+    status = _error_status(error)
+    if status in (401, 403):
+        return True
+    # Gemini reports a bad API key as 400 INVALID_ARGUMENT
+    return status == 400 and (getattr(error, "reason", None) == "API_KEY_INVALID" or "API key" in str(error))
+
+
+def _is_input_error(error):
+    """This request's content was rejected; other inputs may still succeed."""
+    return _error_status(error) in (400, 413, 422) and not _is_auth_error(error)
+
+
+def _is_client_error(error):
+    """Bad input or bad credentials — retrying the same request will not help."""
+    return _is_auth_error(error) or _is_input_error(error)
+
+
+def _embed_with_retry(texts, task_type):
+    """Call the embedder, backing off on rate limits and transient errors."""
+
+    attempt = 0
+    while True:
+        try:
+            return embed_batch_fn(texts, task_type)
+        except Exception as e:
+            attempt += 1
+            if attempt > EMBED_MAX_RETRIES or _is_client_error(e):
+                raise
+            delay = EMBED_BACKOFF_BASE * (2 ** (attempt - 1))
+            if _is_rate_limited(e):
+                delay *= 2
+            delay += random.uniform(0, EMBED_BACKOFF_BASE)
+            EMBEDDING_RETRIES.inc()
+            log_event(logging.WARNING, "embedding_retry", batch=len(texts), attempt=attempt,
+                      max_retries=EMBED_MAX_RETRIES, delay_s=round(delay, 1), error=e)
+            time.sleep(delay)
+
+
+def _embed_batch_job(texts, task_type):
+    """Embed one batch; on a per-input error, isolate the failing texts one by one.
+
+    Returns (vectors, errors) where a failed position has vector None and its
+    error message in errors. Any other failure (rate limits, timeouts, bad
+    credentials) fails the whole batch once retries are exhausted: resending
+    its texts one by one would only multiply requests that fail the same way.
+    """
+
+    try:
+        return _embed_with_retry(texts, task_type), [None] * len(texts)
+    except Exception as e:
+        if len(texts) == 1 or not _is_input_error(e):
+            return [None] * len(texts), [str(e)] * len(texts)
+
+    vectors, errors = [], []
+    for i, text in enumerate(texts):
+        try:
+            vectors.append(_embed_with_retry([text], task_type)[0])
+            errors.append(None)
+        except Exception as e:
+            if not _is_input_error(e):
+                # the provider is failing now, not this text: stop isolating
+                vectors.extend([None] * (len(texts) - i))
+                errors.extend([str(e)] * (len(texts) - i))
+                break
+            vectors.append(None)
+            errors.append(str(e))
+    return vectors, errors
 
 
 # =============================
-# EMBEDDINGS (GEMINI)
+# EMBEDDING CACHE (CONTENT-HASH, SQLITE)
 # =============================
-def get_embedding(text, task_type="retrieval_document"):
-    """Return embedding vector for text using Gemini with a short timeout."""
-    import concurrent.futures
-
-    def _call():
-        return genai.embed_content(
-            model="models/gemini-embedding-001",
-            content=text,
-            task_type=task_type
+# sha256(model, task_type, normalized text) -> float32 vector blob.
+# Bounded to EMBED_CACHE_MAX_ENTRIES with least-recently-used eviction;
+# set it to 0 to disable the cache.
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", os.path.join("index", "embedding_cache.sqlite3"))
+EMBED_CACHE_MAX_ENTRIES = int(os.getenv("EMBED_CACHE_MAX_ENTRIES", "50000"))
+
+_embed_cache_conn = None
+_embed_cache_lock = threading.Lock()
+embed_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def _embed_cache():
+    global _embed_cache_conn
+    if _embed_cache_conn is None:
+        os.makedirs(os.path.dirname(EMBED_CACHE_PATH) or ".", exist_ok=True)
+        conn = sqlite3.connect(EMBED_CACHE_PATH, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)")
+        _embed_cache_conn = conn
+    return _embed_cache_conn
+
+
+def embedding_cache_key(text, task_type):
+    normalized = re.sub(r"\s+", " ", text).strip()
+    return hashlib.sha256(f"{EMBEDDING_MODEL}\0{task_type}\0{normalized}".encode("utf-8")).hexdigest()
+
+
+def embed_cache_get_many(keys):
+    """Return {key: vector} for the keys present in the cache."""
+
+    if EMBED_CACHE_MAX_ENTRIES <= 0 or not keys:
+        return {}
+
+    found = {}
+    now = time.time()
+    with _embed_cache_lock:
+        conn = _embed_cache()
+        unique = list(dict.fromkeys(keys))
+        for i in range(0, len(unique), 500):
+            batch = unique[i:i + 500]
+            placeholders = ",".join("?" * len(batch))
+            for key, blob in conn.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+            ):
+                found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+        if found:
+            conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, k) for k in found])
+            conn.commit()
+        hits = sum(1 for k in keys if k in found)
+        embed_cache_stats["hits"] += hits
+        embed_cache_stats["misses"] += len(keys) - hits
+    CACHE_REQUESTS.inc(hits, cache="embedding", result="hit")
+    CACHE_REQUESTS.inc(len(keys) - hits, cache="embedding", result="miss")
+    return found
+
+
+def embed_cache_put_many(items):
+    """Store (key, vector) pairs, evicting least-recently-used rows over the bound."""
+
+    if EMBED_CACHE_MAX_ENTRIES <= 0 or not items:
+        return
+
+    now = time.time()
+    with _embed_cache_lock:
+        conn = _embed_cache()
+        conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+            [(k, np.asarray(v, dtype=np.float32).tobytes(), now) for k, v in items],
         )
+        (count,) = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        overflow = count - EMBED_CACHE_MAX_ENTRIES
+        if overflow > 0:
+            conn.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                (overflow,),
+            )
+            embed_cache_stats["evictions"] += overflow
+            CACHE_EVICTIONS.inc(overflow, cache="embedding")
+        conn.commit()
 
-    try:
-        with concurrent.futures.ThreadPoolExecutor() as pool:
-            future = pool.submit(_call)
-            result = future.result(timeout=15)  # 15s max per embedding
-        print("🔵 embedding generated")
-        return result["embedding"]
-    except concurrent.futures.TimeoutError:
-        print("⚠️ Embedding timed out (15s)")
+
+def embed_texts(texts, task_type="retrieval_document", batch_size=None, on_progress=None):
+    """Embed many texts through the shared pool in batches.
+
+    Returns (vectors, failures): vectors is aligned with texts (None where
+    embedding failed) and failures is a list of {"index", "error"}.
+    on_progress(embedded_so_far) is called as batches complete.
+    """
+
+    batch_size = batch_size or EMBED_BATCH_SIZE
+    vectors = [None] * len(texts)
+    failures = []
+
+    keys = [embedding_cache_key(text, task_type) for text in texts]
+    cached = embed_cache_get_many(keys)
+
+    # only texts not in the cache go to the network; identical texts share one call
+    pending = {}
+    for i, key in enumerate(keys):
+        if key in cached:
+            vectors[i] = cached[key]
+        else:
+            pending.setdefault(key, []).append(i)
+    todo = list(pending)
+
+    batches = {
+        i: [texts[pending[k][0]] for k in todo[i:i + batch_size]]
+        for i in range(0, len(todo), batch_size)
+    }
+    if len(batches) == 1:
+        # a single batch (e.g. a query) runs on the caller's thread instead of
+        # queueing behind bulk upload batches in the shared pool
+        outcomes = [(0, _embed_batch_job(batches[0], task_type))]
+    else:
+        futures = {_embedding_pool.submit(_embed_batch_job, batch, task_type): i for i, batch in batches.items()}
+        outcomes = ((futures[f], f.result()) for f in concurrent.futures.as_completed(futures))
+
+    fresh = []
+    embedded = len(texts) - sum(map(len, pending.values()))
+    if on_progress and embedded:
+        on_progress(embedded)
+    for start, (batch_vectors, batch_errors) in outcomes:
+        for offset, (vector, error) in enumerate(zip(batch_vectors, batch_errors)):
+            key = todo[start + offset]
+            if error is None and vector:
+                fresh.append((key, vector))
+                for i in pending[key]:
+                    vectors[i] = vector
+                embedded += len(pending[key])
+            else:
+                failures.extend({"index": i, "error": error or "empty embedding"} for i in pending[key])
+        if on_progress:
+            on_progress(embedded)
+
+    embed_cache_put_many(fresh)
+
+    failures.sort(key=lambda f: f["index"])
+    if failures:
+        EMBEDDING_FAILURES.inc(len(failures))
+    if texts:
+        log_event(logging.DEBUG, "embeddings_ready", ok=len(texts) - len(failures), total=len(texts),
+                  cached=len(texts) - sum(map(len, pending.values())))
+    return vectors, failures
+
+
+def get_embedding(text, task_type="retrieval_document"):
+    """Return embedding vector for text using Gemini, or None if it failed."""
+
+    vectors, failures = embed_texts([text], task_type=task_type)
+    if failures:
+        log_event(logging.WARNING, "embedding_failed", error=failures[0]["error"])
         return None
-    except Exception as e:
-        print(f"⚠️ Embedding failed: {e}")
+    return vectors[0]
+
+
+# =============================
+# VECTOR SCORING (NUMPY)
+# =============================
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def build_embedding_matrix(chunks):
+    """Stack chunk embeddings into a pre-normalized float32 matrix.
+
+    Returns (matrix, rows) where rows[i] is the position in `chunks` of the
+    chunk whose embedding is matrix[i]. Chunks without an embedding are skipped.
+    """
+
+    rows = [i for i, c in enumerate(chunks) if c.get("embedding")]
+    if not rows:
+        return np.zeros((0, 0), dtype=np.float32), np.zeros(0, dtype=np.int64)
+
+    dim = len(chunks[rows[0]]["embedding"])
+    rows = [i for i in rows if len(chunks[i]["embedding"]) == dim]
+
+    matrix = _normalize_rows(np.asarray([chunks[i]["embedding"] for i in rows], dtype=np.float32))
+
+    return np.ascontiguousarray(matrix), np.asarray(rows, dtype=np.int64)
+
+
+def _top_k(scores, k, row_ids):
+    """Indices into `scores` of the k best, highest first, ties by row id."""
+    k = min(k, scores.shape[0])
+    top = np.argpartition(-scores, k - 1)[:k]
+    # highest score first, ties keep index order (same as a stable sort)
+    return top[np.lexsort((row_ids[top], -scores[top]))]
+
+
+def score_query(query_embedding, index, top_k, nprobe=None):
+    """Return [(score, chunk), ...] for the top_k chunks by cosine similarity.
+
+    Large subjects with a trained ANN index only score the rows in the
+    `nprobe` closest inverted lists; small ones are always scanned exactly.
+    """
+
+    matrix = index["matrix"]
+    if matrix.shape[0] == 0 or top_k <= 0:
+        return []
+
+    query = np.asarray(query_embedding, dtype=np.float32)
+    if query.shape[0] != matrix.shape[1]:
+        log_event(logging.WARNING, "query_dim_mismatch", query_dim=query.shape[0], index_dim=matrix.shape[1])
+        return []
+    norm = np.linalg.norm(query)
+    if norm == 0:
+        return []
+    query = query / norm
+
+    chunks = index["chunks"]
+    rows = index["rows"]
+    search = index.get("search")
+
+    ann = index.get("ann")
+    if ann is not None and matrix.shape[0] >= ANN_MIN_ROWS:
+        candidates = ANN_BACKENDS[ann["backend"]]["candidates"](ann, query, nprobe or ANN_NPROBE)
+        if candidates.shape[0] >= top_k:
+            if search is not None:
+                top_rows, scores = compressed_top_rows(index, query, top_k, candidates)
+                return [(float(score), chunks[rows[r]]) for r, score in zip(top_rows, scores)]
+            scores = matrix[candidates] @ query
+            top = _top_k(scores, top_k, candidates)
+            return [(float(scores[i]), chunks[rows[candidates[i]]]) for i in top]
+
+    if search is not None:
+        top_rows, scores = compressed_top_rows(index, query, top_k)
+        return [(float(score), chunks[rows[r]]) for r, score in zip(top_rows, scores)]
+
+    scores = matrix @ query
+    top = _top_k(scores, top_k, np.arange(scores.shape[0]))
+    return [(float(scores[r]), chunks[rows[r]]) for r in top]
+
+
+# =============================
+# COMPRESSED SEARCH (MATRYOSHKA + QUANTIZATION)
+# =============================
+# Optional. Queries are first scored against a compact in-RAM copy of the
+# embedding matrix: its leading EMBED_SEARCH_DIM dimensions (gemini-embedding-001
+# is Matryoshka-trained, so a prefix is itself a usable embedding), re-normalized
+# and stored as float32, int8 (4x smaller) or sign bits (32x smaller). The best
+# max(top_k x EMBED_RESCORE_FACTOR, EMBED_RESCORE_MIN) rows are then rescored
+# against the full-precision float32 segments, which stay memory-mapped and are
+# read only for those rows. Returned scores are always full-precision cosine,
+# so MIN_SCORE_THRESHOLD and the confidence labels mean the same thing.
+EMBED_SEARCH_DIM = int(os.getenv("EMBED_SEARCH_DIM", "0"))  # 0 = every dimension
+EMBED_QUANTIZATION = os.getenv("EMBED_QUANTIZATION", "none")  # none | int8 | binary
+EMBED_RESCORE_FACTOR = int(os.getenv("EMBED_RESCORE_FACTOR", "10"))
+EMBED_RESCORE_MIN = int(os.getenv("EMBED_RESCORE_MIN", "100"))
+QUANTIZATIONS = ("none", "int8", "binary")
+_SEARCH_BLOCK = 8192
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def compressed_search_enabled(dim=None, quantization=None):
+    dim = EMBED_SEARCH_DIM if dim is None else dim
+    quantization = EMBED_QUANTIZATION if quantization is None else quantization
+    return dim > 0 or quantization != "none"
+
+
+class StackedRows:
+    """Read-only row access across several memory-mapped segment matrices.
+
+    Stands in for the concatenated matrix when compressed search is on, so
+    the full-precision vectors stay on disk instead of being copied into RAM.
+    Supports .shape, integer, slice and integer-array row indexing.
+    """
+
+    def __init__(self, parts, row_ids):
+        self._parts = parts
+        self._starts = np.concatenate(([0], np.cumsum([p.shape[0] for p in parts])))
+        self._row_ids = row_ids
+        self.shape = (row_ids.shape[0], parts[0].shape[1])
+        self.ndim = 2
+        self.dtype = np.dtype(np.float32)
+        self.nbytes = row_ids.nbytes
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self._gather(np.asarray([key]))[0]
+        if isinstance(key, slice):
+            key = np.arange(*key.indices(self.shape[0]))
+        return self._gather(np.asarray(key, dtype=np.int64))
+
+    def _gather(self, idx):
+        positions = self._row_ids[idx]
+        parts = np.searchsorted(self._starts, positions, side="right") - 1
+        out = np.empty((idx.shape[0], self.shape[1]), dtype=np.float32)
+        for part in np.unique(parts):
+            mask = parts == part
+            out[mask] = self._parts[part][positions[mask] - self._starts[part]]
+        return out
+
+
+def build_search_matrix(matrix, dim=None, quantization=None):
+    """Compact search copy of a normalized matrix, or None when compression is off."""
+
+    dim = EMBED_SEARCH_DIM if dim is None else dim
+    quantization = EMBED_QUANTIZATION if quantization is None else quantization
+    if quantization not in QUANTIZATIONS:
+        log_event(logging.WARNING, "quantization_unknown", quantization=quantization, using="none")
+        quantization = "none"
+    if not compressed_search_enabled(dim, quantization) or not matrix.shape[0]:
         return None
 
+    n = matrix.shape[0]
+    d = min(dim or matrix.shape[1], matrix.shape[1])
+
+    def blocks():
+        for start in range(0, n, _SEARCH_BLOCK):
+            block = np.asarray(matrix[start:start + _SEARCH_BLOCK], dtype=np.float32)[:, :d]
+            yield start, _normalize_rows(block)
+
+    scale = None
+    if quantization == "int8":
+        # per-dimension symmetric scale, so every dimension uses the full int8 range
+        scale = np.zeros(d, dtype=np.float32)
+        for _, block in blocks():
+            np.maximum(scale, np.abs(block).max(axis=0), out=scale)
+        scale = np.where(scale > 0, scale / 127, 1).astype(np.float32)
+        data = np.empty((n, d), dtype=np.int8)
+        for start, block in blocks():
+            data[start:start + block.shape[0]] = np.clip(np.rint(block / scale), -127, 127)
+    elif quantization == "binary":
+        data = np.empty((n, (d + 7) // 8), dtype=np.uint8)
+        for start, block in blocks():
+            data[start:start + block.shape[0]] = np.packbits(block > 0, axis=1)
+    else:
+        data = np.empty((n, d), dtype=np.float32)
+        for start, block in blocks():
+            data[start:start + block.shape[0]] = block
+
+    return {"dim": d, "quantization": quantization, "data": data, "scale": scale}
+
+
+def search_matrix_nbytes(search):
+    return search["data"].nbytes + (search["scale"].nbytes if search["scale"] is not None else 0)
+
+
+def approximate_scores(search, query, rows=None):
+    """Scores of a normalized query against every row (or `rows`) of a search copy."""
+
+    d = search["dim"]
+    q = np.asarray(query[:d], dtype=np.float32)
+    norm = np.linalg.norm(q)
+    q = q / norm if norm else q
+    if search["quantization"] == "int8":
+        q = q * search["scale"]
+    elif search["quantization"] == "binary":
+        q = np.packbits(q > 0)
+
+    data = search["data"]
+    n = data.shape[0] if rows is None else rows.shape[0]
+    out = np.empty(n, dtype=np.float32)
+    for start in range(0, n, _SEARCH_BLOCK):
+        block = data[start:start + _SEARCH_BLOCK] if rows is None else data[rows[start:start + _SEARCH_BLOCK]]
+        if search["quantization"] == "binary":
+            hamming = _POPCOUNT[np.bitwise_xor(block, q)].sum(axis=1, dtype=np.int32)
+            out[start:start + block.shape[0]] = 1 - 2 * hamming / d
+        else:
+            out[start:start + block.shape[0]] = block.astype(np.float32, copy=False) @ q
+    return out
+
+
+def compressed_top_rows(index, query, top_k, candidates=None, rescore=True):
+    """Top rows via the search copy, rescored at full precision; returns (rows, scores).
+
+    With rescore=False the approximate scores are returned as they are (only
+    used to measure what rescoring buys).
+    """
+
+    ids = np.arange(index["matrix"].shape[0]) if candidates is None else candidates
+    approx = approximate_scores(index["search"], query, candidates)
+    if not rescore:
+        top = _top_k(approx, top_k, ids)
+        return ids[top], approx[top]
+
+    shortlist = ids[_top_k(approx, min(ids.shape[0], max(top_k * EMBED_RESCORE_FACTOR, EMBED_RESCORE_MIN)), ids)]
+    shortlist = np.sort(shortlist)  # sequential reads from the memory-mapped segments
+    scores = np.asarray(index["matrix"][shortlist], dtype=np.float32) @ query
+    top = _top_k(scores, top_k, shortlist)
+    return shortlist[top], scores[top]
+
+
+# =============================
+# APPROXIMATE NEAREST NEIGHBOURS (IVF)
+# =============================
+# Inverted-file index over the normalized embedding matrix: k-means centroids
+# partition the rows into lists; a query scores only the rows in its `nprobe`
+# closest lists (higher nprobe = better recall, more latency). Subjects below
+# ANN_MIN_ROWS rows are always scanned exactly. ANN_BACKEND=exact disables it.
+ANN_BACKEND = os.getenv("ANN_BACKEND", "ivf")
+ANN_MIN_ROWS = int(os.getenv("ANN_MIN_ROWS", "20000"))
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", "16"))
+# retrain centroids once the subject has grown this much since the last training
+ANN_RETRAIN_GROWTH = float(os.getenv("ANN_RETRAIN_GROWTH", "2.0"))
+ANN_KMEANS_ITERS = 10
+_ASSIGN_BLOCK = 65536
+
+
+def ivf_list_count(n_rows):
+    return int(min(4096, max(16, math.sqrt(n_rows))))
+
+
+def train_ivf(matrix, nlist=None, seed=0):
+    """Spherical k-means on a sample of the matrix; returns normalized centroids."""
+
+    n = matrix.shape[0]
+    nlist = min(nlist or ivf_list_count(n), n)
+    rng = np.random.default_rng(seed)
+    sample_size = min(n, nlist * 40)
+    sample = np.asarray(matrix[np.sort(rng.choice(n, sample_size, replace=False))], dtype=np.float32)
+
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+    for _ in range(ANN_KMEANS_ITERS):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        empty = np.bincount(assign, minlength=nlist) == 0
+        # re-seed empty lists with random sample rows
+        sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+        centroids = _normalize_rows(sums).astype(np.float32)
+
+    return centroids
+
 
-def cosine_similarity(a, b):
-    """Pure Python cosine similarity between two vectors."""
-    dot = sum(x * y for x, y in zip(a, b))
-    mag_a = math.sqrt(sum(x * x for x in a))
-    mag_b = math.sqrt(sum(x * x for x in b))
-    if mag_a == 0 or mag_b == 0:
-        return 0.0
-    return dot / (mag_a * mag_b)
+def assign_ivf(matrix, centroids):
+    """Nearest-centroid list id for every row, computed in blocks."""
+
+    out = np.empty(matrix.shape[0], dtype=np.int32)
+    for start in range(0, matrix.shape[0], _ASSIGN_BLOCK):
+        block = np.asarray(matrix[start:start + _ASSIGN_BLOCK], dtype=np.float32)
+        out[start:start + block.shape[0]] = np.argmax(block @ centroids.T, axis=1)
+    return out
+
+
+def build_ivf(centroids, assignments):
+    """Group row ids by list: rows of list i are order[offsets[i]:offsets[i+1]]."""
+
+    order = np.argsort(assignments, kind="stable")
+    counts = np.bincount(assignments, minlength=centroids.shape[0])
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    return {"backend": "ivf", "centroids": centroids, "order": order, "offsets": offsets}
+
+
+def ivf_candidates(ann, query, nprobe):
+    centroids = ann["centroids"]
+    nprobe = min(nprobe, centroids.shape[0])
+    probe = np.argpartition(-(centroids @ query), nprobe - 1)[:nprobe]
+    order, offsets = ann["order"], ann["offsets"]
+    return np.concatenate([order[offsets[i]:offsets[i + 1]] for i in probe])
+
+
+# pluggable backends: name -> train(matrix) / assign(matrix, state) / build / candidates
+ANN_BACKENDS = {
+    "ivf": {
+        "train": train_ivf,
+        "assign": assign_ivf,
+        "build": build_ivf,
+        "candidates": ivf_candidates,
+    },
+}
+
+
+# =============================
+# LEXICAL INDEX (BM25)
+# =============================
+# Each segment stores inverted postings for its chunks (seg-{id}.terms.json),
+# built when the segment is written. Loading a subject merges the live
+# segments' postings, so tombstoned (deleted) sources drop out with them.
+#
+# Lexical hits are ranked by BM25 but scored by coverage: the share of the
+# query's IDF mass (over terms that occur in the notes at all) found in the
+# chunk. Coverage is mapped onto the cosine scale so MIN_SCORE_THRESHOLD and
+# the confidence labels apply to every mode: LEXICAL_MIN_COVERAGE lands on the
+# default 0.55 threshold and full coverage on LEXICAL_MAX_SCORE, inside the
+# "Medium" band. Term overlap alone cannot tell a generic match ("explain the
+# process") from a real one, so it never claims "High".
+BM25_K1 = 1.2
+BM25_B = 0.75
+LEXICAL_MIN_COVERAGE = float(os.getenv("LEXICAL_MIN_COVERAGE", "0.5"))
+LEXICAL_MAX_SCORE = 0.70
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have how in is it its of on or that the "
+    "this to was were what when where which who why will with does do did can".split()
+)
+
+
+def tokenize(text):
+    return [t for t in re.findall(r"[a-z0-9_]+", text.lower()) if t not in STOPWORDS]
+
+
+def build_postings(texts):
+    """Inverted postings for a list of chunk texts: {"doc_len", "postings": {term: [[pos, tf]]}}."""
+
+    postings = {}
+    doc_len = []
+    for pos, text in enumerate(texts):
+        tokens = tokenize(text)
+        doc_len.append(len(tokens))
+        for term, tf in Counter(tokens).items():
+            postings.setdefault(term, []).append([pos, tf])
+    return {"doc_len": doc_len, "postings": postings}
+
+
+def merge_postings(parts, n_chunks):
+    """Merge per-segment postings into one subject-level lexical index.
+
+    `parts` is a list of (postings, position_map) where position_map[local]
+    is the chunk's position in the subject (-1 when hidden by a tombstone).
+    """
+
+    merged = {}
+    doc_len = np.zeros(n_chunks, dtype=np.float32)
+    for part, position_map in parts:
+        for local, length in enumerate(part["doc_len"]):
+            if position_map[local] >= 0:
+                doc_len[position_map[local]] = length
+        for term, plist in part["postings"].items():
+            entry = merged.setdefault(term, ([], []))
+            for local, tf in plist:
+                pos = position_map[local]
+                if pos >= 0:
+                    entry[0].append(pos)
+                    entry[1].append(tf)
+
+    terms = {
+        term: (np.asarray(p, dtype=np.int64), np.asarray(tf, dtype=np.float32))
+        for term, (p, tf) in merged.items() if p
+    }
+    avgdl = float(doc_len.mean()) if n_chunks and doc_len.any() else 1.0
+    return {"terms": terms, "doc_len": doc_len, "avgdl": avgdl}
+
+
+def lexical_similarity(coverage):
+    """Map query-term coverage (0..1) onto the cosine similarity scale."""
+    if coverage >= 1.0 or LEXICAL_MIN_COVERAGE >= 1.0:
+        return LEXICAL_MAX_SCORE if coverage >= LEXICAL_MIN_COVERAGE else 0.0
+    slope = (LEXICAL_MAX_SCORE - 0.55) / (1.0 - LEXICAL_MIN_COVERAGE)
+    return max(0.0, 0.55 + (coverage - LEXICAL_MIN_COVERAGE) * slope)
+
+
+def lexical_search(lexical, query, top_k):
+    """BM25 top_k as [(position, bm25, similarity)].
+
+    similarity is lexical_similarity() of the chunk's coverage of the query,
+    comparable across queries and modes, so it stands in for cosine.
+    Query terms that occur nowhere in the notes are left out of the coverage:
+    no chunk can match them, and their high IDF would sink every hit.
+    """
+
+    n = lexical["doc_len"].shape[0]
+    terms = list(dict.fromkeys(tokenize(query)))
+    if not n or not terms or top_k <= 0:
+        return []
+
+    scores = np.zeros(n, dtype=np.float32)
+    matched = np.zeros(n, dtype=np.float32)
+    total_idf = 0.0
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * lexical["doc_len"] / lexical["avgdl"])
+
+    for term in terms:
+        positions, tf = lexical["terms"].get(term, (None, None))
+        df = 0 if positions is None else positions.shape[0]
+        if not df:
+            continue
+        idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+        total_idf += idf
+        scores[positions] += idf * tf * (BM25_K1 + 1) / (tf + norm[positions])
+        matched[positions] += idf
+
+    hits = np.flatnonzero(scores)
+    if not hits.size:
+        return []
+    top = hits[_top_k(scores[hits], top_k, hits)]
+    return [(int(p), float(scores[p]), lexical_similarity(float(matched[p] / total_idf))) for p in top]
 
 
 # =============================
@@ -258,64 +1278,220 @@ def custom_openapi():
 
 app.openapi = custom_openapi
 
+
+# =============================
+# BLOCKING WORK OFF THE EVENT LOOP
+# =============================
+# The Gemini/Groq SDKs, PyMuPDF and file writes are all synchronous. Async
+# routes hand them to this bounded pool so one slow call never stalls the
+# event loop for every other request.
+BLOCKING_WORKERS = int(os.getenv("BLOCKING_WORKERS", "32"))
+
+_blocking_pool = concurrent.futures.ThreadPoolExecutor(
+    max_workers=BLOCKING_WORKERS, thread_name_prefix="blocking"
+)
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """Run a synchronous call in the bounded worker pool and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_blocking_pool, functools.partial(fn, *args, **kwargs))
+
+
+# =============================
+# UPLOAD SPOOLING (HASH + BYTE BUDGETS)
+# =============================
+# Starlette has already spooled each multipart file to a temporary file by the
+# time /upload runs. It is copied into uploads/ in bounded chunks in a single
+# pass that also computes the sha256 used for de-duplication, so the content
+# is never held in memory whole and never read twice before extraction.
+#
+# Bytes stay charged to the global in-flight budget from the copy until the
+# ingestion job finishes (extraction and OCR are where large scans cost RAM).
+# When the budget is exhausted new uploads wait, up to UPLOAD_BUDGET_WAIT
+# seconds, before their bytes are read.
+UPLOAD_READ_CHUNK = 1024 * 1024
+UPLOAD_MAX_BYTES = int(float(os.getenv("UPLOAD_MAX_MB", "200")) * 1024 * 1024)
+UPLOAD_REQUEST_MAX_BYTES = int(float(os.getenv("UPLOAD_REQUEST_MAX_MB", "1024")) * 1024 * 1024)
+UPLOAD_INFLIGHT_MAX_BYTES = int(float(os.getenv("UPLOAD_INFLIGHT_MAX_MB", "512")) * 1024 * 1024)
+UPLOAD_BUDGET_WAIT = float(os.getenv("UPLOAD_BUDGET_WAIT", "300"))
+
+
+class UploadTooLarge(ValueError):
+    pass
+
+
+class ByteBudget:
+    """A counting budget of bytes shared by every in-flight upload."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.in_use = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self, n):
+        with self._lock:
+            # an idle budget always admits one upload, however large
+            if self.in_use and self.in_use + n > self.capacity:
+                return False
+            self.in_use += n
+            return True
+
+    def release(self, n):
+        with self._lock:
+            self.in_use = max(0, self.in_use - n)
+
+    async def acquire(self, n, timeout):
+        deadline = time.monotonic() + timeout
+        while not self.try_acquire(n):
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.05)
+        return True
+
+
+upload_budget = ByteBudget(UPLOAD_INFLIGHT_MAX_BYTES)
+
+
+def upload_size(file):
+    """Size of a spooled UploadFile, without reading it."""
+    if file.size is not None:
+        return file.size
+    size = file.file.seek(0, os.SEEK_END)
+    file.file.seek(0)
+    return size
+
+
+def spool_upload(src, dest_path, max_bytes=None):
+    """Copy a file object to dest_path in bounded chunks; returns (sha256, bytes)."""
+
+    max_bytes = UPLOAD_MAX_BYTES if max_bytes is None else max_bytes
+    digest = hashlib.sha256()
+    size = 0
+    with open(dest_path, "wb") as out:
+        while data := src.read(UPLOAD_READ_CHUNK):
+            size += len(data)
+            if size > max_bytes:
+                raise UploadTooLarge(f"file exceeds {max_bytes // (1024 * 1024)} MB")
+            digest.update(data)
+            out.write(data)
+    return digest.hexdigest(), size
+
+# Created on first write (ensure_subject / index writes), not at import.
 UPLOAD_DIR = "uploads"
 INDEX_DIR = "index"
 
-os.makedirs("uploads/subject1", exist_ok=True)
-os.makedirs("uploads/subject2", exist_ok=True)
-os.makedirs("uploads/subject3", exist_ok=True)
-os.makedirs(INDEX_DIR, exist_ok=True)
+
+def _list_dir(path):
+    try:
+        return os.listdir(path)
+    except FileNotFoundError:
+        return []
 
 
 # =============================
-# FLAT JSON INDEX STORAGE
+# SUBJECT REGISTRY
 # =============================
-def save_chunks_to_index(subject, chunks):
-    """Append chunks to index/{subject}_index.json with embeddings."""
+# Subjects are created on demand (first upload or POST /subjects) and are
+# discovered from the uploads/ and index/ folders, so there is no fixed list.
+# DEFAULT_SUBJECTS are always listed so a fresh install shows something.
+SUBJECT_NAME_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_-]{0,63}$")
+DEFAULT_SUBJECTS = [s for s in os.getenv("DEFAULT_SUBJECTS", "subject1,subject2,subject3").split(",") if s]
 
-    index_path = os.path.join(INDEX_DIR, f"{subject}_index.json")
 
-    # Load existing chunks
-    if os.path.exists(index_path):
-        try:
-            with open(index_path, "r", encoding="utf-8") as f:
-                existing = json.load(f)
-        except (json.JSONDecodeError, ValueError):
-            existing = []
-    else:
-        existing = []
+def is_valid_subject(subject):
+    """Subject names double as folder names: letters, digits, '-' and '_' only."""
+    return bool(subject) and SUBJECT_NAME_PATTERN.match(subject) is not None
 
-    # Add citation + embedding and append
-    for chunk in chunks:
-        chunk["citation"] = f"{chunk['source']} | page {chunk['page']}"
 
-        # Generate embedding if not already present
-        if "embedding" not in chunk:
-            embedding = get_embedding(chunk["text"], task_type="retrieval_document")
-            if embedding:
-                chunk["embedding"] = embedding
+def ensure_subject(subject):
+    os.makedirs(os.path.join(UPLOAD_DIR, subject), exist_ok=True)
 
-        existing.append(chunk)
 
-    # Write back safely (atomic-ish via temp file)
-    tmp_path = index_path + ".tmp"
-    with open(tmp_path, "w", encoding="utf-8") as f:
-        json.dump(existing, f, indent=2, ensure_ascii=False)
-    os.replace(tmp_path, index_path)
-
-    print(f"💾 Saved {len(chunks)} chunks → {index_path} (total: {len(existing)})")
+def list_subjects():
+    found = set(DEFAULT_SUBJECTS)
+    for name in _list_dir(UPLOAD_DIR):
+        if os.path.isdir(os.path.join(UPLOAD_DIR, name)) and is_valid_subject(name):
+            found.add(name)
+    for name in _list_dir(INDEX_DIR):
+        if name.endswith("_index.json"):
+            name = name[:-len("_index.json")]
+        elif not os.path.isdir(os.path.join(INDEX_DIR, name)):
+            continue
+        if is_valid_subject(name):
+            found.add(name)
+    return sorted(found)
 
 
 # =============================
-# INDEX LOADING
+# BINARY INDEX STORAGE (v2, APPEND-ONLY SEGMENTS)
 # =============================
-def load_subject_index(subject):
-    """Load all chunks from index/{subject}_index.json."""
+# index/{subject}/
+#   manifest.json   {"version": 2, "generation": n, "dim": d, "next_segment": k,
+#                    "segments": [{"id", "embeddings", "meta", "count"}, ...],
+#                    "tombstones": [{"source", "max_segment"}, ...],
+#                    "sources": {filename: {"sha256", "bytes", "manifest"}}}
+#   seg-{id}.npy    float32 (count, dim), rows L2-normalized, memory-mappable
+#   seg-{id}.jsonl  one compact JSON object per chunk; "row" points into the .npy
+#                   (-1 when the chunk has no embedding)
+#   seg-{id}.terms.json  BM25 postings for the segment's chunks
+#   ivf-{n}.npy     ANN centroids (manifest "ann"), once the subject is large
+#   seg-{id}.ivf-{n}.npy  per-segment ANN list assignments (segment "ann")
+#   src-{name hash}-{id}.json  per-source manifest: page fingerprints, the
+#                   chunk ids on each page and OCR text of scanned pages
+#
+# Segment files are immutable. Uploads append a new segment, deletes append a
+# tombstone that hides a source in every segment up to max_segment, and
+# compaction folds everything back into one segment. The manifest is replaced
+# atomically after the data files are written, so a reader always sees one
+# complete generation. Legacy index/{subject}_index.json files are still read
+# when no manifest exists, and are migrated on first write.
+INDEX_FORMAT_VERSION = 2
+CHUNK_META_FIELDS = ("chunk_id", "page", "page_end", "source", "text", "citation")
 
-    index_path = os.path.join(INDEX_DIR, f"{subject}_index.json")
+# background compaction triggers
+COMPACT_MAX_SEGMENTS = int(os.getenv("INDEX_COMPACT_MAX_SEGMENTS", "8"))
+COMPACT_MAX_TOMBSTONES = int(os.getenv("INDEX_COMPACT_MAX_TOMBSTONES", "4"))
 
-    if not os.path.exists(index_path):
-        return []
+_subject_write_locks = {}
+_subject_write_locks_guard = threading.Lock()
+
+
+def _subject_write_lock(subject):
+    """One writer per subject: serializes manifest read-modify-write cycles."""
+    with _subject_write_locks_guard:
+        return _subject_write_locks.setdefault(subject, threading.RLock())
+
+
+def _subject_index_dir(subject):
+    return os.path.join(INDEX_DIR, subject)
+
+
+def _manifest_path(subject):
+    return os.path.join(_subject_index_dir(subject), "manifest.json")
+
+
+def _json_index_path(subject):
+    return os.path.join(INDEX_DIR, f"{subject}_index.json")
+
+
+def _read_manifest(subject):
+    try:
+        with open(_manifest_path(subject), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError, ValueError):
+        return None
+    if manifest.get("version") != INDEX_FORMAT_VERSION:
+        log_event(logging.WARNING, "index_version_unsupported", subject=subject, version=manifest.get("version"))
+        return None
+    manifest.setdefault("tombstones", [])
+    manifest.setdefault("sources", {})
+    manifest.setdefault("next_segment", max((seg.get("id", 0) for seg in manifest["segments"]), default=0) + 1)
+    return manifest
+
+
+def _read_json_index(index_path):
+    """Parse a legacy index/{subject}_index.json from disk."""
 
     try:
         with open(index_path, "r", encoding="utf-8") as f:
@@ -324,29 +1500,773 @@ def load_subject_index(subject):
         return []
 
 
+def _read_binary_index(subject, manifest, lazy_rows=False):
+    """Load the live chunks, embedding matrix and ANN state for one generation.
+
+    With lazy_rows=True a matrix spread over several segments (or with
+    tombstoned rows) is returned as a StackedRows view over the memory-mapped
+    segments instead of being concatenated into RAM.
+    """
+
+    index_dir = _subject_index_dir(subject)
+    hidden = {}
+    for tomb in manifest["tombstones"]:
+        hidden[tomb["source"]] = max(hidden.get(tomb["source"], -1), tomb["max_segment"])
+
+    ann_meta = manifest.get("ann")
+    if ann_meta and (ANN_BACKEND == "exact" or ann_meta["backend"] not in ANN_BACKENDS):
+        ann_meta = None
+    centroids = _load_ann_centroids(subject, ann_meta) if ann_meta else None
+
+    chunks = []
+    matrices = []
+    assignments = []
+    row_ids = []
+    postings = []
+    offset = 0
+
+    for segment in manifest["segments"]:
+        seg_id = segment.get("id", 0)
+        matrix = np.load(os.path.join(index_dir, segment["embeddings"]), mmap_mode="r")
+        if centroids is not None and matrix.shape[0]:
+            if segment.get("ann"):
+                assignments.append(np.load(os.path.join(index_dir, segment["ann"])))
+            else:
+                assignments.append(ANN_BACKENDS[ann_meta["backend"]]["assign"](matrix, centroids))
+        position_map = []
+        seg_texts = []
+        with open(os.path.join(index_dir, segment["meta"]), "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                meta = json.loads(line)
+                row = meta.pop("row", -1)
+                seg_texts.append(meta.get("text", ""))
+                if seg_id <= hidden.get(meta.get("source"), -1):
+                    position_map.append(-1)
+                    continue
+                if row >= 0:
+                    row_ids.append(offset + row)
+                    meta["_pos"] = len(chunks)
+                position_map.append(len(chunks))
+                chunks.append(meta)
+        if segment.get("terms"):
+            with open(os.path.join(index_dir, segment["terms"]), "r", encoding="utf-8") as f:
+                postings.append((json.load(f), position_map))
+        else:
+            postings.append((build_postings(seg_texts), position_map))
+        if matrix.shape[0]:
+            matrices.append(matrix)
+        offset += matrix.shape[0]
+
+    row_ids = np.asarray(row_ids, dtype=np.int64)
+    identity = np.array_equal(row_ids, np.arange(offset))
+    if lazy_rows and matrices and (len(matrices) > 1 or not identity):
+        matrix = StackedRows(matrices, row_ids)
+    else:
+        if len(matrices) == 1:
+            matrix = matrices[0]
+        elif matrices:
+            matrix = np.concatenate(matrices)
+        else:
+            matrix = np.zeros((0, manifest.get("dim") or 0), dtype=np.float32)
+        if not identity:
+            matrix = np.ascontiguousarray(matrix[row_ids])
+
+    ann = None
+    if centroids is not None and assignments:
+        assignments = np.concatenate(assignments)
+        if not identity:
+            assignments = assignments[row_ids]
+        ann = ANN_BACKENDS[ann_meta["backend"]]["build"](centroids, assignments)
+
+    rows = np.asarray([c.pop("_pos") for c in chunks if "_pos" in c], dtype=np.int64)
+    return chunks, matrix, rows, ann, merge_postings(postings, len(chunks))
+
+
+def _load_ann_centroids(subject, ann_meta):
+    return np.load(os.path.join(_subject_index_dir(subject), ann_meta["centroids"]))
+
+
+def _assign_segment(subject, segment, matrix, manifest):
+    """Write the ANN list assignments of one segment under the current centroids."""
+
+    segment.pop("ann", None)
+    ann_meta = manifest.get("ann")
+    if not ann_meta or ann_meta["backend"] not in ANN_BACKENDS or not matrix.shape[0]:
+        return
+
+    centroids = _load_ann_centroids(subject, ann_meta)
+    assignments = ANN_BACKENDS[ann_meta["backend"]]["assign"](matrix, centroids)
+    name = f"seg-{segment['id']}.{ann_meta['tag']}.npy"
+    np.save(os.path.join(_subject_index_dir(subject), name), assignments)
+    segment["ann"] = name
+
+
+def _write_segment(subject, segment_id, chunks, matrix, rows):
+    """Write one immutable segment and return its manifest entry.
+
+    `matrix` holds normalized float32 embeddings; `rows[i]` is the position in
+    `chunks` of matrix row i.
+    """
+
+    index_dir = _subject_index_dir(subject)
+    os.makedirs(index_dir, exist_ok=True)
+
+    chunk_to_row = {int(c): r for r, c in enumerate(rows)}
+    emb_name = f"seg-{segment_id}.npy"
+    meta_name = f"seg-{segment_id}.jsonl"
+
+    np.save(os.path.join(index_dir, emb_name), np.ascontiguousarray(matrix, dtype=np.float32))
+
+    with open(os.path.join(index_dir, meta_name), "w", encoding="utf-8") as f:
+        for i, chunk in enumerate(chunks):
+            meta = {k: chunk[k] for k in CHUNK_META_FIELDS if k in chunk}
+            meta["row"] = chunk_to_row.get(i, -1)
+            f.write(json.dumps(meta, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+    terms_name = f"seg-{segment_id}.terms.json"
+    with open(os.path.join(index_dir, terms_name), "w", encoding="utf-8") as f:
+        json.dump(build_postings([c["text"] for c in chunks]), f, separators=(",", ":"))
+
+    return {
+        "id": segment_id,
+        "embeddings": emb_name,
+        "meta": meta_name,
+        "terms": terms_name,
+        "count": len(chunks),
+        "rows": int(matrix.shape[0]),
+    }
+
+
+def _publish_manifest(subject, manifest):
+    """Atomically swap in a new manifest and drop the cached snapshot."""
+
+    manifest["generation"] = manifest.get("generation", 0) + 1
+    tmp_path = _manifest_path(subject) + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, _manifest_path(subject))
+    invalidate_subject_index(subject)
+
+
+def _remove_unreferenced_files(subject, manifest):
+    referenced = {"manifest.json"}
+    referenced.update(info.get("manifest") for info in manifest["sources"].values())
+    for segment in manifest["segments"]:
+        referenced.update((segment["embeddings"], segment["meta"], segment.get("ann"), segment.get("terms")))
+    if manifest.get("ann"):
+        referenced.add(manifest["ann"]["centroids"])
+
+    index_dir = _subject_index_dir(subject)
+    for name in os.listdir(index_dir):
+        if name in referenced or name.endswith(".tmp"):
+            continue
+        try:
+            os.remove(os.path.join(index_dir, name))
+        except OSError:
+            pass  # still mapped by a reader (Windows) — removed by the next compaction
+
+
+def _empty_manifest():
+    return {
+        "version": INDEX_FORMAT_VERSION,
+        "generation": 0,
+        "dim": 0,
+        "next_segment": 1,
+        "segments": [],
+        "tombstones": [],
+        "sources": {},
+    }
+
+
+def write_index_snapshot(subject, chunks, matrix, rows):
+    """Replace a subject's whole index with a single fresh segment."""
+
+    with _subject_write_lock(subject):
+        manifest = _read_manifest(subject) or _empty_manifest()
+        segment_id = manifest["next_segment"]
+
+        segment = _write_segment(subject, segment_id, chunks, matrix, rows)
+        _assign_segment(subject, segment, matrix, manifest)
+        manifest["segments"] = [segment]
+        manifest["tombstones"] = []
+        manifest["next_segment"] = segment_id + 1
+        manifest["dim"] = int(matrix.shape[1]) if matrix.ndim == 2 else 0
+        _publish_manifest(subject, manifest)
+
+        _remove_unreferenced_files(subject, manifest)
+        _retire_json_index(subject)
+
+
+def _ensure_binary_index(subject):
+    """Migrate a legacy JSON index before the first incremental write."""
+    if _read_manifest(subject) is None and os.path.exists(_json_index_path(subject)):
+        chunks = _read_json_index(_json_index_path(subject))
+        matrix, rows = build_embedding_matrix(chunks)
+        write_index_snapshot(subject, chunks, matrix, rows)
+
+
+def _source_manifest_name(source_name, segment_id):
+    name_hash = hashlib.sha256(source_name.encode("utf-8")).hexdigest()[:16]
+    return f"src-{name_hash}-{segment_id}.json"
+
+
+def read_source_manifest(subject, source_name):
+    """The per-source manifest of an indexed file, or None."""
+    manifest = _read_manifest(subject)
+    info = manifest["sources"].get(source_name) if manifest else None
+    if not info or not info.get("manifest"):
+        return None
+    try:
+        with open(os.path.join(_subject_index_dir(subject), info["manifest"]), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _write_source_manifest(subject, segment_id, source, chunks):
+    pages = {p["page"]: {"page": p["page"], "hash": p["hash"], "chunks": []} for p in source["pages"]}
+    for chunk in chunks:
+        for page in range(chunk["page"], chunk.get("page_end", chunk["page"]) + 1):
+            if page in pages:
+                pages[page]["chunks"].append(chunk["chunk_id"])
+    name = _source_manifest_name(source["name"], segment_id)
+    with open(os.path.join(_subject_index_dir(subject), name), "w", encoding="utf-8") as f:
+        json.dump({
+            "source": source["name"],
+            "sha256": source.get("sha256"),
+            "bytes": source.get("bytes"),
+            "pages": list(pages.values()),
+            "ocr": source.get("ocr", {}),
+        }, f, ensure_ascii=False, separators=(",", ":"))
+    return name
+
+
+def append_to_index(subject, chunks, matrix, rows, source=None):
+    """Append chunks as a new segment — O(new chunks), existing data untouched.
+
+    source ({"name", "sha256", "bytes"}, optionally "pages" and "ocr") is
+    recorded in the same manifest swap, so a source is registered exactly when
+    its chunks become visible. If the source was indexed before, its old
+    chunks are tombstoned in that same swap: a re-uploaded file replaces its
+    previous version atomically instead of being indexed twice.
+    """
+
+    with _subject_write_lock(subject):
+        _ensure_binary_index(subject)
+        manifest = _read_manifest(subject) or _empty_manifest()
+        segment_id = manifest["next_segment"]
+
+        segment = _write_segment(subject, segment_id, chunks, matrix, rows)
+        _assign_segment(subject, segment, matrix, manifest)
+        if source:
+            if source_is_indexed(subject, source["name"], manifest):
+                manifest["tombstones"].append({"source": source["name"], "max_segment": segment_id - 1})
+            manifest["sources"][source["name"]] = {
+                "sha256": source.get("sha256"),
+                "bytes": source.get("bytes"),
+                "manifest": _write_source_manifest(subject, segment_id, source, chunks) if source.get("pages") else None,
+            }
+        manifest["segments"].append(segment)
+        manifest["next_segment"] = segment_id + 1
+        if not manifest["dim"] and matrix.shape[0]:
+            manifest["dim"] = int(matrix.shape[1])
+        _publish_manifest(subject, manifest)
+
+    _schedule_index_maintenance(subject, manifest)
+
+
+def _retire_json_index(subject):
+    """Move a legacy JSON index out of the way once a v2 index exists."""
+    json_path = _json_index_path(subject)
+    if os.path.exists(json_path):
+        os.replace(json_path, json_path + ".migrated")
+        log_event(logging.INFO, "legacy_index_retired", path=f"{json_path}.migrated")
+
+
+def migrate_json_indexes():
+    """One-shot conversion of every index/*_index.json into the v2 format."""
+
+    migrated = []
+    for name in sorted(_list_dir(INDEX_DIR)):
+        if not name.endswith("_index.json"):
+            continue
+        subject = name[: -len("_index.json")]
+        if _read_manifest(subject):
+            _retire_json_index(subject)
+            continue
+        _ensure_binary_index(subject)
+        migrated.append(subject)
+        log_event(logging.INFO, "index_migrated", subject=subject)
+    return migrated
+
+
+def format_citation(chunk):
+    if chunk.get("page_end", chunk["page"]) != chunk["page"]:
+        return f"{chunk['source']} | pages {chunk['page']}-{chunk['page_end']}"
+    return f"{chunk['source']} | page {chunk['page']}"
+
+
+def save_chunks_to_index(subject, chunks, progress=None, source=None):
+    """Append chunks (with embeddings) to the subject's index as a new segment.
+
+    Returns a list of {"chunk_id", "error"} for chunks whose embedding failed;
+    those chunks are still stored, just without a vector. `progress(**fields)`
+    receives stage / chunks_embedded updates for ingestion jobs; `source` is
+    passed through to append_to_index.
+    """
+
+    progress = progress or (lambda **fields: None)
+
+    index = get_subject_index(subject)
+    dim = index["matrix"].shape[1] if index and index["matrix"].shape[0] else None
+
+    # Add citation; embed every chunk that does not carry an embedding yet
+    for chunk in chunks:
+        chunk["citation"] = format_citation(chunk)
+
+    missing = [pos for pos, chunk in enumerate(chunks) if not chunk.get("embedding")]
+    already = len(chunks) - len(missing)
+    progress(stage="embedding", chunks_total=len(chunks), chunks_embedded=already)
+    with timed("document_embedding"):
+        new_vectors, failures = embed_texts(
+            [chunks[pos]["text"] for pos in missing],
+            on_progress=lambda n: progress(chunks_embedded=already + n),
+        )
+    failed = [{"chunk_id": chunks[missing[f["index"]]]["chunk_id"], "error": f["error"]} for f in failures]
+    for pos, vector in zip(missing, new_vectors):
+        chunks[pos]["embedding"] = vector
+
+    vectors = []
+    rows = []
+    for pos, chunk in enumerate(chunks):
+        embedding = chunk.pop("embedding", None)
+        if not embedding:
+            continue
+        if dim is None:
+            dim = len(embedding)
+        if len(embedding) != dim:
+            log_event(logging.WARNING, "embedding_dim_mismatch", chunk_id=chunk["chunk_id"], dim=len(embedding), index_dim=dim)
+            failed.append({"chunk_id": chunk["chunk_id"], "error": f"dimension {len(embedding)} != {dim}"})
+            continue
+        rows.append(pos)
+        vectors.append(embedding)
+
+    if vectors:
+        matrix = _normalize_rows(np.asarray(vectors, dtype=np.float32))
+    else:
+        matrix = np.zeros((0, dim or 0), dtype=np.float32)
+
+    progress(stage="indexing")
+    with timed("index_write"):
+        append_to_index(subject, chunks, matrix, np.asarray(rows, dtype=np.int64), source=source)
+
+    log_event(logging.INFO, "index_segment_saved", subject=subject, chunks=len(chunks), without_embedding=len(failed))
+    return failed
+
+
+def remove_source_from_index(subject, source):
+    """Hide every chunk of one source file behind a tombstone; returns chunks removed."""
+
+    with _subject_write_lock(subject):
+        _ensure_binary_index(subject)
+
+        index = get_subject_index(subject)
+        manifest = _read_manifest(subject)
+        if not index or manifest is None:
+            return 0
+        removed = sum(1 for c in index["chunks"] if c.get("source") == source)
+        registered = manifest["sources"].pop(source, None) is not None
+        if not removed and not registered:
+            return 0
+
+        if removed:
+            manifest["tombstones"].append({
+                "source": source,
+                "max_segment": manifest["next_segment"] - 1,
+            })
+        _publish_manifest(subject, manifest)
+
+    _schedule_index_maintenance(subject, manifest)
+    return removed
+
+
+def find_source_by_hash(subject, sha256):
+    """Name of the indexed source with this content hash, or None."""
+    manifest = _read_manifest(subject)
+    if manifest is None or not sha256:
+        return None
+    for name, info in manifest["sources"].items():
+        if info.get("sha256") == sha256:
+            return name
+    return None
+
+
+def source_is_indexed(subject, source_name, manifest=None, index=None):
+    """True when the subject has live chunks of this source or has it registered.
+
+    Sources from a migrated legacy JSON index have chunks but no manifest
+    entry; they are replaced on re-upload all the same.
+    """
+    manifest = _read_manifest(subject) if manifest is None else manifest
+    if manifest and source_name in manifest["sources"]:
+        return True
+    index = get_subject_index(subject) if index is None else index
+    return bool(index) and any(c.get("source") == source_name for c in index["chunks"])
+
+
+def reuse_source_embeddings(subject, source_name, chunks):
+    """Copy vectors of unchanged chunks from the source's indexed version.
+
+    A chunk whose text is identical to a live chunk of the same source gets
+    that chunk's stored vector, so only new text goes to the embedding API.
+    Returns the number of chunks reused.
+    """
+
+    index = get_subject_index(subject)
+    if not index or not index["matrix"].shape[0]:
+        return 0
+    position_row = np.full(len(index["chunks"]), -1, dtype=np.int64)
+    position_row[np.asarray(index["rows"], dtype=np.int64)] = np.arange(len(index["rows"]))
+    old_rows = {}
+    for pos, chunk in enumerate(index["chunks"]):
+        if chunk.get("source") == source_name and position_row[pos] >= 0:
+            old_rows[chunk["text"]] = int(position_row[pos])
+
+    reused = 0
+    for chunk in chunks:
+        row = old_rows.get(chunk["text"])
+        if row is not None and not chunk.get("embedding"):
+            chunk["embedding"] = np.asarray(index["matrix"][row], dtype=np.float32).tolist()
+            reused += 1
+    return reused
+
+
+# =============================
+# INDEX COMPACTION
+# =============================
+def compact_subject_index(subject):
+    """Fold all segments and tombstones into one segment. Returns live chunk count."""
+
+    with _subject_write_lock(subject):
+        manifest = _read_manifest(subject)
+        if manifest is None:
+            return 0
+        if len(manifest["segments"]) <= 1 and not manifest["tombstones"]:
+            return manifest["segments"][0]["count"] if manifest["segments"] else 0
+
+        chunks, matrix, rows, _, _ = _read_binary_index(subject, manifest)
+        write_index_snapshot(subject, chunks, np.asarray(matrix), rows)
+
+    log_event(logging.INFO, "index_compacted", subject=subject, segments=len(manifest["segments"]), chunks=len(chunks))
+    return len(chunks)
+
+
+def train_ann_index(subject):
+    """(Re)train the subject's ANN centroids and re-assign every segment.
+
+    Returns True if an ANN index was built, False if the subject is too small
+    or ANN is disabled.
+    """
+
+    if ANN_BACKEND == "exact":
+        return False
+
+    with _subject_write_lock(subject):
+        manifest = _read_manifest(subject)
+        if manifest is None:
+            return False
+        _, matrix, _, _, _ = _read_binary_index(subject, manifest)
+        if matrix.shape[0] < ANN_MIN_ROWS:
+            return False
+
+        started = time.perf_counter()
+        backend = ANN_BACKENDS[ANN_BACKEND]
+        centroids = backend["train"](matrix)
+        tag = f"{ANN_BACKEND}-{manifest['generation'] + 1}"
+        np.save(os.path.join(_subject_index_dir(subject), f"{tag}.npy"), centroids)
+        manifest["ann"] = {
+            "backend": ANN_BACKEND,
+            "centroids": f"{tag}.npy",
+            "tag": tag,
+            "trained_rows": int(matrix.shape[0]),
+        }
+
+        index_dir = _subject_index_dir(subject)
+        for segment in manifest["segments"]:
+            seg_matrix = np.load(os.path.join(index_dir, segment["embeddings"]), mmap_mode="r")
+            _assign_segment(subject, segment, seg_matrix, manifest)
+
+        _publish_manifest(subject, manifest)
+        _remove_unreferenced_files(subject, manifest)
+
+    log_event(logging.INFO, "ann_trained", subject=subject, backend=ANN_BACKEND, lists=centroids.shape[0],
+              rows=matrix.shape[0], seconds=round(time.perf_counter() - started, 1))
+    return True
+
+
+def _needs_ann_training(manifest):
+    if ANN_BACKEND == "exact":
+        return False
+    live_rows = sum(seg.get("rows", seg["count"]) for seg in manifest["segments"])
+    if live_rows < ANN_MIN_ROWS:
+        return False
+    ann_meta = manifest.get("ann")
+    return not ann_meta or live_rows >= ANN_RETRAIN_GROWTH * ann_meta["trained_rows"]
+
+
+_maintenance_running = set()
+_maintenance_lock = threading.Lock()
+
+
+def _schedule_index_maintenance(subject, manifest):
+    """Compact and/or (re)train the ANN index in a background thread when due."""
+
+    compact = len(manifest["segments"]) > COMPACT_MAX_SEGMENTS or len(manifest["tombstones"]) > COMPACT_MAX_TOMBSTONES
+    train = _needs_ann_training(manifest)
+    if not compact and not train:
+        return
+
+    with _maintenance_lock:
+        if subject in _maintenance_running:
+            return
+        _maintenance_running.add(subject)
+
+    def _run():
+        try:
+            if compact:
+                compact_subject_index(subject)
+            if train:
+                train_ann_index(subject)
+        except Exception as e:
+            log_event(logging.ERROR, "index_maintenance_failed", subject=subject, error=e)
+        finally:
+            with _maintenance_lock:
+                _maintenance_running.discard(subject)
+
+    threading.Thread(target=_run, name=f"index-maintenance-{subject}", daemon=True).start()
+
+
+# =============================
+# IN-MEMORY INDEX CACHE
+# =============================
+# subject -> {"key", "chunks", "matrix", "rows", "search", "chunk_ids", "nbytes"}, least
+# recently used first. Indexes load lazily on first use; when the cached total
+# exceeds INDEX_CACHE_MAX_MB the coldest subjects are dropped (they reload from
+# disk on their next query). Loads take a per-subject lock, so one slow cold
+# subject never blocks queries on the others.
+INDEX_CACHE_MAX_MB = float(os.getenv("INDEX_CACHE_MAX_MB", "2048"))
+
+_index_cache = OrderedDict()
+_index_cache_lock = threading.Lock()
+_index_load_locks = {}
+
+
+def _index_load_lock(subject):
+    with _index_cache_lock:
+        return _index_load_locks.setdefault(subject, threading.Lock())
+
+
+def _index_entry_nbytes(entry):
+    """Approximate RAM held by a cached index entry."""
+    total = entry["rows"].nbytes + 8 * len(entry["chunk_ids"])
+    if entry.get("search") is not None:
+        # the full-precision rows stay on disk and are only paged in for rescoring
+        total += search_matrix_nbytes(entry["search"])
+        if not isinstance(entry["matrix"], (np.memmap, StackedRows)):
+            total += entry["matrix"].nbytes
+    else:
+        total += entry["matrix"].nbytes
+    total += sum(len(c.get("text", "")) + 200 for c in entry["chunks"])
+    lexical = entry["lexical"]
+    total += lexical["doc_len"].nbytes + sum(p.nbytes + tf.nbytes + 100 for p, tf in lexical["terms"].values())
+    if entry["ann"]:
+        total += sum(v.nbytes for v in entry["ann"].values() if isinstance(v, np.ndarray))
+    return total
+
+
+def _evict_cold_indexes_locked(keep):
+    limit = INDEX_CACHE_MAX_MB * 1024 * 1024
+    total = sum(e["nbytes"] for e in _index_cache.values())
+    for subject in list(_index_cache):
+        if total <= limit:
+            break
+        if subject == keep:
+            continue
+        total -= _index_cache.pop(subject)["nbytes"]
+        CACHE_EVICTIONS.inc(cache="index")
+        log_event(logging.INFO, "index_evicted", subject=subject)
+
+
+def index_cache_stats():
+    with _index_cache_lock:
+        return {
+            "subjects": list(_index_cache),
+            "bytes": sum(e["nbytes"] for e in _index_cache.values()),
+            "mb": round(sum(e["nbytes"] for e in _index_cache.values()) / (1024 * 1024), 1),
+            "max_mb": INDEX_CACHE_MAX_MB,
+        }
+
+
+def get_subject_index(subject):
+    """Return the cached index entry for a subject, reloading if the files changed."""
+
+    manifest_path = _manifest_path(subject)
+    json_path = _json_index_path(subject)
+
+    # A compaction may delete segment files between reading the manifest and
+    # opening them; re-read the (newer) manifest and try again.
+    for _ in range(3):
+        path = manifest_path if os.path.exists(manifest_path) else json_path
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            invalidate_subject_index(subject)
+            return None
+        # manifests are published with os.replace, so every publish has a new
+        # inode even when mtime and size repeat within one clock tick
+        key = (path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+        with _index_cache_lock:
+            entry = _index_cache.get(subject)
+            if entry and entry["key"] == key:
+                _index_cache.move_to_end(subject)
+                CACHE_REQUESTS.inc(cache="index", result="hit")
+                return entry
+
+        with _index_load_lock(subject):
+            # another request may have loaded it while we waited
+            with _index_cache_lock:
+                entry = _index_cache.get(subject)
+                if entry and entry["key"] == key:
+                    return entry
+
+            CACHE_REQUESTS.inc(cache="index", result="miss")
+            try:
+                with timed("index_load"):
+                    entry = _load_index_entry(subject, path == manifest_path, key)
+            except FileNotFoundError:
+                continue
+            entry["nbytes"] = _index_entry_nbytes(entry)
+
+            with _index_cache_lock:
+                _index_cache[subject] = entry
+                _index_cache.move_to_end(subject)
+                _evict_cold_indexes_locked(keep=subject)
+            log_event(logging.INFO, "index_loaded", subject=subject, chunks=len(entry["chunks"]),
+                      mb=round(entry["nbytes"] / 1e6, 1))
+            return entry
+
+    return None
+
+
+def _load_index_entry(subject, use_manifest, key):
+    manifest = _read_manifest(subject) if use_manifest else None
+    ann = None
+    if manifest:
+        chunks, matrix, rows, ann, lexical = _read_binary_index(
+            subject, manifest, lazy_rows=compressed_search_enabled())
+    else:
+        json_path = _json_index_path(subject)
+        chunks = _read_json_index(json_path) if os.path.exists(json_path) else []
+        matrix, rows = build_embedding_matrix(chunks)
+        for chunk in chunks:
+            chunk.pop("embedding", None)
+        lexical = merge_postings([(build_postings([c.get("text", "") for c in chunks]), range(len(chunks)))], len(chunks))
+
+    return {
+        "key": key,
+        # bumps on every upload/delete/compaction; keys the query caches
+        "version": manifest["generation"] if manifest else f"{key[1]}:{key[2]}:{key[3]}",
+        "chunks": chunks,
+        "matrix": matrix,
+        "rows": rows,
+        "ann": ann,
+        "lexical": lexical,
+        "search": build_search_matrix(matrix),
+        "chunk_ids": np.asarray([chunks[r].get("chunk_id", "") for r in rows], dtype=object),
+    }
+
+
+def invalidate_subject_index(subject):
+    """Drop a subject's cached index so the next read reloads it from disk."""
+    with _index_cache_lock:
+        _index_cache.pop(subject, None)
+    answer_cache.invalidate_subject(subject)
+    retrieval_cache.invalidate_subject(subject)
+    quiz_cache.invalidate_subject(subject)
+
+
+def load_subject_index(subject):
+    """Load all chunks for a subject (served from the cache)."""
+
+    entry = get_subject_index(subject)
+    if entry is None:
+        return []
+    return entry["chunks"]
+
+
 # =============================
 # SEMANTIC RETRIEVAL
 # =============================
-def retrieve_relevant_chunks(query, chunks, top_k=5):
-    """Score chunks by cosine similarity with query embedding, return top_k."""
+# vector: embeddings only · lexical: BM25 only, no embedding call ·
+# hybrid: reciprocal rank fusion of both
+RETRIEVAL_MODES = ("vector", "hybrid", "lexical")
+RRF_K = 60
+HYBRID_CANDIDATES = 50
+
+
+def rank_chunks(query, index, top_k, mode="vector", query_embedding=None):
+    """Return [(score, chunk), ...] best first for the given retrieval mode.
+
+    score is cosine similarity (vector), query-term coverage mapped onto the
+    cosine scale (lexical, see lexical_similarity), or the better of the two
+    (hybrid), so MIN_SCORE_THRESHOLD applies to all modes.
+    Pass query_embedding to reuse one embedding across several indexes.
+    """
 
-    print("🧠 semantic retrieval running")
+    if mode == "lexical":
+        chunks = index["chunks"]
+        with timed("scoring"):
+            return [(score, chunks[p]) for p, _, score in lexical_search(index["lexical"], query, top_k)]
 
-    query_embedding = get_embedding(query, task_type="retrieval_query")
+    if query_embedding is None:
+        with timed("query_embedding"):
+            query_embedding = get_embedding(query, task_type="retrieval_query")
+    if mode == "vector":
+        with timed("scoring"):
+            return score_query(query_embedding, index, top_k) if query_embedding else []
+
+    # hybrid
     if not query_embedding:
-        return []
+        log_event(logging.WARNING, "query_embedding_failed", fallback="lexical")
+    with timed("scoring"):
+        return _fuse_hybrid(query, index, query_embedding, top_k)
 
-    scored = []
-    for chunk in chunks:
-        chunk_embedding = chunk.get("embedding")
-        if not chunk_embedding:
-            continue
-        score = cosine_similarity(query_embedding, chunk_embedding)
-        scored.append((score, chunk))
 
-    scored.sort(key=lambda x: x[0], reverse=True)
+def _fuse_hybrid(query, index, query_embedding, top_k):
+    chunks = index["chunks"]
+    vector_hits = score_query(query_embedding, index, HYBRID_CANDIDATES) if query_embedding else []
+    lexical_hits = [(score, chunks[p]) for p, _, score in lexical_search(index["lexical"], query, HYBRID_CANDIDATES)]
+
+    fused = {}
+    for hits in (vector_hits, lexical_hits):
+        for rank, (score, chunk) in enumerate(hits):
+            entry = fused.setdefault(id(chunk), [0.0, 0.0, chunk])
+            entry[0] += 1.0 / (RRF_K + rank + 1)
+            entry[1] = max(entry[1], score)
+
+    ranked = sorted(fused.values(), key=lambda e: e[0], reverse=True)
+    return [(score, chunk) for _, score, chunk in ranked[:top_k]]
+
 
-    return [chunk for _, chunk in scored[:top_k]]
+def retrieve_relevant_chunks(query, index, top_k=5, mode="vector"):
+    """Score chunks against the query, return top_k."""
+
+    log_event(logging.DEBUG, "retrieval", mode=mode)
+
+    return [chunk for _, chunk in rank_chunks(query, index, top_k, mode)]
 
 
 # =============================
@@ -354,102 +2274,374 @@ def retrieve_relevant_chunks(query, chunks, top_k=5):
 # =============================
 @app.get("/")
 def home():
-    return {"status": "Backend is running 🚀"}
+    return {
+        "status": "Backend is running 🚀",
+        "providers": {
+            p.name: {"configured": p.configured, "initialized": p.initialized} for p in PROVIDERS
+        },
+    }
+
+
+@app.middleware("http")
+async def record_request_latency(request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    HTTP_REQUEST_SECONDS.observe(
+        time.perf_counter() - started,
+        method=request.method,
+        route=route.path if route is not None else "unmatched",
+        status=response.status_code,
+    )
+    return response
+
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus text exposition of stage latencies, caches and failures."""
+
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    cache = index_cache_stats()
+    lines += [
+        "# HELP askmynotes_index_cache_bytes Approximate RAM held by loaded subject indexes.",
+        "# TYPE askmynotes_index_cache_bytes gauge",
+        f"askmynotes_index_cache_bytes {cache['bytes']}",
+        "# HELP askmynotes_index_cache_subjects Subject indexes currently loaded.",
+        "# TYPE askmynotes_index_cache_subjects gauge",
+        f"askmynotes_index_cache_subjects {len(cache['subjects'])}",
+        "# HELP askmynotes_conversation_sessions Tutor conversations held in memory.",
+        "# TYPE askmynotes_conversation_sessions gauge",
+        f"askmynotes_conversation_sessions {len(conversation_memory)}",
+        "# HELP askmynotes_upload_inflight_bytes Upload bytes being stored or ingested (UPLOAD_INFLIGHT_MAX_MB budget).",
+        "# TYPE askmynotes_upload_inflight_bytes gauge",
+        f"askmynotes_upload_inflight_bytes {upload_budget.in_use}",
+    ]
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
 
 
 @app.get("/subjects")
 def subjects():
-    return {"subjects": ["subject1", "subject2", "subject3"]}
+    return {"subjects": list_subjects(), "index_cache": index_cache_stats()}
+
+
+@app.post("/subjects")
+def create_subject(name: Annotated[str, Form(...)]):
+    if not is_valid_subject(name):
+        return {"error": "Invalid subject name. Use letters, digits, '-' or '_' (max 64)."}
+    ensure_subject(name)
+    return {"message": f"Subject {name} ready", "subject": name}
 
 
 # =============================
 # UPLOAD ROUTE
 # =============================
-@app.post("/upload")
-async def upload_file(
-    subject: Annotated[str, Form(...)],
-    files: Annotated[list[UploadFile], File(description="Upload PDFs and images")],
-):
+def ingest_saved_file(subject, file_path, filename, progress=None, source=None):
+    """Extract, chunk, embed and index one stored upload (blocking).
 
-    if subject not in ["subject1", "subject2", "subject3"]:
-        return {"error": "Invalid subject"}
+    source ({"name", "sha256", "bytes"}) is registered in the index manifest
+    with the chunks, which is what later uploads are de-duplicated against.
 
-    subject_path = os.path.join(UPLOAD_DIR, subject)
+    Re-uploading a filename that is already indexed is incremental: scanned
+    pages whose fingerprint is in the previous per-source manifest reuse its
+    OCR text, chunks whose text did not change reuse their stored vectors, and
+    the old chunks are replaced atomically when the new segment is published.
+    """
 
-    results = []
+    progress = progress or (lambda **fields: None)
+    source = dict(source or {"name": filename, "sha256": None, "bytes": os.path.getsize(file_path)})
+    replaces = source_is_indexed(subject, filename)
+    previous = read_source_manifest(subject, filename)
+    previous_hashes = {p["hash"] for p in previous["pages"]} if previous else set()
+    pages = None
+
+    # =============================
+    # PDF
+    # =============================
+    if filename.lower().endswith(".pdf"):
+
+        progress(stage="extracting")
+        with timed("pdf_extract"):
+            pages = extract_pdf_pages(
+                file_path,
+                on_page=lambda done, total: progress(pages_done=done, pages_total=total),
+                known_ocr=previous.get("ocr") if previous else None,
+            )
+        extracted_preview = pages[0]["text"][:300] if pages else None
 
-    for file in files:
+    # =============================
+    # IMAGE
+    # =============================
+    elif filename.lower().endswith((".png", ".jpg", ".jpeg")):
 
-        file_path = os.path.join(subject_path, file.filename)
+        progress(stage="extracting", pages_total=1)
+        with timed("ocr"):
+            extracted_text = extract_text_with_gemini(file_path)
+        progress(pages_done=1)
 
-        # save file
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        text = clean_text(extracted_text)
+        # the whole image is one page; identical images are caught by upload de-duplication
+        pages = [{"page": 1, "text": text, "hash": page_fingerprint(text), "ocr": False}]
+        extracted_preview = extracted_text[:300]
 
-        extracted_preview = None
+    if pages is None:
+        return {"filename": filename, "preview": None, "failed_chunks": []}
 
-        # =============================
-        # PDF
-        # =============================
-        if file.filename.lower().endswith(".pdf"):
+    pages_reused = sum(1 for p in pages if p["hash"] in previous_hashes)
+    progress(stage="chunking", pages_reused=pages_reused, pages_reprocessed=len(pages) - pages_reused)
+    chunks = create_smart_chunks(
+        pages,
+        source_name=filename
+    )
+    chunks_reused = reuse_source_embeddings(subject, filename, chunks)
 
-            pages = extract_pdf_pages(file_path)
+    log_event(logging.INFO, "source_chunked", file=filename, pages=len(pages), pages_reused=pages_reused,
+              chunks=len(chunks), chunks_reused=chunks_reused, replaces=replaces)
 
-            chunks = create_smart_chunks(
-                pages,
-                source_name=file.filename
-            )
+    source["pages"] = [{"page": p["page"], "hash": p["hash"]} for p in pages]
+    source["ocr"] = {p["hash"]: p["text"] for p in pages if p.get("ocr")}
+    failed_chunks = save_chunks_to_index(subject, chunks, progress=progress, source=source)
 
-            print(f"\n===== PDF: {file.filename} =====")
-            print("Pages:", len(pages))
-            print("Chunks:", len(chunks))
+    return {
+        "filename": filename,
+        "preview": extracted_preview,
+        "failed_chunks": failed_chunks,
+        "replaced": replaces,
+        "pages_total": len(pages),
+        "pages_reused": pages_reused,
+        "pages_reprocessed": len(pages) - pages_reused,
+        "chunks_total": len(chunks),
+        "chunks_reused": chunks_reused,
+        "chunks_embedded": len(chunks) - chunks_reused,
+    }
 
-            save_chunks_to_index(subject, chunks)
 
-            extracted_preview = pages[0]["text"][:300] if pages else None
+# =============================
+# INGESTION JOBS
+# =============================
+# /upload stores the file and enqueues a job. Jobs for one subject run one at
+# a time (a single writer per subject); different subjects run in parallel on
+# the ingest pool. Content hashes of queued jobs are claimed up front so an
+# identical file uploaded again before the first copy is indexed is still
+# recognised as a duplicate.
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "4"))
+JOB_HISTORY = int(os.getenv("JOB_HISTORY", "1000"))
+
+_ingest_pool = concurrent.futures.ThreadPoolExecutor(
+    max_workers=INGEST_WORKERS, thread_name_prefix="ingest"
+)
+_jobs = OrderedDict()
+_subject_job_queues = {}
+_pending_hashes = {}  # (subject, sha256) -> filename of the queued/running job
+_jobs_lock = threading.Lock()
 
-        # =============================
-        # IMAGE
-        # =============================
-        elif file.filename.lower().endswith((".png", ".jpg", ".jpeg")):
 
-            extracted_text = extract_text_with_gemini(file_path)
+def _update_job(job_id, **fields):
+    with _jobs_lock:
+        job = _jobs[job_id]
+        job.update(fields)
+        job["updated_at"] = time.time()
+
 
-            pages = [{
-                "page": 1,
-                "text": clean_text(extracted_text)
-            }]
+def claim_upload(subject, sha256, filename):
+    """Reserve a content hash for a new job; returns the existing source name if it is a duplicate."""
 
-            chunks = create_smart_chunks(
-                pages,
-                source_name=file.filename
+    with _jobs_lock:
+        existing = _pending_hashes.get((subject, sha256)) or find_source_by_hash(subject, sha256)
+        if existing is None:
+            _pending_hashes[(subject, sha256)] = filename
+        return existing
+
+
+def release_upload_claim(subject, sha256):
+    with _jobs_lock:
+        _pending_hashes.pop((subject, sha256), None)
+
+
+def enqueue_ingest_job(subject, file_path, filename, source=None, on_finish=None, spool_path=None):
+    """Queue a stored upload for ingestion and return its job id.
+
+    With spool_path the upload is still in its spool file and is moved to
+    file_path only when the job starts. on_finish() runs once the job is done
+    or has failed.
+    """
+
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with _jobs_lock:
+        _jobs[job_id] = {
+            "id": job_id,
+            "subject": subject,
+            "filename": filename,
+            "status": "queued",
+            "stage": "queued",
+            "pages_done": 0,
+            "pages_total": None,
+            "pages_reused": None,
+            "pages_reprocessed": None,
+            "chunks_embedded": 0,
+            "chunks_total": None,
+            "errors": [],
+            "result": None,
+            "created_at": now,
+            "updated_at": now,
+        }
+        _prune_finished_jobs()
+
+        queue = _subject_job_queues.get(subject)
+        start_worker = queue is None
+        if start_worker:
+            queue = _subject_job_queues[subject] = deque()
+        queue.append((job_id, file_path, filename, source, on_finish, spool_path))
+
+    if start_worker:
+        _ingest_pool.submit(_drain_subject_jobs, subject)
+    return job_id
+
+
+def _drain_subject_jobs(subject):
+    """Run a subject's queued jobs in order until its queue is empty."""
+
+    while True:
+        with _jobs_lock:
+            queue = _subject_job_queues[subject]
+            if not queue:
+                del _subject_job_queues[subject]
+                return
+            job_id, file_path, filename, source, on_finish, spool_path = queue.popleft()
+
+        _update_job(job_id, status="running", stage="starting")
+        try:
+            if spool_path:
+                # not before now: an earlier job of this subject may still be reading file_path
+                os.replace(spool_path, file_path)
+            result = ingest_saved_file(
+                subject, file_path, filename,
+                progress=lambda **fields: _update_job(job_id, **fields),
+                source=source,
             )
+            errors = [f"{f['chunk_id']}: {f['error']}" for f in result["failed_chunks"]]
+            _update_job(job_id, status="done", stage="done", result=result, errors=errors)
+        except Exception as e:
+            log_event(logging.ERROR, "ingest_failed", subject=subject, file=filename, error=e)
+            _update_job(job_id, status="failed", stage="failed", errors=[str(e)])
+        finally:
+            if spool_path and os.path.exists(spool_path):
+                os.remove(spool_path)
+            if source:
+                release_upload_claim(subject, source["sha256"])
+            if on_finish:
+                on_finish()
+
+
+def _prune_finished_jobs():
+    # caller holds _jobs_lock
+    finished = [jid for jid, job in _jobs.items() if job["status"] in ("done", "failed")]
+    for jid in finished[: max(0, len(_jobs) - JOB_HISTORY)]:
+        del _jobs[jid]
+
+
+def get_job(job_id):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return dict(job, errors=list(job["errors"])) if job else None
+
+
+@app.post("/upload")
+async def upload_file(
+    subject: Annotated[str, Form(...)],
+    files: Annotated[list[UploadFile], File(description="Upload PDFs and images")],
+):
+
+    if not is_valid_subject(subject):
+        return {"error": "Invalid subject"}
+
+    sizes = [await run_blocking(upload_size, file) for file in files]
+    if sum(sizes) > UPLOAD_REQUEST_MAX_BYTES:
+        return {"error": f"Upload exceeds {UPLOAD_REQUEST_MAX_BYTES // (1024 * 1024)} MB per request"}
+
+    ensure_subject(subject)
+    subject_path = os.path.join(UPLOAD_DIR, subject)
 
-            print(f"\n===== IMAGE: {file.filename} =====")
-            print("Chunks:", len(chunks))
+    results = []
 
-            save_chunks_to_index(subject, chunks)
+    for file, size in zip(files, sizes):
+        filename = os.path.basename(file.filename or "")
+        if not filename:
+            results.append({"filename": file.filename, "status": "rejected", "error": "Missing filename"})
+            continue
+        if size > UPLOAD_MAX_BYTES:
+            results.append({"filename": filename, "status": "rejected",
+                            "error": f"File exceeds {UPLOAD_MAX_BYTES // (1024 * 1024)} MB"})
+            continue
 
-            extracted_preview = extracted_text[:300]
+        # backpressure: wait for in-flight uploads/ingests to free their bytes
+        if not await upload_budget.acquire(size, UPLOAD_BUDGET_WAIT):
+            results.append({"filename": filename, "status": "rejected", "error": "Server busy, try again later"})
+            continue
 
-        results.append({
-            "filename": file.filename,
-            "preview": extracted_preview
-        })
+        file_path = os.path.join(subject_path, filename)
+        # one spool file per upload; its job moves it to file_path when it runs
+        part_path = f"{file_path}.{uuid.uuid4().hex[:12]}.part"
+        claimed = queued = False
+        try:
+            # copy + hash in one pass, then hand extraction/embedding to the ingestion workers
+            sha256, size_written = await run_blocking(spool_upload, file.file, part_path)
+            duplicate_of = claim_upload(subject, sha256, filename)
+            if duplicate_of is not None:
+                log_event(logging.INFO, "upload_duplicate", subject=subject, file=filename, duplicate_of=duplicate_of)
+                results.append({"filename": filename, "status": "duplicate", "duplicate_of": duplicate_of})
+                continue
+            claimed = True
+
+            # read before queueing: a fast job may publish this very file first
+            replaces = await run_blocking(source_is_indexed, subject, filename)
+            job_id = enqueue_ingest_job(
+                subject, file_path, filename,
+                source={"name": filename, "sha256": sha256, "bytes": size_written},
+                on_finish=functools.partial(upload_budget.release, size),
+                spool_path=part_path,
+            )
+            queued = True
+            results.append({
+                "filename": filename,
+                "job_id": job_id,
+                "status": "queued",
+                # a new version of an indexed file: pages reused / reprocessed are reported on the job
+                "replaces": replaces,
+            })
+        except UploadTooLarge as e:
+            results.append({"filename": filename, "status": "rejected", "error": str(e)})
+        finally:
+            if not queued:
+                if claimed:
+                    release_upload_claim(subject, sha256)
+                upload_budget.release(size)
+                if os.path.exists(part_path):
+                    await run_blocking(os.remove, part_path)
 
     return {
-        "message": "Files uploaded successfully",
+        "message": "Files uploaded — processing in background",
         "total_files": len(results),
         "files": results
     }
 
 
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        return {"error": "Job not found"}
+    return job
+
+
 # =============================
 # FILE MANAGEMENT
 # =============================
 @app.get("/files/{subject}")
 def get_files(subject: str):
-    if subject not in ["subject1", "subject2", "subject3"]:
+    if not is_valid_subject(subject):
         return {"error": "Invalid subject"}
         
     subject_path = os.path.join(UPLOAD_DIR, subject)
@@ -459,7 +2651,7 @@ def get_files(subject: str):
     files = []
     for filename in os.listdir(subject_path):
         file_path = os.path.join(subject_path, filename)
-        if os.path.isfile(file_path):
+        if os.path.isfile(file_path) and not filename.endswith(".part"):
             size_kb = os.path.getsize(file_path) / 1024
             file_type = filename.split(".")[-1].upper() if "." in filename else "FILE"
             files.append({
@@ -472,7 +2664,7 @@ def get_files(subject: str):
 
 @app.delete("/files/{subject}/{filename}")
 def delete_file(subject: str, filename: str):
-    if subject not in ["subject1", "subject2", "subject3"]:
+    if not is_valid_subject(subject):
         return {"error": "Invalid subject"}
         
     subject_path = os.path.join(UPLOAD_DIR, subject)
@@ -482,23 +2674,23 @@ def delete_file(subject: str, filename: str):
         os.remove(file_path)
         
         # update index to remove chunks from this file
-        chunks = load_subject_index(subject)
-        if chunks:
-            filtered_chunks = [c for c in chunks if c.get("source") != filename]
-            if len(filtered_chunks) != len(chunks):
-                # Save the new filtered index back
-                index_path = os.path.join(INDEX_DIR, f"{subject}_index.json")
-                tmp_path = index_path + ".tmp"
-                with open(tmp_path, "w", encoding="utf-8") as f:
-                    json.dump(filtered_chunks, f, indent=2, ensure_ascii=False)
-                os.replace(tmp_path, index_path)
-                print(f"🗑️ Removed chunks for {filename} from {subject} index.")
+        if remove_source_from_index(subject, filename):
+            log_event(logging.INFO, "source_removed", subject=subject, file=filename)
         
         return {"message": f"Successfully deleted {filename}"}
     
     return {"error": "File not found"}
 
 
+@app.post("/index/{subject}/compact")
+def compact_index(subject: str):
+    if not is_valid_subject(subject):
+        return {"error": "Invalid subject"}
+
+    chunks = compact_subject_index(subject)
+    return {"message": f"Compacted {subject} index", "chunks": chunks}
+
+
 # =============================
 # ASK ROUTE (SEMANTIC RETRIEVAL)
 # =============================
@@ -506,17 +2698,20 @@ def delete_file(subject: str, filename: str):
 async def ask_question(
     subject: Annotated[str, Form(...)],
     question: Annotated[str, Form(...)],
+    mode: Annotated[str, Form()] = "vector",
 ):
 
-    if subject not in ["subject1", "subject2", "subject3"]:
+    if not is_valid_subject(subject):
         return {"error": "Invalid subject"}
+    if mode not in RETRIEVAL_MODES:
+        return {"error": f"Invalid mode. Use one of: {', '.join(RETRIEVAL_MODES)}"}
 
-    chunks = load_subject_index(subject)
+    index = await run_blocking(get_subject_index, subject)
 
-    if not chunks:
+    if not index or not index["chunks"]:
         return {"question": question, "results": [], "message": "No index found for this subject. Upload files first."}
 
-    relevant = retrieve_relevant_chunks(question, chunks)
+    relevant = await run_blocking(retrieve_relevant_chunks, question, index, mode=mode)
 
     return {
         "question": question,
@@ -530,6 +2725,125 @@ async def ask_question(
     }
 
 
+# =============================
+# CROSS-SUBJECT SEARCH
+# =============================
+def _rank_subject(subject, query, top_k, mode, query_embedding):
+    index = get_subject_index(subject)
+    if not index or not index["chunks"]:
+        return []
+    return [(score, subject, chunk) for score, chunk in rank_chunks(query, index, top_k, mode, query_embedding)]
+
+
+@app.post("/search")
+async def search_subjects(
+    question: Annotated[str, Form(...)],
+    subjects: Annotated[str, Form()] = "",
+    mode: Annotated[str, Form()] = "vector",
+    top_k: Annotated[int, Form()] = 5,
+):
+    """Fan a query out over several subjects' indexes in parallel and merge the top_k.
+
+    `subjects` is comma-separated; empty means every registered subject.
+    """
+
+    names = [s.strip() for s in subjects.split(",") if s.strip()] or list_subjects()
+    invalid = [s for s in names if not is_valid_subject(s)]
+    if invalid:
+        return {"error": f"Invalid subject(s): {', '.join(invalid)}"}
+    if mode not in RETRIEVAL_MODES:
+        return {"error": f"Invalid mode. Use one of: {', '.join(RETRIEVAL_MODES)}"}
+    top_k = max(1, min(top_k, 50))
+
+    # embed the query once and share it across every subject
+    query_embedding = None
+    if mode != "lexical":
+        query_embedding = await run_blocking(get_embedding, question, task_type="retrieval_query")
+        if query_embedding is None:
+            if mode == "vector":
+                return {"question": question, "results": [], "message": "Query embedding failed."}
+            mode = "lexical"
+
+    per_subject = await asyncio.gather(*(
+        run_blocking(_rank_subject, subject, question, top_k, mode, query_embedding)
+        for subject in names
+    ))
+    merged = sorted((hit for hits in per_subject for hit in hits), key=lambda h: h[0], reverse=True)[:top_k]
+
+    return {
+        "question": question,
+        "subjects": names,
+        "results": [
+            {
+                "subject": subject,
+                "score": round(score, 4),
+                "citation": chunk["citation"],
+                "text": chunk["text"]
+            }
+            for score, subject, chunk in merged
+        ]
+    }
+
+
+# =============================
+# QUERY RESULT CACHE
+# =============================
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1024"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+
+
+class TTLCache:
+    """Thread-safe LRU cache with per-entry expiry, keyed by (subject, ...) tuples."""
+
+    def __init__(self, max_entries, ttl, name="query"):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                CACHE_REQUESTS.inc(cache=self.name, result="miss")
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            CACHE_REQUESTS.inc(cache=self.name, result="hit")
+            return item[1]
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                CACHE_EVICTIONS.inc(cache=self.name)
+
+    def invalidate_subject(self, subject):
+        with self._lock:
+            for key in [k for k in self._data if k[0] == subject]:
+                del self._data[key]
+
+
+# full /ask_v2 responses
+answer_cache = TTLCache(ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL, name="answer")
+# retrieval results only — the teacher's answer depends on conversation memory
+retrieval_cache = TTLCache(ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL, name="retrieval")
+
+
+def normalize_question(question):
+    return re.sub(r"\s+", " ", question).strip().lower().rstrip("?!. ")
+
+
 # =============================
 # ASK V2 — LLM GROUNDED ANSWER
 # =============================
@@ -537,41 +2851,280 @@ async def ask_question(
 MIN_SCORE_THRESHOLD = 0.55
 
 
-def retrieve_relevant_chunks_with_scores(query, chunks, top_k=5):
-    """Score chunks by cosine similarity, return top_k that pass threshold."""
+def retrieve_relevant_chunks_with_scores(query, index, top_k=5, mode="vector"):
+    """Score chunks against the query, return top_k that pass threshold."""
 
-    print("🧠 ask_v2 retrieval running")
+    log_event(logging.DEBUG, "retrieval", mode=mode)
 
-    query_embedding = get_embedding(query, task_type="retrieval_query")
-    if not query_embedding:
-        return []
+    top = rank_chunks(query, index, max(top_k, 5), mode)
+
+    # Log top scores for debugging
+    log_event(logging.DEBUG, "retrieval_scores", top=[(round(s, 4), c["citation"][:40]) for s, c in top[:5]])
+
+    scored = [
+        {"score": score, "text": chunk["text"], "citation": chunk["citation"]}
+        for score, chunk in top[:top_k]
+        if score >= MIN_SCORE_THRESHOLD
+    ]
+    log_event(logging.INFO, "retrieval_done", mode=mode, candidates=len(top), passed=len(scored),
+              threshold=MIN_SCORE_THRESHOLD)
+
+    return scored
+
+
+# =============================
+# RERANKING (CPU, OPTIONAL)
+# =============================
+# The top RERANK_CANDIDATES retrieval hits are re-scored against the question
+# and the best ANSWER_CHUNKS go to the LLM. Every reranker returns scores in
+# 0..1; when even the best candidate is below the reranker's min_score, and
+# the best retrieval score is also below RERANK_EXIT_MAX_RETRIEVAL_SCORE, the
+# question is answered "not found" without calling the LLM at all. A strong
+# semantic match is always answered: a paraphrase shares no words with the
+# question, so a low reranker score alone proves nothing.
+#
+#   lexical        IDF-weighted query-term coverage + adjacent-term (phrase)
+#                  matches, using the subject's BM25 statistics. No model.
+#   cross-encoder  a sentence-transformers CrossEncoder on CPU (RERANK_MODEL);
+#                  falls back to lexical when the model cannot be loaded.
+#   none           retrieval order, no early exit (default).
+RERANKER = os.getenv("RERANKER", "none")
+RERANK_MODEL = os.getenv("RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "20"))
+RERANK_MIN_SCORE = os.getenv("RERANK_MIN_SCORE")  # overrides the backend default
+# the "Medium" confidence cutoff: retrieval at or above it is never skipped
+RERANK_EXIT_MAX_RETRIEVAL_SCORE = float(os.getenv("RERANK_EXIT_MAX_RETRIEVAL_SCORE", "0.60"))
+ANSWER_CHUNKS = 3
+RETRIEVAL_TOP_K = 5
+
+
+def lexical_rerank_scores(question, texts, index):
+    terms = list(dict.fromkeys(tokenize(question)))
+    if not terms:
+        return np.zeros(len(texts), dtype=np.float32)
+
+    lexical = index.get("lexical") if index else None
+    n = lexical["doc_len"].shape[0] if lexical else 0
+    idf = {}
+    for term in terms:
+        positions = lexical["terms"].get(term, (None, None))[0] if lexical else None
+        df = 0 if positions is None else positions.shape[0]
+        idf[term] = math.log(1 + (n - df + 0.5) / (df + 0.5)) if n else 1.0
+    total_idf = sum(idf.values())
+    pairs = list(zip(terms, terms[1:]))
+
+    scores = np.zeros(len(texts), dtype=np.float32)
+    for i, text in enumerate(texts):
+        tokens = tokenize(text)
+        present = set(tokens)
+        coverage = sum(idf[t] for t in terms if t in present) / total_idf
+        if pairs:
+            adjacent = set(zip(tokens, tokens[1:]))
+            scores[i] = 0.8 * coverage + 0.2 * sum(1 for pair in pairs if pair in adjacent) / len(pairs)
+        else:
+            scores[i] = coverage
+    return scores
+
+
+_cross_encoder = None
+_cross_encoder_lock = threading.Lock()
+
+
+def _load_cross_encoder():
+    global _cross_encoder
+    with _cross_encoder_lock:
+        if _cross_encoder is None:
+            from sentence_transformers import CrossEncoder
+
+            started = time.perf_counter()
+            _cross_encoder = CrossEncoder(RERANK_MODEL, device="cpu")
+            log_event(logging.INFO, "reranker_loaded", model=RERANK_MODEL,
+                      ms=round((time.perf_counter() - started) * 1000, 1))
+        return _cross_encoder
+
+
+def cross_encoder_scores(question, texts, index):
+    scores = np.asarray(_load_cross_encoder().predict([(question, text) for text in texts]), dtype=np.float32)
+    if scores.size and (scores.min() < 0 or scores.max() > 1):
+        scores = 1 / (1 + np.exp(-scores))  # raw logits from models without a sigmoid head
+    return scores
+
+
+RERANKERS = {
+    "lexical": {"score": lexical_rerank_scores, "min_score": 0.15},
+    "cross-encoder": {"score": cross_encoder_scores, "min_score": 0.02},
+}
+
+
+_reranker_fallback = None  # set once when the configured reranker fails to load
+
+
+def _active_reranker():
+    """(name, backend) of the reranker in use; backend is None for "none"."""
+    global _reranker_fallback
+    name = _reranker_fallback or RERANKER
+    if name == "cross-encoder":
+        try:
+            _load_cross_encoder()
+        except Exception as e:
+            with _cross_encoder_lock:
+                if _reranker_fallback is None:
+                    _reranker_fallback = "lexical"
+                    hint = {"hint": "pip install sentence-transformers"} if isinstance(e, ImportError) else {}
+                    log_event(logging.WARNING, "reranker_unavailable", reranker=name, fallback="lexical",
+                              error=str(e)[:200], **hint)
+            name = "lexical"
+    return name, RERANKERS.get(name)
+
+
+def rerank_chunks(question, candidates, index=None):
+    """Sort candidates by reranker score; empty if both rerank and retrieval are weak.
+
+    Returns (ranked, info) where info is {"reranker", "ms", "top_score",
+    "candidates"} for the response. Without a reranker the candidates come
+    back in retrieval order.
+    """
+
+    name, backend = _active_reranker()
+    if backend is None or not candidates:
+        return candidates, {"reranker": "none", "ms": 0.0, "top_score": None, "candidates": len(candidates)}
+
+    started = time.perf_counter()
+    with timed("rerank"):
+        scores = backend["score"](question, [c["text"] for c in candidates], index)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+
+    min_score = float(RERANK_MIN_SCORE) if RERANK_MIN_SCORE else backend["min_score"]
+    ranked = sorted(
+        (dict(c, rerank_score=float(score)) for c, score in zip(candidates, scores)),
+        key=lambda c: c["rerank_score"], reverse=True,
+    )
+    weak_retrieval = max(c["score"] for c in candidates) < RERANK_EXIT_MAX_RETRIEVAL_SCORE
+    passing = [] if ranked[0]["rerank_score"] < min_score and weak_retrieval else ranked
+    info = {
+        "reranker": name,
+        "ms": round(elapsed_ms, 2),
+        "top_score": round(ranked[0]["rerank_score"], 4),
+        "candidates": len(candidates),
+    }
+    log_event(logging.INFO, "rerank_done", early_exit=not passing, min_score=min_score, **info)
+    return passing, info
+
+
+def select_answer_chunks(question, index, mode="vector"):
+    """Retrieve, rerank and return (answer_chunks, rerank_info); empty chunks mean "not found"."""
+
+    top_k = RERANK_CANDIDATES if RERANKER != "none" else RETRIEVAL_TOP_K
+    candidates = retrieve_relevant_chunks_with_scores(question, index, top_k=top_k, mode=mode)
+    passing, info = rerank_chunks(question, candidates, index)
+    return passing[:ANSWER_CHUNKS], info
 
-    all_scores = []
-    scored = []
-    for chunk in chunks:
-        chunk_embedding = chunk.get("embedding")
-        if not chunk_embedding:
-            continue
-        score = cosine_similarity(query_embedding, chunk_embedding)
-        all_scores.append((round(score, 4), chunk["citation"][:40]))
-        if score >= MIN_SCORE_THRESHOLD:
-            scored.append({"score": score, "text": chunk["text"], "citation": chunk["citation"]})
 
-    # Log all scores for debugging
-    all_scores.sort(key=lambda x: x[0], reverse=True)
-    print(f"📊 All scores (top 5): {all_scores[:5]}")
-    print(f"✅ Passed threshold ({MIN_SCORE_THRESHOLD}): {len(scored)} chunks")
+# =============================
+# CONTEXT PACKING (TOKEN BUDGET)
+# =============================
+# Context is packed best-chunk-first into a token budget. Sentences already
+# packed from an earlier chunk (chunk overlap) are dropped, and a chunk that
+# does not fit whole is trimmed to its sentences most relevant to the query.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+QUIZ_CONTEXT_TOKEN_BUDGET = int(os.getenv("QUIZ_CONTEXT_TOKEN_BUDGET", "4000"))
+MIN_TRIMMED_TOKENS = 40
+
+
+def estimate_tokens(text):
+    """Local token estimate (~4 characters per token, Llama/GPT-style BPE)."""
+    return (len(text) + 3) // 4
+
+
+def _select_sentences(sentences, query_terms, budget):
+    """Pick the most query-relevant sentences fitting the budget, in reading order."""
+
+    def relevance(item):
+        pos, sentence = item
+        terms = set(tokenize(sentence))
+        return (-len(terms & query_terms), pos)
+
+    picked = []
+    for pos, sentence in sorted(enumerate(sentences), key=relevance):
+        cost = estimate_tokens(sentence) + 1
+        if cost <= budget:
+            picked.append(pos)
+            budget -= cost
+    return [sentences[pos] for pos in sorted(picked)]
 
-    scored.sort(key=lambda x: x["score"], reverse=True)
-    return scored[:top_k]
 
+def pack_context(chunks, query="", token_budget=None, share_budget=False):
+    """Pack chunks into a SOURCE/TEXT context string within token_budget.
 
-def build_context_from_chunks(chunks):
-    """Build a single context string from the top 3 chunks."""
+    Chunks are packed highest "rerank_score" first when reranked, else
+    highest "score" first. With share_budget=True every chunk gets an equal
+    share of what is left instead (budget unused by short chunks passes to
+    the rest), so no chunk is skipped because earlier ones filled the budget.
+    Returns (context, stats) where stats has packed/trimmed/skipped counts
+    and tokens.
+    """
+
+    budget = CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    # the reranker's order also picks the fallback answer; packing must agree with it
+    key = "rerank_score" if any("rerank_score" in chunk for chunk in chunks) else "score"
+    if any(key in chunk for chunk in chunks):
+        chunks = sorted(chunks, key=lambda c: c.get(key, 0.0), reverse=True)
+
+    query_terms = set(tokenize(query))
+    seen = set()
     parts = []
-    for chunk in chunks[:3]:
-        parts.append(f"SOURCE: {chunk['citation']}\nTEXT: {chunk['text']}")
-    return "\n\n".join(parts)
+    stats = {"packed": 0, "trimmed": 0, "skipped": 0, "deduped_sentences": 0}
+
+    for i, chunk in enumerate(chunks):
+        header = f"SOURCE: {chunk['citation']}\nTEXT: "
+        limit = budget // (len(chunks) - i) if share_budget else budget
+        room = limit - estimate_tokens(header) - 1
+        if room < MIN_TRIMMED_TOKENS:
+            stats["skipped"] += 1
+            continue
+
+        sentences = []
+        keys = set()
+        for sentence in split_into_sentences(chunk["text"]):
+            key = " ".join(sentence.lower().split())
+            if not key:
+                continue
+            if key in seen or key in keys:
+                stats["deduped_sentences"] += 1
+                continue
+            keys.add(key)
+            sentences.append(sentence)
+        if not sentences:
+            stats["skipped"] += 1
+            continue
+
+        text = " ".join(sentences)
+        if estimate_tokens(text) > room:
+            sentences = _select_sentences(sentences, query_terms, room)
+            if not sentences:
+                stats["skipped"] += 1
+                continue
+            text = " ".join(sentences)
+            keys = {" ".join(sentence.lower().split()) for sentence in sentences}
+            stats["trimmed"] += 1
+
+        seen.update(keys)
+        part = header + text
+        parts.append(part)
+        budget -= estimate_tokens(part) + 1
+        stats["packed"] += 1
+
+    context = "\n\n".join(parts)
+    stats["tokens"] = estimate_tokens(context)
+    return context, stats
+
+
+def build_context_from_chunks(chunks, query="", token_budget=None, share_budget=False):
+    """Build a single context string from the best chunks within the token budget."""
+    with timed("context_build"):
+        context, stats = pack_context(chunks, query, token_budget, share_budget)
+    log_event(logging.DEBUG, "context_packed", **stats)
+    return context
 
 
 def get_confidence_label(score):
@@ -583,12 +3136,7 @@ def get_confidence_label(score):
     return "Low"
 
 
-def generate_grounded_answer(question, context, fallback_text=""):
-    """Use Groq (Llama 3.3 70B) to generate a grounded answer from context."""
-
-    print("🤖 Groq LLM generating answer")
-
-    system_prompt = """You are AskMyNotes.
+GROUNDED_SYSTEM_PROMPT = """You are AskMyNotes.
 
 Answer ONLY using the provided context.
 Do NOT invent information.
@@ -598,47 +3146,96 @@ If the answer is not found in the context, return EXACTLY:
 
 Return concise educational answers."""
 
+
+def build_grounded_prompt(question, context):
+    """Return (system_prompt, user_prompt) for a grounded answer."""
+
     user_prompt = f"""CONTEXT:
 {context}
 
 QUESTION:
 {question}"""
 
+    return GROUNDED_SYSTEM_PROMPT, user_prompt
+
+
+def generate_grounded_answer(question, context, fallback_text=""):
+    """Use Groq (Llama 3.3 70B) to generate a grounded answer from context.
+
+    Returns (answer, prompt, ok); ok is False when a fallback answer was used.
+    """
+
+    system_prompt, user_prompt = build_grounded_prompt(question, context)
     full_prompt = f"SYSTEM:\n{system_prompt}\n\nUSER:\n{user_prompt}"
 
+    log_event(logging.INFO, "llm_request", route="ask_v2", prompt_tokens=estimate_tokens(full_prompt))
+
     try:
-        response = groq_client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.3,
-            max_tokens=512
-        )
+        with timed("llm"):
+            response = groq_client.chat.completions.create(
+                model="llama-3.3-70b-versatile",
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}
+                ],
+                temperature=0.3,
+                max_tokens=512
+            )
         answer = response.choices[0].message.content.strip()
-        print(f"✅ Groq answered")
-        return answer, full_prompt
+        return answer, full_prompt, True
     except Exception as e:
-        print(f"⚠️ Groq LLM failed: {e}")
+        LLM_FAILURES.inc(route="ask_v2")
+        log_event(logging.WARNING, "llm_failed", route="ask_v2", error=e)
         if fallback_text:
-            print("🔄 Using best chunk as fallback answer")
-            return fallback_text, full_prompt
-        return "Could not generate answer. Please try again.", full_prompt
+            log_event(logging.INFO, "llm_fallback", route="ask_v2")
+            return fallback_text, full_prompt, False
+        return "Could not generate answer. Please try again.", full_prompt, False
+
+
+def stream_groq_tokens(system_prompt, user_prompt, temperature, max_tokens):
+    """Yield answer tokens from a streaming Groq completion (blocking iterator)."""
+
+    stream = groq_client.chat.completions.create(
+        model="llama-3.3-70b-versatile",
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        temperature=temperature,
+        max_tokens=max_tokens,
+        stream=True
+    )
+    for chunk in stream:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            yield delta
+
+
+def build_evidence(chunks):
+    return [
+        {
+            "citation": chunk["citation"],
+            "snippet": chunk["text"][:200]
+        }
+        for chunk in chunks
+    ]
 
 
 @app.post("/ask_v2")
 async def ask_v2(
     subject: Annotated[str, Form(...)],
     question: Annotated[str, Form(...)],
+    mode: Annotated[str, Form()] = "vector",
 ):
 
-    if subject not in ["subject1", "subject2", "subject3"]:
+    if not is_valid_subject(subject):
         return {"error": "Invalid subject"}
+    if mode not in RETRIEVAL_MODES:
+        return {"error": f"Invalid mode. Use one of: {', '.join(RETRIEVAL_MODES)}"}
 
-    chunks = load_subject_index(subject)
+    index = await run_blocking(get_subject_index, subject)
 
-    if not chunks:
+    if not index or not index["chunks"]:
         return {
             "answer": f"Not found in your notes for {subject}.",
             "confidence": "Low",
@@ -646,68 +3243,337 @@ async def ask_v2(
             "message": "No index found for this subject. Upload files first."
         }
 
-    scored_chunks = retrieve_relevant_chunks_with_scores(question, chunks)
+    cache_key = (subject, normalize_question(question), index["version"], mode)
+    cached = answer_cache.get(cache_key)
+    if cached is not None:
+        log_event(logging.DEBUG, "cache_hit", cache="answer", subject=subject)
+        return {**cached, "cached": True}
 
-    if not scored_chunks:
-        return {
+    strong_chunks, rerank = await run_blocking(select_answer_chunks, question, index, mode=mode)
+
+    if not strong_chunks:
+        # nothing relevant enough: answer without spending an LLM call
+        if rerank["candidates"]:
+            LLM_SKIPPED.inc(route="ask_v2")
+        result = {
             "answer": f"Not found in your notes for {subject}.",
             "confidence": "Low",
-            "evidence": []
+            "evidence": [],
+            "rerank": rerank,
         }
+        # only a reranker verdict is worth pinning: no candidates at all may
+        # just be a failed query embedding
+        if rerank["candidates"]:
+            answer_cache.put(cache_key, result)
+        return {**result, "cached": False}
 
-    best_score = scored_chunks[0]["score"]
-    strong_chunks = scored_chunks[:3]
+    best_score = max(c["score"] for c in strong_chunks)
 
-    context = build_context_from_chunks(strong_chunks)
+    context = build_context_from_chunks(strong_chunks, question)
     fallback = strong_chunks[0]["text"][:500]
-    answer, prompt = generate_grounded_answer(question, context, fallback_text=fallback)
+    answer, prompt, llm_ok = await run_blocking(generate_grounded_answer, question, context, fallback_text=fallback)
     confidence = get_confidence_label(best_score)
 
-    print(f"📈 Best score: {best_score:.4f} → {confidence} confidence")
+    log_event(logging.INFO, "ask_v2_answered", subject=subject, mode=mode, best_score=round(best_score, 4),
+              confidence=confidence, rerank_ms=rerank["ms"])
 
-    evidence = [
-        {
-            "citation": chunk["citation"],
-            "snippet": chunk["text"][:200]
-        }
-        for chunk in strong_chunks
-    ]
+    evidence = build_evidence(strong_chunks)
 
-    return {
+    result = {
         "answer": answer,
         "confidence": confidence,
         "evidence": evidence,
-        "prompt": prompt
+        "prompt": prompt,
+        "prompt_tokens": estimate_tokens(prompt),
+        "rerank": rerank,
     }
+    # don't pin a fallback answer in the cache — Groq may be back next time
+    if llm_ok:
+        answer_cache.put(cache_key, result)
+
+    return {**result, "cached": False}
 
 
 # =============================
-# GLOBAL MEMORY
+# STREAMING (SERVER-SENT EVENTS)
 # =============================
-conversation_memory = deque(maxlen=20)
+# Stream endpoints emit: one "evidence" event, then "token" events as the LLM
+# produces them, and a final "confidence" event. Clients can start rendering
+# (or text-to-speech) on the first token instead of waiting for the full answer.
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
 
-def add_to_memory(role, content):
-    conversation_memory.append({
-        "role": role,
-        "content": content
-    })
 
-def get_memory_context():
-    context = ""
-    for msg in conversation_memory:
-        context += f"{msg['role'].upper()}: {msg['content']}\n"
-    return context
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def iterate_blocking(iterator):
+    """Drive a blocking iterator from async code, one item per pool hop."""
+    done = object()
+    while True:
+        item = await run_blocking(next, iterator, done)
+        if item is done:
+            return
+        yield item
+
+
+async def stream_answer_tokens(tokens, parts, fallback_text, route):
+    """Relay LLM tokens as SSE events, collecting them into `parts`.
+
+    If the LLM fails before producing anything the fallback text is sent
+    instead. A trailing None in `parts` marks an answer that should not be cached.
+    """
+    started = time.perf_counter()
+    try:
+        async for token in iterate_blocking(tokens):
+            if not parts:
+                STAGE_SECONDS.observe(time.perf_counter() - started, stage="llm_first_token")
+            parts.append(token)
+            yield sse_event("token", {"text": token})
+    except Exception as e:
+        LLM_FAILURES.inc(route=route)
+        log_event(logging.WARNING, "llm_failed", route=route, error=e)
+        if not parts and fallback_text:
+            log_event(logging.INFO, "llm_fallback", route=route)
+            parts.append(fallback_text)
+            yield sse_event("token", {"text": fallback_text})
+        parts.append(None)
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage="llm")
+
+
+def _not_found_events(subject, **extra):
+    yield sse_event("evidence", {"evidence": []})
+    yield sse_event("token", {"text": f"Not found in your notes for {subject}."})
+    yield sse_event("confidence", {"confidence": "Low", "score": None, "cached": False, **extra})
+
+
+@app.post("/ask_v2/stream")
+async def ask_v2_stream(
+    subject: Annotated[str, Form(...)],
+    question: Annotated[str, Form(...)],
+    mode: Annotated[str, Form()] = "vector",
+):
+
+    if not is_valid_subject(subject):
+        return {"error": "Invalid subject"}
+    if mode not in RETRIEVAL_MODES:
+        return {"error": f"Invalid mode. Use one of: {', '.join(RETRIEVAL_MODES)}"}
+
+    async def events():
+        index = await run_blocking(get_subject_index, subject)
+        if not index or not index["chunks"]:
+            for event in _not_found_events(subject, message="No index found for this subject. Upload files first."):
+                yield event
+            return
+
+        cache_key = (subject, normalize_question(question), index["version"], mode)
+        cached = answer_cache.get(cache_key)
+        if cached is not None:
+            log_event(logging.DEBUG, "cache_hit", cache="answer", subject=subject)
+            yield sse_event("evidence", {"evidence": cached["evidence"], "rerank": cached.get("rerank")})
+            yield sse_event("token", {"text": cached["answer"]})
+            yield sse_event("confidence", {
+                "confidence": cached["confidence"], "score": cached.get("score"), "cached": True,
+                "prompt_tokens": cached.get("prompt_tokens"),
+            })
+            return
+
+        strong_chunks, rerank = await run_blocking(select_answer_chunks, question, index, mode=mode)
+        if not strong_chunks:
+            if rerank["candidates"]:
+                LLM_SKIPPED.inc(route="ask_v2_stream")
+            for event in _not_found_events(subject, rerank=rerank):
+                yield event
+            return
+
+        best_score = max(c["score"] for c in strong_chunks)
+        evidence = build_evidence(strong_chunks)
+        yield sse_event("evidence", {"evidence": evidence, "rerank": rerank})
+
+        context = build_context_from_chunks(strong_chunks, question)
+        system_prompt, user_prompt = build_grounded_prompt(question, context)
+        full_prompt = f"SYSTEM:\n{system_prompt}\n\nUSER:\n{user_prompt}"
+        prompt_tokens = estimate_tokens(full_prompt)
+        log_event(logging.INFO, "llm_request", route="ask_v2_stream", prompt_tokens=prompt_tokens)
+
+        parts = []
+        tokens = stream_groq_tokens(system_prompt, user_prompt, temperature=0.3, max_tokens=512)
+        async for event in stream_answer_tokens(tokens, parts, strong_chunks[0]["text"][:500], "ask_v2_stream"):
+            yield event
+
+        confidence = get_confidence_label(best_score)
+        if None not in parts:
+            answer_cache.put(cache_key, {
+                "answer": "".join(parts).strip(),
+                "confidence": confidence,
+                "evidence": evidence,
+                "prompt": full_prompt,
+                "prompt_tokens": prompt_tokens,
+                "score": best_score,
+                "rerank": rerank,
+            })
+        yield sse_event("confidence", {
+            "confidence": confidence, "score": best_score, "cached": False, "prompt_tokens": prompt_tokens,
+        })
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+# =============================
+# CONVERSATION MEMORY (PER SESSION + SUBJECT)
+# =============================
+# Each (session_id, subject) pair has its own bounded turn history, so
+# concurrent students never see each other's conversation. Sessions idle for
+# MEMORY_IDLE_TTL seconds are dropped, and at most MEMORY_MAX_SESSIONS are kept
+# in RAM (least recently used first out). Set MEMORY_PERSIST_PATH to a SQLite
+# file to keep histories across restarts.
+MEMORY_MAX_TURNS = int(os.getenv("MEMORY_MAX_TURNS", "20"))
+MEMORY_MAX_SESSIONS = int(os.getenv("MEMORY_MAX_SESSIONS", "1000"))
+MEMORY_IDLE_TTL = float(os.getenv("MEMORY_IDLE_TTL", "3600"))
+MEMORY_HISTORY_TOKENS = int(os.getenv("MEMORY_HISTORY_TOKENS", "1200"))
+MEMORY_PERSIST_PATH = os.getenv("MEMORY_PERSIST_PATH", "")
+DEFAULT_SESSION_ID = "default"
+
+
+class ConversationStore:
+    """Thread-safe per-(session, subject) turn histories with LRU + idle eviction."""
+
+    def __init__(self, max_sessions, max_turns, idle_ttl, persist_path=""):
+        self.max_sessions = max_sessions
+        self.max_turns = max_turns
+        self.idle_ttl = idle_ttl
+        self.persist_path = persist_path
+        self._sessions = OrderedDict()  # least recently used first
+        self._lock = threading.Lock()
+        self._conn = None
+        self._last_purge = 0.0
+
+    def _db(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.persist_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.persist_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                " session_id TEXT NOT NULL, subject TEXT NOT NULL, turns TEXT NOT NULL,"
+                " last_seen REAL NOT NULL, PRIMARY KEY (session_id, subject))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS conversations_last_seen ON conversations(last_seen)")
+            self._conn = conn
+        return self._conn
+
+    def _turn(self, role, content):
+        line = f"{role.upper()}: {content}\n"
+        return {"role": role, "content": content, "line": line, "tokens": estimate_tokens(line)}
+
+    def _evict_locked(self, now):
+        while self._sessions:
+            key, session = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_sessions and now - session["last_seen"] <= self.idle_ttl:
+                break
+            del self._sessions[key]
+        if self.persist_path and now - self._last_purge > 60:
+            self._last_purge = now
+            conn = self._db()
+            conn.execute("DELETE FROM conversations WHERE last_seen < ?", (now - self.idle_ttl,))
+            conn.commit()
+
+    def _session_locked(self, key, now):
+        session = self._sessions.get(key)
+        if session is not None and now - session["last_seen"] > self.idle_ttl:
+            del self._sessions[key]
+            session = None
+        if session is None and self.persist_path:
+            row = self._db().execute(
+                "SELECT turns, last_seen FROM conversations WHERE session_id = ? AND subject = ?", key
+            ).fetchone()
+            if row and now - row[1] <= self.idle_ttl:
+                session = {"turns": deque(maxlen=self.max_turns), "last_user": "", "last_seen": now}
+                for turn in json.loads(row[0]):
+                    session["turns"].append(self._turn(turn["role"], turn["content"]))
+                    if turn["role"] == "user":
+                        session["last_user"] = turn["content"]
+        if session is None:
+            session = {"turns": deque(maxlen=self.max_turns), "last_user": "", "last_seen": now}
+        session["last_seen"] = now
+        self._sessions[key] = session
+        self._sessions.move_to_end(key)
+        return session
+
+    def add(self, session_id, subject, role, content):
+        now = time.time()
+        key = (session_id, subject)
+        with self._lock:
+            session = self._session_locked(key, now)
+            session["turns"].append(self._turn(role, content))
+            if role == "user":
+                session["last_user"] = content
+            if self.persist_path:
+                turns = [{"role": t["role"], "content": t["content"]} for t in session["turns"]]
+                conn = self._db()
+                conn.execute(
+                    "INSERT OR REPLACE INTO conversations (session_id, subject, turns, last_seen) VALUES (?, ?, ?, ?)",
+                    (session_id, subject, json.dumps(turns, ensure_ascii=False), now),
+                )
+                conn.commit()
+            self._evict_locked(now)
+
+    def history(self, session_id, subject, token_budget=None):
+        """Most recent turns, oldest first, that fit within token_budget."""
+        budget = MEMORY_HISTORY_TOKENS if token_budget is None else token_budget
+        with self._lock:
+            session = self._session_locked((session_id, subject), time.time())
+            lines = []
+            for turn in reversed(session["turns"]):
+                if turn["tokens"] > budget:
+                    break
+                budget -= turn["tokens"]
+                lines.append(turn["line"])
+        return "".join(reversed(lines))
+
+    def last_user_message(self, session_id, subject):
+        with self._lock:
+            return self._session_locked((session_id, subject), time.time())["last_user"]
+
+    def clear(self, session_id):
+        with self._lock:
+            for key in [k for k in self._sessions if k[0] == session_id]:
+                del self._sessions[key]
+            if self.persist_path:
+                conn = self._db()
+                conn.execute("DELETE FROM conversations WHERE session_id = ?", (session_id,))
+                conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+
+conversation_memory = ConversationStore(MEMORY_MAX_SESSIONS, MEMORY_MAX_TURNS, MEMORY_IDLE_TTL, MEMORY_PERSIST_PATH)
+
+
+def add_to_memory(session_id, subject, role, content):
+    conversation_memory.add(session_id, subject, role, content)
+
+
+def get_memory_context(session_id, subject):
+    return conversation_memory.history(session_id, subject)
+
+
+@app.delete("/sessions/{session_id}")
+async def clear_session(session_id: str):
+    await run_blocking(conversation_memory.clear, session_id)
+    return {"message": f"Cleared conversation memory for {session_id}"}
 
 
 # =============================
 # AI TEACHER ROUTE
 # =============================
-def generate_teacher_answer(question, context, fallback_text=""):
-    """Use Groq (Llama 3.3 70B) to generate a conversational teacher answer with a follow up question."""
+def build_teacher_prompt(question, context, session_id=DEFAULT_SESSION_ID, subject=""):
+    """Return (system_prompt, user_prompt) for the conversational teacher."""
 
-    print("🤖 Groq LLM generating teacher answer")
-    
-    memory_context = get_memory_context()
+    memory_context = get_memory_context(session_id, subject)
 
     system_prompt = f"""You are a grounded study assistant.
 Use previous conversation context if needed.
@@ -731,113 +3597,171 @@ CURRENT QUESTION:
 {question}
 """
 
+    return system_prompt, user_prompt
+
+
+TEACHER_UNAVAILABLE = "I'm having trouble connecting to my knowledge base. Can you try asking that again?"
+
+
+def generate_teacher_answer(question, context, fallback_text="", session_id=DEFAULT_SESSION_ID, subject=""):
+    """Use Groq (Llama 3.3 70B) to generate a conversational teacher answer with a follow up question.
+
+    Returns (answer, prompt_tokens).
+    """
+
+    system_prompt, user_prompt = build_teacher_prompt(question, context, session_id, subject)
+    prompt_tokens = estimate_tokens(system_prompt) + estimate_tokens(user_prompt)
+
+    log_event(logging.INFO, "llm_request", route="teacher_ask", prompt_tokens=prompt_tokens)
+
     try:
-        response = groq_client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.5,
-            max_tokens=600
-        )
+        with timed("llm"):
+            response = groq_client.chat.completions.create(
+                model="llama-3.3-70b-versatile",
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}
+                ],
+                temperature=0.5,
+                max_tokens=600
+            )
         answer = response.choices[0].message.content.strip()
-        print(f"✅ Groq answered as Teacher")
-        return answer
+        return answer, prompt_tokens
     except Exception as e:
-        print(f"⚠️ Groq LLM failed: {e}")
+        LLM_FAILURES.inc(route="teacher_ask")
+        log_event(logging.WARNING, "llm_failed", route="teacher_ask", error=e)
         if fallback_text:
-            return fallback_text
-        return "I'm having trouble connecting to my knowledge base. Can you try asking that again?"
-
-
-@app.post("/teacher_ask")
-async def teacher_ask(
-    subject: Annotated[str, Form(...)],
-    question: Annotated[str, Form(...)],
-):
-    
-    if subject not in ["subject1", "subject2", "subject3"]:
-        return {"reply": "Invalid subject provided."}
+            return fallback_text, prompt_tokens
+        return TEACHER_UNAVAILABLE, prompt_tokens
 
-    chunks = load_subject_index(subject)
 
-    if not chunks:
-        return {"reply": f"Not found in your notes for {subject}. Please upload some files first!"}
+async def retrieve_teacher_context(subject, question, index, session_id=DEFAULT_SESSION_ID):
+    """Retrieve grounding for a tutor question; returns (scored_chunks, context, fallback)."""
 
     # If the user asks a short follow-up question like "simplify it" or "give an example",
     # the vector search alone will fail to find context. We prepend the recent history 
     # topic to the semantic search query.
     search_query = question
-    if len(question.split()) < 8 and len(conversation_memory) > 0:
-        # Find the last user message from deque memory
-        last_user_msg = next((msg['content'] for msg in reversed(list(conversation_memory)) if msg['role'] == 'user'), "")
+    if len(question.split()) < 8:
+        last_user_msg = await run_blocking(conversation_memory.last_user_message, session_id, subject)
         if last_user_msg:
             search_query = f"{last_user_msg} {question}"
 
-    scored_chunks = retrieve_relevant_chunks_with_scores(search_query, chunks, top_k=3)
+    cache_key = (subject, normalize_question(search_query), index["version"])
+    scored_chunks = retrieval_cache.get(cache_key)
+    if scored_chunks is None:
+        scored_chunks = await run_blocking(retrieve_relevant_chunks_with_scores, search_query, index, top_k=3)
+        # an empty result may just be a failed query embedding — don't cache it
+        if scored_chunks:
+            retrieval_cache.put(cache_key, scored_chunks)
+    else:
+        log_event(logging.DEBUG, "cache_hit", cache="retrieval", subject=subject)
 
     context = ""
     fallback = ""
     if scored_chunks:
         strong_chunks = scored_chunks[:3]
-        context = build_context_from_chunks(strong_chunks)
+        context = build_context_from_chunks(strong_chunks, search_query)
         fallback = "Here's what I found: " + strong_chunks[0]["text"][:200] + "... What part of that is most interesting to you?"
 
+    return scored_chunks, context, fallback
+
+
+@app.post("/teacher_ask")
+async def teacher_ask(
+    subject: Annotated[str, Form(...)],
+    question: Annotated[str, Form(...)],
+    session_id: Annotated[str, Form()] = DEFAULT_SESSION_ID,
+):
+    
+    if not is_valid_subject(subject):
+        return {"reply": "Invalid subject provided."}
+
+    index = await run_blocking(get_subject_index, subject)
+
+    if not index or not index["chunks"]:
+        return {"reply": f"Not found in your notes for {subject}. Please upload some files first!"}
+
+    scored_chunks, context, fallback = await retrieve_teacher_context(subject, question, index, session_id)
+
     # Update memory before generating an answer
-    add_to_memory("user", question)
+    await run_blocking(add_to_memory, session_id, subject, "user", question)
     
-    answer = generate_teacher_answer(question, context, fallback_text=fallback)
+    answer, prompt_tokens = await run_blocking(
+        generate_teacher_answer, question, context,
+        fallback_text=fallback, session_id=session_id, subject=subject,
+    )
     
     # Store LLM response in memory
-    add_to_memory("assistant", answer)
-
-    evidence = [
-        {
-            "citation": chunk["citation"],
-            "snippet": chunk["text"][:200]
-        }
-        for chunk in scored_chunks
-    ] if scored_chunks else []
+    await run_blocking(add_to_memory, session_id, subject, "assistant", answer)
 
     return {
         "reply": answer,
-        "evidence": evidence
+        "evidence": build_evidence(scored_chunks) if scored_chunks else [],
+        "prompt_tokens": prompt_tokens
     }
 
 
-# =============================
-# QUIZ GENERATION ROUTE
-# =============================
-@app.post("/generate_quiz")
-async def generate_quiz(
+@app.post("/teacher_ask/stream")
+async def teacher_ask_stream(
     subject: Annotated[str, Form(...)],
+    question: Annotated[str, Form(...)],
+    session_id: Annotated[str, Form()] = DEFAULT_SESSION_ID,
 ):
-    """Generates MCQs and Short Answers based on the uploaded notes."""
-    
-    if subject not in ["subject1", "subject2", "subject3"]:
-        return {"error": "Invalid subject provided."}
 
-    chunks = load_subject_index(subject)
+    if not is_valid_subject(subject):
+        return {"reply": "Invalid subject provided."}
+
+    async def events():
+        index = await run_blocking(get_subject_index, subject)
+        if not index or not index["chunks"]:
+            yield sse_event("evidence", {"evidence": []})
+            yield sse_event("token", {"text": f"Not found in your notes for {subject}. Please upload some files first!"})
+            yield sse_event("confidence", {"confidence": "Low", "score": None})
+            return
 
-    if not chunks:
-        # Return empty generic structure if no notes exist
-        return {
-            "mcqs": [],
-            "short": []
-        }
-        
-    # We take up to the first 15 chunks (roughly 15,000 chars) to give the LLM broad context
-    # for generating a diverse quiz.
-    sample_chunks = chunks[:15]
-    context = build_context_from_chunks(sample_chunks)
+        scored_chunks, context, fallback = await retrieve_teacher_context(subject, question, index, session_id)
+        yield sse_event("evidence", {"evidence": build_evidence(scored_chunks) if scored_chunks else []})
 
-    print(f"🧠 Generating quiz for {subject} with {len(sample_chunks)} chunks of context")
+        await run_blocking(add_to_memory, session_id, subject, "user", question)
+        system_prompt, user_prompt = await run_blocking(build_teacher_prompt, question, context, session_id, subject)
+        prompt_tokens = estimate_tokens(system_prompt) + estimate_tokens(user_prompt)
+        log_event(logging.INFO, "llm_request", route="teacher_ask_stream", prompt_tokens=prompt_tokens)
 
-    system_prompt = """You are an expert educator. Your task is to generate a structured quiz based strictly on the provided CONTEXT.
+        parts = []
+        tokens = stream_groq_tokens(system_prompt, user_prompt, temperature=0.5, max_tokens=600)
+        async for event in stream_answer_tokens(tokens, parts, fallback or TEACHER_UNAVAILABLE, "teacher_ask_stream"):
+            yield event
 
-    Format your output ONLY as a valid JSON object with the following structure:
-    {
+        answer = "".join(p for p in parts if p).strip()
+        await run_blocking(add_to_memory, session_id, subject, "assistant", answer)
+
+        best_score = scored_chunks[0]["score"] if scored_chunks else None
+        confidence = get_confidence_label(best_score) if best_score is not None else "Low"
+        yield sse_event("confidence", {"confidence": confidence, "score": best_score, "prompt_tokens": prompt_tokens})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+# =============================
+# QUIZ GENERATION ROUTE
+# =============================
+QUIZ_SAMPLE_CHUNKS = int(os.getenv("QUIZ_SAMPLE_CHUNKS", "15"))
+QUIZ_POOL_SIZE = int(os.getenv("QUIZ_POOL_SIZE", "8"))
+QUIZ_MAX_RETRIES = int(os.getenv("QUIZ_MAX_RETRIES", "2"))
+QUIZ_CACHE_MAX_ENTRIES = int(os.getenv("QUIZ_CACHE_MAX_ENTRIES", "256"))
+QUIZ_CACHE_TTL = float(os.getenv("QUIZ_CACHE_TTL", "86400"))
+
+# generated quizzes keyed (subject, index version, seed): a class shares a pool
+# of QUIZ_POOL_SIZE quizzes per index version instead of generating on every click
+quiz_cache = TTLCache(QUIZ_CACHE_MAX_ENTRIES, QUIZ_CACHE_TTL, name="quiz")
+
+QUIZ_SECTIONS = {
+    "mcqs": {
+        "count": 5,
+        "max_tokens": 1200,
+        "label": "multiple-choice questions",
+        "format": """{
       "mcqs": [
         {
           "q": "Question text here?",
@@ -846,7 +3770,14 @@ async def generate_quiz(
           "explanation": "Why this is the correct answer.",
           "citation": "Source file name or general topic from context"
         }
-      ],
+      ]
+    }""",
+    },
+    "short": {
+        "count": 3,
+        "max_tokens": 900,
+        "label": "short answer questions",
+        "format": """{
       "short": [
         {
           "q": "Short answer question text?",
@@ -854,35 +3785,205 @@ async def generate_quiz(
           "citation": "Source file name or general topic from context"
         }
       ]
-    }
+    }""",
+    },
+}
+
+
+def sample_quiz_chunks(index, count, seed):
+    """Pick up to `count` diverse chunks: the chunk nearest each k-means centroid.
+
+    Clustering reuses the ANN k-means on the subject's embeddings, so the quiz
+    covers every file and topic instead of the first pages of the first file.
+    Different seeds give different clusterings, hence different quizzes.
+    """
+
+    chunks = index["chunks"]
+    matrix = index["matrix"]
+    rows = index["rows"]
+    n = matrix.shape[0]
+
+    if len(chunks) <= count:
+        return list(chunks)
+    if n <= count:
+        rng = np.random.default_rng(seed)
+        return [chunks[pos] for pos in sorted(rng.choice(len(chunks), count, replace=False))]
+
+    centroids = train_ivf(matrix, nlist=count, seed=seed)
+    k = centroids.shape[0]
+    best = np.full(k, -np.inf, dtype=np.float32)
+    best_row = np.zeros(k, dtype=np.int64)
+    for start in range(0, n, _ASSIGN_BLOCK):
+        block = np.asarray(matrix[start:start + _ASSIGN_BLOCK], dtype=np.float32)
+        sims = block @ centroids.T
+        arg = np.argmax(sims, axis=0)
+        val = sims[arg, np.arange(k)]
+        better = val > best
+        best[better] = val[better]
+        best_row[better] = arg[better] + start
+
+    picked = dict.fromkeys(int(rows[r]) for r in best_row)
+    return [chunks[pos] for pos in picked]
+
+
+def _quiz_item_errors(section, item):
+    if not isinstance(item, dict):
+        return ["must be an object"]
+    problems = []
+    for field in ("q", "answer" if section == "short" else "explanation", "citation"):
+        if not isinstance(item.get(field), str) or not item[field].strip():
+            problems.append(f'"{field}" must be a non-empty string')
+    if section == "mcqs":
+        options = item.get("options")
+        if not isinstance(options, list) or len(options) != 4 or not all(isinstance(o, str) and o.strip() for o in options):
+            problems.append('"options" must be a list of 4 non-empty strings')
+        answer = item.get("answer")
+        if not isinstance(answer, int) or isinstance(answer, bool) or not 0 <= answer <= 3:
+            problems.append('"answer" must be an integer index 0-3')
+    return problems
+
+
+def validate_quiz_section(section, data):
+    """Return (valid_items, errors) for one parsed quiz section."""
+
+    count = QUIZ_SECTIONS[section]["count"]
+    if not isinstance(data, dict) or not isinstance(data.get(section), list):
+        return [], [f'the top-level object must contain a "{section}" list']
+
+    items = []
+    errors = []
+    for i, item in enumerate(data[section]):
+        problems = _quiz_item_errors(section, item)
+        if problems:
+            errors.append(f"{section}[{i}]: " + "; ".join(problems))
+        else:
+            items.append(item)
+    if len(items) < count:
+        errors.append(f"expected {count} valid {section} items, got {len(items)}")
+    return items[:count], errors
+
+
+def generate_quiz_section(section, context):
+    """Generate one quiz section with Groq, re-asking with the validation errors.
+
+    Returns (items, prompt_tokens, errors); errors is empty on success.
+    """
+
+    spec = QUIZ_SECTIONS[section]
+    system_prompt = f"""You are an expert educator. Your task is to generate {spec["label"]} based strictly on the provided CONTEXT.
+
+    Format your output ONLY as a valid JSON object with the following structure:
+    {spec["format"]}
 
     REQUIREMENTS:
-    1. Generate EXACTLY 5 MCQs and 3 Short Answer questions.
-    2. Base all questions ONLY on the provided CONTEXT.
+    1. Generate EXACTLY {spec["count"]} {spec["label"]}.
+    2. Base all questions ONLY on the provided CONTEXT, and spread them across its sources.
     3. Output nothing but the valid JSON object. No markdown formatting, no intro text.
     """
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": f"CONTEXT:\n{context}\n\nGenerate the JSON now."}
+    ]
+    prompt_tokens = 0
+    items, errors = [], ["no response"]
 
-    user_prompt = f"CONTEXT:\n{context}\n\nGenerate the JSON quiz now."
+    for attempt in range(QUIZ_MAX_RETRIES + 1):
+        prompt_tokens += sum(estimate_tokens(m["content"]) for m in messages)
+        try:
+            with timed("llm"):
+                response = groq_client.chat.completions.create(
+                    model="llama-3.3-70b-versatile",
+                    messages=messages,
+                    temperature=0.3, # lower temperature for more deterministic JSON
+                    # Setting response_format to ensure valid JSON output from Groq
+                    response_format={"type": "json_object"},
+                    max_tokens=spec["max_tokens"]
+                )
+            raw = response.choices[0].message.content.strip()
+        except Exception as e:
+            LLM_FAILURES.inc(route="generate_quiz")
+            log_event(logging.WARNING, "llm_failed", route="generate_quiz", section=section, attempt=attempt + 1, error=e)
+            errors = [str(e)]
+            continue
 
-    try:
-        response = groq_client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.3, # lower temperature for more deterministic JSON
-            # Setting response_format to ensure valid JSON output from Groq
-            response_format={"type": "json_object"},
-            max_tokens=2000
-        )
-        
-        quiz_json_str = response.choices[0].message.content.strip()
-        import json
-        quiz_data = json.loads(quiz_json_str)
-        print("✅ Quiz generated successfully")
-        return quiz_data
-        
-    except Exception as e:
-        print(f"⚠️ Quiz generation failed: {e}")
-        return {"error": "Failed to generate quiz. Please try again."}
\ No newline at end of file
+        try:
+            data = json.loads(raw)
+        except ValueError as e:
+            data = None
+            errors = [f"the output is not valid JSON ({e})"]
+        else:
+            items, errors = validate_quiz_section(section, data)
+
+        if not errors:
+            return items, prompt_tokens, []
+
+        log_event(logging.WARNING, "quiz_invalid", section=section, attempt=attempt + 1, errors=errors[:3])
+        # targeted retry: show the model its own output and exactly what to fix
+        messages = messages[:2] + [
+            {"role": "assistant", "content": raw},
+            {"role": "user", "content": "Your JSON has these problems:\n- " + "\n- ".join(errors[:10])
+                + "\nReturn the corrected JSON object only."}
+        ]
+
+    return items, prompt_tokens, errors
+
+
+@app.post("/generate_quiz")
+async def generate_quiz(
+    subject: Annotated[str, Form(...)],
+    seed: Annotated[int | None, Form(ge=0)] = None,
+):
+    """Generates MCQs and Short Answers based on the uploaded notes.
+
+    Without a seed, one of QUIZ_POOL_SIZE cached quizzes is served at random.
+    """
+    
+    if not is_valid_subject(subject):
+        return {"error": "Invalid subject provided."}
+
+    index = await run_blocking(get_subject_index, subject)
+
+    if not index or not index["chunks"]:
+        # Return empty generic structure if no notes exist
+        return {
+            "mcqs": [],
+            "short": []
+        }
+
+    if seed is None:
+        seed = random.randrange(QUIZ_POOL_SIZE)
+
+    cache_key = (subject, index["version"], seed)
+    cached = quiz_cache.get(cache_key)
+    if cached is not None:
+        log_event(logging.DEBUG, "cache_hit", cache="quiz", subject=subject, seed=seed)
+        return {**cached, "cached": True}
+
+    sample_chunks = await run_blocking(sample_quiz_chunks, index, QUIZ_SAMPLE_CHUNKS, seed)
+    # one share of the budget per sampled cluster, so every topic reaches the prompt
+    context = build_context_from_chunks(sample_chunks, token_budget=QUIZ_CONTEXT_TOKEN_BUDGET, share_budget=True)
+
+    log_event(logging.INFO, "quiz_generating", subject=subject, seed=seed, chunks=len(sample_chunks))
+
+    # both sections are generated concurrently
+    (mcqs, mcq_tokens, mcq_errors), (short, short_tokens, short_errors) = await asyncio.gather(
+        run_blocking(generate_quiz_section, "mcqs", context),
+        run_blocking(generate_quiz_section, "short", context),
+    )
+
+    if not mcqs and not short:
+        log_event(logging.ERROR, "quiz_failed", subject=subject, errors=mcq_errors + short_errors)
+        return {"error": "Failed to generate quiz. Please try again."}
+
+    result = {
+        "mcqs": mcqs,
+        "short": short,
+        "seed": seed,
+        "prompt_tokens": mcq_tokens + short_tokens
+    }
+    # only complete quizzes join the shared pool
+    if not mcq_errors and not short_errors:
+        quiz_cache.put(cache_key, result)
+        log_event(logging.INFO, "quiz_generated", subject=subject, seed=seed)
+
+    return {**result, "cached": False}
@@ -0,0 +1,11 @@
+"""One-shot migration of legacy index/*_index.json files to the v2 binary format.
+
+Usage (from backend/):
+    python migrate_index.py
+"""
+from main import migrate_json_indexes
+
+
+if __name__ == "__main__":
+    migrated = migrate_json_indexes()
+    print(f"Done. Migrated {len(migrated)} subject index(es): {', '.join(migrated) or 'none'}")
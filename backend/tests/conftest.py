@@ -0,0 +1,71 @@
+"""Shared fixtures: main.py rooted in a scratch directory with local stub providers.
+
+The stubs are the ones the benchmarks use (benchmarks/common.install_stubs):
+hashed bag-of-words embeddings and a Groq fake that streams its answer word
+by word, so no test needs network access or API keys.
+"""
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from common import install_stubs, load_app  # noqa: E402
+
+STUB_ANSWER = "Mitochondria make ATP for the cell."
+
+
+@pytest.fixture
+def main(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    module = load_app(str(tmp_path))
+    install_stubs(module, dim=64, answer=STUB_ANSWER)
+    # stub embeddings are not calibrated like Gemini's; always answer
+    monkeypatch.setattr(module, "MIN_SCORE_THRESHOLD", -1.0)
+    module._index_cache.clear()
+    module.answer_cache._data.clear()
+    module.retrieval_cache._data.clear()
+    return module
+
+
+def add_notes(main, subject, texts, source="notes.pdf"):
+    main.ensure_subject(subject)
+    chunks = [{"chunk_id": f"{source}_{i}", "page": i + 1, "source": source, "text": text}
+              for i, text in enumerate(texts)]
+    return main.save_chunks_to_index(subject, chunks)
+
+
+def post(main, path, data):
+    import httpx
+
+    async def send():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post(path, data=data)
+
+    return asyncio.run(send())
+
+
+def post_files(main, subject, files):
+    """POST /upload with {filename: bytes}."""
+    import httpx
+
+    async def send():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post("/upload", data={"subject": subject},
+                                     files=[("files", (name, body)) for name, body in files.items()])
+
+    return asyncio.run(send())
+
+
+def sse_events(body):
+    """Parse a text/event-stream body into [(event, data), ...]."""
+    events = []
+    for block in body.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
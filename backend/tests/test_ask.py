@@ -0,0 +1,105 @@
+"""/ask_v2: grounded answers and what gets cached."""
+from conftest import STUB_ANSWER, add_notes, post
+
+NOTES = ["Mitochondria produce ATP through oxidative phosphorylation in the cell."]
+QUESTION = {"subject": "bio", "question": "How do mitochondria produce ATP?"}
+
+
+def test_not_found_after_failed_query_embedding_is_not_cached(main, monkeypatch):
+    add_notes(main, "bio", NOTES)
+    working = main.embed_batch_fn
+
+    def down(texts, task_type="retrieval_document"):
+        raise TimeoutError("deadline exceeded")
+
+    monkeypatch.setattr(main, "EMBED_MAX_RETRIES", 0)
+    monkeypatch.setattr(main, "embed_batch_fn", down)
+    first = post(main, "/ask_v2", QUESTION).json()
+    monkeypatch.setattr(main, "embed_batch_fn", working)
+    second = post(main, "/ask_v2", QUESTION).json()
+
+    assert first["answer"].startswith("Not found")
+    assert second["answer"] == STUB_ANSWER
+    assert second["cached"] is False
+
+
+def test_rerank_early_exit_is_cached(main, monkeypatch):
+    add_notes(main, "bio", NOTES)
+    monkeypatch.setattr(main, "RERANKER", "lexical")
+    monkeypatch.setattr(main, "RERANK_EXIT_MAX_RETRIEVAL_SCORE", 2.0)  # let the lexical verdict decide
+    question = {"subject": "bio", "question": "Who won the treaty war?"}
+
+    first = post(main, "/ask_v2", question).json()
+    second = post(main, "/ask_v2", question).json()
+
+    assert first["answer"].startswith("Not found") and first["rerank"]["candidates"]
+    assert second["cached"] is True
+
+
+def groq_down(main, monkeypatch):
+    def create(**kwargs):
+        raise ConnectionError("groq unavailable")
+
+    monkeypatch.setattr(main.groq_client.chat.completions, "create", create)
+
+
+def test_repeated_question_is_answered_from_the_cache(main, monkeypatch):
+    add_notes(main, "bio", NOTES)
+    first = post(main, "/ask_v2", QUESTION).json()
+    groq_down(main, monkeypatch)  # a hit must not reach the LLM
+    second = post(main, "/ask_v2", {**QUESTION, "question": "  how do MITOCHONDRIA produce ATP? "}).json()
+
+    assert first["cached"] is False
+    assert second["cached"] is True and second["answer"] == STUB_ANSWER
+
+
+def test_upload_and_delete_invalidate_cached_answers(main, tmp_path):
+    add_notes(main, "bio", NOTES)
+    post(main, "/ask_v2", QUESTION)
+    assert post(main, "/ask_v2", QUESTION).json()["cached"] is True
+
+    add_notes(main, "bio", ["Chloroplasts run photosynthesis."], source="plants.pdf")
+    assert not main.answer_cache._data
+    assert post(main, "/ask_v2", QUESTION).json()["cached"] is False
+
+    main.ensure_subject("bio")
+    open(tmp_path / "uploads" / "bio" / "plants.pdf", "wb").close()
+    assert "message" in main.delete_file("bio", "plants.pdf")
+    assert not main.answer_cache._data
+    assert post(main, "/ask_v2", QUESTION).json()["cached"] is False
+
+
+def test_teacher_route_caches_retrieval_but_not_the_answer(main, monkeypatch):
+    add_notes(main, "bio", NOTES)
+    retrieve, llm_calls, retrievals = main.retrieve_relevant_chunks_with_scores, [], []
+    create = main.groq_client.chat.completions.create
+
+    def counting_retrieve(*args, **kwargs):
+        retrievals.append(args[0])
+        return retrieve(*args, **kwargs)
+
+    def counting_create(**kwargs):
+        llm_calls.append(kwargs)
+        return create(**kwargs)
+
+    monkeypatch.setattr(main, "retrieve_relevant_chunks_with_scores", counting_retrieve)
+    monkeypatch.setattr(main.groq_client.chat.completions, "create", counting_create)
+    question = {"subject": "bio", "question": "Can you explain how the mitochondria produce ATP for cells?"}
+    for session in ("alice", "bob"):
+        assert post(main, "/teacher_ask", {**question, "session_id": session}).json()["reply"] == STUB_ANSWER
+
+    assert len(retrievals) == 1
+    assert len(llm_calls) == 2
+    assert not main.answer_cache._data
+
+
+def test_fallback_answer_is_not_cached(main, monkeypatch):
+    add_notes(main, "bio", NOTES)
+    working = main.groq_client.chat.completions.create
+    groq_down(main, monkeypatch)
+    first = post(main, "/ask_v2", QUESTION).json()
+    monkeypatch.setattr(main.groq_client.chat.completions, "create", working)
+    second = post(main, "/ask_v2", QUESTION).json()
+
+    assert first["answer"] != STUB_ANSWER and first["cached"] is False
+    assert second["answer"] == STUB_ANSWER and second["cached"] is False
@@ -0,0 +1,24 @@
+"""Parallel /ask_v2 requests must not serialize on the event loop."""
+import asyncio
+
+from bench_concurrency import install_bench_stubs, run
+
+LLM_DELAY = 0.3
+REQUESTS = 10
+
+
+def test_parallel_requests_take_about_one_request(main, monkeypatch):
+    # install_bench_stubs switches caches and reranking off; undo that after the test
+    for name in ("ANSWER_CACHE_MAX_ENTRIES", "EMBED_CACHE_MAX_ENTRIES", "RERANKER"):
+        monkeypatch.setattr(main, name, getattr(main, name))
+    monkeypatch.setattr(main.answer_cache, "max_entries", main.answer_cache.max_entries)
+    install_bench_stubs(main, embed_delay=0.02, llm_delay=LLM_DELAY)
+    main.save_chunks_to_index("subject1", [
+        {"chunk_id": f"c{i}", "page": i + 1, "source": "notes.pdf", "text": f"synthetic chunk {i}"}
+        for i in range(20)
+    ])
+
+    single, parallel = asyncio.run(run(main, REQUESTS))
+
+    assert single >= LLM_DELAY  # the warm-up request really waited on the LLM
+    assert parallel < 2 * single, f"{REQUESTS} parallel took {parallel:.2f}s vs {single:.2f}s for one"
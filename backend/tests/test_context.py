@@ -0,0 +1,26 @@
+"""Token-budgeted context packing."""
+
+
+def chunk(name, score, rerank_score=None, sentences=30):
+    text = " ".join(f"{name} fact {i}." for i in range(sentences))
+    c = {"citation": f"{name}.pdf | page 1", "text": text, "score": score}
+    if rerank_score is not None:
+        c["rerank_score"] = rerank_score
+    return c
+
+
+def test_packs_by_retrieval_score_without_reranker(main):
+    context, stats = main.pack_context([chunk("low", 0.5), chunk("high", 0.9)], token_budget=10_000)
+
+    assert context.index("high.pdf") < context.index("low.pdf")
+    assert stats["packed"] == 2
+
+
+def test_reranked_order_decides_what_fits_a_tight_budget(main):
+    chunks = [chunk("retrieval_best", 0.9, rerank_score=0.1), chunk("rerank_best", 0.7, rerank_score=0.8)]
+
+    context, stats = main.pack_context(chunks, token_budget=170)
+
+    assert context.startswith("SOURCE: rerank_best.pdf")
+    assert "retrieval_best" not in context
+    assert stats["packed"] == 1
@@ -0,0 +1,122 @@
+"""Batched embedding: retries, batch splitting and per-chunk failure reporting."""
+import pytest
+from google.api_core import exceptions as google_errors
+
+from conftest import add_notes
+
+
+class FakeEmbedder:
+    """embed_batch_fn stand-in that fails according to a rule and records every call."""
+
+    def __init__(self, fail=None):
+        self.fail = fail or (lambda texts, call: None)
+        self.calls = []
+
+    def __call__(self, texts, task_type="retrieval_document"):
+        self.calls.append(list(texts))
+        error = self.fail(texts, len(self.calls))
+        if error:
+            raise error
+        return [[1.0, float(len(text)), 0.5] for text in texts]
+
+
+@pytest.fixture
+def embedder(main, monkeypatch):
+    monkeypatch.setattr(main, "EMBED_BACKOFF_BASE", 0.0)
+    monkeypatch.setattr(main, "EMBED_MAX_RETRIES", 3)
+    monkeypatch.setattr(main, "EMBED_CACHE_MAX_ENTRIES", 0)
+
+    def install(fail=None):
+        fake = FakeEmbedder(fail)
+        monkeypatch.setattr(main, "embed_batch_fn", fake)
+        return fake
+
+    return install
+
+
+def test_transient_errors_are_retried(main, embedder):
+    fake = embedder(lambda texts, call: TimeoutError("deadline exceeded") if call <= 2 else None)
+
+    vectors, failures = main.embed_texts(["alpha", "beta"])
+
+    assert failures == []
+    assert all(vectors)
+    assert len(fake.calls) == 3
+    assert fake.calls[0] == fake.calls[-1] == ["alpha", "beta"]
+
+
+def test_rate_limited_batch_fails_whole_without_splitting(main, embedder):
+    fake = embedder(lambda texts, call: google_errors.ResourceExhausted("quota exceeded"))
+    texts = [f"text {i}" for i in range(8)]
+
+    vectors, failures = main.embed_texts(texts, batch_size=8)
+
+    assert vectors == [None] * 8
+    assert [f["index"] for f in failures] == list(range(8))
+    # one batch, retried: never resent text by text
+    assert len(fake.calls) == 1 + main.EMBED_MAX_RETRIES
+    assert all(len(call) == 8 for call in fake.calls)
+
+
+def test_per_input_error_splits_batch_and_isolates_bad_text(main, embedder):
+    def fail(texts, call):
+        if "bad" in texts:
+            return google_errors.InvalidArgument("text too long")
+
+    fake = embedder(fail)
+
+    vectors, failures = main.embed_texts(["good one", "bad", "good two"], batch_size=3)
+
+    assert vectors[0] and vectors[2] and vectors[1] is None
+    assert failures == [{"index": 1, "error": "400 text too long"}]
+    # the batch once (client errors are not retried), then each text alone
+    assert fake.calls == [["good one", "bad", "good two"], ["good one"], ["bad"], ["good two"]]
+
+
+def test_failed_chunks_are_reported_and_still_stored(main, embedder):
+    embedder(lambda texts, call: google_errors.InvalidArgument("bad") if "broken" in " ".join(texts) else None)
+
+    failed = add_notes(main, "bio", ["cells divide", "broken chunk", "enzymes catalyse"])
+
+    assert failed == [{"chunk_id": "notes.pdf_1", "error": "400 bad"}]
+    index = main.get_subject_index("bio")
+    assert len(index["chunks"]) == 3
+    assert index["matrix"].shape[0] == 2
+
+
+@pytest.mark.parametrize("error", [
+    google_errors.InvalidArgument("API key not valid. Please pass a valid API key."),
+    google_errors.PermissionDenied("caller does not have permission"),
+    google_errors.Unauthenticated("missing credentials"),
+], ids=["bad-key", "forbidden", "unauthenticated"])
+def test_credential_errors_fail_each_batch_once(main, embedder, error):
+    fake = embedder(lambda texts, call: error)
+    texts = [f"text {i}" for i in range(64)]
+
+    vectors, failures = main.embed_texts(texts, batch_size=32)
+
+    assert vectors == [None] * 64 and len(failures) == 64
+    assert len(fake.calls) == 2  # one request per batch: no retries, no splitting
+
+
+def test_unconfigured_provider_fails_batch_without_splitting(main, embedder):
+    fake = embedder(lambda texts, call: main.ProviderNotConfigured("GEMINI_API_KEY is not set"))
+
+    vectors, failures = main.embed_texts(["a", "b", "c"], batch_size=3)
+
+    assert len(failures) == 3 and len(fake.calls) == 1
+
+
+def test_isolation_stops_when_the_provider_starts_failing(main, embedder):
+    def fail(texts, call):
+        if call == 1:
+            return google_errors.InvalidArgument("one bad text")
+        return google_errors.ServiceUnavailable("backend down")
+
+    fake = embedder(fail)
+
+    vectors, failures = main.embed_texts(["a", "b", "c", "d"], batch_size=4)
+
+    assert vectors == [None] * 4 and len(failures) == 4
+    # the batch once, then the first single text with its retries: never b, c, d
+    assert fake.calls[1:] == [["a"]] * (1 + main.EMBED_MAX_RETRIES)
@@ -0,0 +1,54 @@
+"""PDF extraction with scanned (image-only) pages going through OCR."""
+import random
+import threading
+import time
+
+from bench_suite import write_synthetic_pdf
+
+
+def make_pdf(tmp_path, pages=12, scanned_every=3):
+    path = str(tmp_path / "scan.pdf")
+    write_synthetic_pdf(path, pages, random.Random(0), scanned_every=scanned_every)
+    return path
+
+
+def test_scanned_pages_are_ocred_and_fingerprinted(main, tmp_path, monkeypatch):
+    path = make_pdf(tmp_path)
+    live, peak, lock = [0], [0], threading.Lock()
+
+    def fake_ocr(png_bytes, mime_type="image/png"):
+        assert png_bytes.startswith(b"\x89PNG")
+        with lock:
+            live[0] += 1
+            peak[0] = max(peak[0], live[0])
+        time.sleep(0.01)
+        with lock:
+            live[0] -= 1
+        return "recognised text"
+
+    monkeypatch.setattr(main, "extract_text_from_image_bytes", fake_ocr)
+    progress = []
+
+    pages = main.extract_pdf_pages(path, on_page=lambda done, total: progress.append((done, total)), parallel=False)
+
+    assert [p["page"] for p in pages] == list(range(1, 13))
+    assert [p["ocr"] for p in pages] == [(n + 1) % 3 == 0 for n in range(12)]
+    assert all(p["text"] == "recognised text" for p in pages if p["ocr"])
+    assert all(p["hash"] for p in pages)
+    assert progress[-1] == (12, 12)
+    assert peak[0] <= main.OCR_WORKERS
+
+
+def test_known_ocr_pages_skip_the_ocr_call(main, tmp_path, monkeypatch):
+    path = make_pdf(tmp_path)
+    first = main.extract_pdf_pages(path, parallel=False)
+    known = {p["hash"]: "remembered" for p in first if p["ocr"]}
+
+    def no_ocr(png_bytes, mime_type="image/png"):
+        raise AssertionError("known page sent to OCR")
+
+    monkeypatch.setattr(main, "extract_text_from_image_bytes", no_ocr)
+    again = main.extract_pdf_pages(path, parallel=False, known_ocr=known)
+
+    assert [p["hash"] for p in again] == [p["hash"] for p in first]
+    assert all(p["text"] == "remembered" for p in again if p["ocr"])
@@ -0,0 +1,26 @@
+"""In-memory subject index cache."""
+import os
+import shutil
+
+from conftest import add_notes
+
+
+def test_cached_index_is_reused(main):
+    add_notes(main, "bio", ["Mitochondria produce ATP."])
+
+    assert main.get_subject_index("bio") is main.get_subject_index("bio")
+
+
+def test_republished_manifest_reloads_even_with_same_mtime_and_size(main):
+    add_notes(main, "bio", ["Mitochondria produce ATP."])
+    before = main.get_subject_index("bio")
+    path = main._manifest_path("bio")
+    stat = os.stat(path)
+
+    # a second publish landing in the same mtime tick with the same size
+    shutil.copyfile(path, path + ".tmp")
+    os.replace(path + ".tmp", path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert os.stat(path).st_size == stat.st_size
+
+    assert main.get_subject_index("bio") is not before
@@ -0,0 +1,65 @@
+"""BM25 lexical and hybrid retrieval."""
+from conftest import add_notes
+
+BIOLOGY = [
+    "Glycolysis splits glucose into two pyruvate molecules in the cytoplasm.",
+    "Explain the process of osmosis: water crosses a membrane toward higher solute concentration.",
+    "The Krebs cycle runs in the mitochondrial matrix and releases carbon dioxide.",
+]
+HISTORY = ["The treaty of Westphalia ended the thirty years war in 1648."]
+
+
+def test_unknown_query_terms_do_not_sink_a_lexical_match(main, monkeypatch):
+    monkeypatch.setattr(main, "MIN_SCORE_THRESHOLD", 0.55)
+    add_notes(main, "bio", BIOLOGY)
+
+    hits = main.retrieve_relevant_chunks_with_scores("How does glycolysis work", main.get_subject_index("bio"),
+                                                     top_k=3, mode="lexical")
+
+    assert hits and "Glycolysis" in hits[0]["text"]
+    assert hits[0]["score"] >= main.MIN_SCORE_THRESHOLD
+
+
+def test_lexical_match_alone_never_claims_high_confidence(main):
+    add_notes(main, "bio", BIOLOGY)
+
+    top = main.rank_chunks("explain the process", main.get_subject_index("bio"), 3, "lexical")
+
+    assert "osmosis" in top[0][1]["text"]
+    assert main.get_confidence_label(top[0][0]) != "High"
+
+
+def test_partial_lexical_coverage_is_below_threshold(main):
+    add_notes(main, "bio", BIOLOGY)
+
+    top = main.rank_chunks("glycolysis krebs mitochondrial carbon", main.get_subject_index("bio"), 3, "lexical")
+
+    assert top[0][1]["text"].startswith("The Krebs")
+    assert top[-1][0] < 0.55  # glycolysis chunk: a quarter of the query's weight
+
+
+def test_hybrid_finds_exact_term_vector_ranking_alone_misses(main, monkeypatch):
+    add_notes(main, "bio", BIOLOGY)
+    index = main.get_subject_index("bio")
+    # a query embedding that points at the Krebs chunk only
+    krebs = main.embed_batch_fn([BIOLOGY[2]])[0]
+    monkeypatch.setattr(main, "get_embedding", lambda text, task_type=None: krebs)
+
+    vector = [c["text"] for _, c in main.rank_chunks("pyruvate", index, 1, "vector")]
+    hybrid = [c["text"] for _, c in main.rank_chunks("pyruvate", index, 2, "hybrid")]
+
+    assert vector == [BIOLOGY[2]]
+    assert BIOLOGY[0] in hybrid
+
+
+def test_deleted_source_drops_out_of_lexical_postings(main):
+    add_notes(main, "mixed", BIOLOGY, source="bio.pdf")
+    add_notes(main, "mixed", HISTORY, source="history.pdf")
+    assert main.rank_chunks("treaty westphalia", main.get_subject_index("mixed"), 3, "lexical")
+
+    main.remove_source_from_index("mixed", "history.pdf")
+    index = main.get_subject_index("mixed")
+
+    assert main.rank_chunks("treaty westphalia", index, 3, "lexical") == []
+    assert all(c["source"] == "bio.pdf" for _, c in main.rank_chunks("glycolysis", index, 3, "lexical"))
+    assert index["lexical"]["doc_len"].shape[0] == len(index["chunks"]) == len(BIOLOGY)
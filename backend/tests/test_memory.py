@@ -0,0 +1,83 @@
+"""Conversation memory: per-(session, subject) isolation, eviction, trimming, persistence."""
+import time
+
+from conftest import add_notes, post
+
+
+def fresh_store(main, max_sessions=10, max_turns=20, idle_ttl=3600, persist_path=""):
+    return main.ConversationStore(max_sessions, max_turns, idle_ttl, persist_path)
+
+
+def test_two_sessions_on_one_subject_do_not_share_history(main, monkeypatch):
+    monkeypatch.setattr(main, "conversation_memory", fresh_store(main))
+    add_notes(main, "bio", ["Mitochondria make ATP.", "Osmosis moves water across membranes."])
+    prompts = []
+    create = main.groq_client.chat.completions.create
+
+    def recording_create(**kwargs):
+        prompts.append(kwargs["messages"][0]["content"])  # the system prompt carries the history
+        return create(**kwargs)
+
+    monkeypatch.setattr(main.groq_client.chat.completions, "create", recording_create)
+
+    post(main, "/teacher_ask", {"subject": "bio", "question": "What do mitochondria do?", "session_id": "alice"})
+    post(main, "/teacher_ask", {"subject": "bio", "question": "How does osmosis work?", "session_id": "bob"})
+    post(main, "/teacher_ask", {"subject": "bio", "question": "Explain that simpler", "session_id": "alice"})
+
+    assert "What do mitochondria do?" not in prompts[1]
+    assert "What do mitochondria do?" in prompts[2] and "osmosis" not in prompts[2]
+    alice = main.conversation_memory.history("alice", "bio")
+    bob = main.conversation_memory.history("bob", "bio")
+    assert "What do mitochondria do?" in alice and "osmosis" not in alice
+    assert "How does osmosis work?" in bob and "mitochondria" not in bob
+    assert main.conversation_memory.last_user_message("alice", "bio") == "Explain that simpler"
+
+
+def test_least_recently_used_session_is_evicted(main):
+    store = fresh_store(main, max_sessions=2)
+    store.add("a", "bio", "user", "first")
+    store.add("b", "bio", "user", "second")
+    store.history("a", "bio")  # a is now more recent than b
+    store.add("c", "bio", "user", "third")
+
+    assert len(store) == 2
+    assert set(store._sessions) == {("a", "bio"), ("c", "bio")}
+
+
+def test_idle_session_is_dropped(main):
+    store = fresh_store(main, idle_ttl=0.05)
+    store.add("a", "bio", "user", "hello")
+    time.sleep(0.1)
+
+    assert store.history("a", "bio") == ""
+    assert store.last_user_message("a", "bio") == ""
+
+
+def test_history_keeps_the_newest_turns_within_the_token_budget(main, monkeypatch):
+    store = fresh_store(main)
+    for n in range(6):
+        store.add("a", "bio", "user", f"question number {n} " + "x" * 30)
+    turn_tokens = main.estimate_tokens(f"USER: question number 0 {'x' * 30}\n")
+    monkeypatch.setattr(main, "MEMORY_HISTORY_TOKENS", turn_tokens * 2)
+
+    history = store.history("a", "bio")
+
+    assert [line.split()[3] for line in history.splitlines()] == ["4", "5"]
+    assert store.history("a", "bio", token_budget=turn_tokens - 1) == ""
+
+
+def test_persisted_history_is_reloaded_by_a_new_store(main, tmp_path):
+    path = str(tmp_path / "memory" / "conversations.db")
+    first = fresh_store(main, persist_path=path)
+    first.add("a", "bio", "user", "What is ATP?")
+    first.add("a", "bio", "assistant", "The cell's energy currency.")
+    first.add("b", "bio", "user", "Unrelated question")
+
+    restarted = fresh_store(main, persist_path=path)
+
+    assert restarted.history("a", "bio") == "USER: What is ATP?\nASSISTANT: The cell's energy currency.\n"
+    assert restarted.last_user_message("a", "bio") == "What is ATP?"
+
+    restarted.clear("a")
+    assert fresh_store(main, persist_path=path).history("a", "bio") == ""
+    assert fresh_store(main, persist_path=path).history("b", "bio") == "USER: Unrelated question\n"
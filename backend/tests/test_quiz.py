@@ -0,0 +1,53 @@
+"""/generate_quiz seeding."""
+from conftest import add_notes, post
+
+TOPICS = ["mitochondria", "membrane", "enzyme", "ribosome", "nucleus"]
+
+
+def add_quiz_notes(main):
+    add_notes(main, "bio", [f"The {TOPICS[i % 5]} note number {i} covers {TOPICS[(i * 3) % 5]} function."
+                            for i in range(40)])
+
+
+def test_seeded_quiz_is_cached_per_seed(main):
+    add_quiz_notes(main)
+
+    first = post(main, "/generate_quiz", {"subject": "bio", "seed": "3"}).json()
+    again = post(main, "/generate_quiz", {"subject": "bio", "seed": "3"}).json()
+
+    assert first["seed"] == 3 and first["mcqs"] and first["cached"] is False
+    assert again["cached"] is True
+
+
+def test_negative_seed_is_rejected(main):
+    add_quiz_notes(main)
+
+    response = post(main, "/generate_quiz", {"subject": "bio", "seed": "-3"})
+
+    assert response.status_code == 422
+
+
+def test_every_sampled_chunk_reaches_the_quiz_context(main, monkeypatch):
+    for n in range(30):
+        topic = f"topic{n}"
+        add_notes(main, "long", [" ".join(f"The {topic} idea number {i} has a detail worth learning." for i in range(40))],
+                  source=f"{topic}.pdf")
+    sampled, contexts = [], []
+    sample, section = main.sample_quiz_chunks, main.generate_quiz_section
+
+    def record_sample(*args):
+        sampled.extend(sample(*args))
+        return sampled
+
+    def record_section(name, context):
+        contexts.append(context)
+        return section(name, context)
+
+    monkeypatch.setattr(main, "sample_quiz_chunks", record_sample)
+    monkeypatch.setattr(main, "generate_quiz_section", record_section)
+
+    post(main, "/generate_quiz", {"subject": "long", "seed": "1"})
+
+    assert len(sampled) == main.QUIZ_SAMPLE_CHUNKS
+    assert all(chunk["citation"] in contexts[0] for chunk in sampled)
+    assert main.estimate_tokens(contexts[0]) <= main.QUIZ_CONTEXT_TOKEN_BUDGET
@@ -0,0 +1,72 @@
+"""Re-ingesting a filename that is already indexed: replacement and reuse."""
+import json
+import os
+import random
+
+from bench_suite import write_synthetic_pdf
+
+
+def ingest(main, tmp_path, subject="bio", filename="notes.pdf", pages=4, seed=0, scanned_every=0):
+    main.ensure_subject(subject)
+    path = os.path.join(main.UPLOAD_DIR, subject, filename)
+    write_synthetic_pdf(path, pages, random.Random(seed), scanned_every=scanned_every)
+    return main.ingest_saved_file(subject, path, filename)
+
+
+def live_chunks(main, subject="bio"):
+    return main.get_subject_index(subject)["chunks"]
+
+
+def test_unchanged_reupload_reuses_every_page_and_chunk(main, tmp_path):
+    first = ingest(main, tmp_path)
+    again = ingest(main, tmp_path)
+
+    assert first["replaced"] is False and first["pages_reused"] == 0
+    assert again["replaced"] is True
+    assert again["pages_reused"] == again["pages_total"] == 4
+    assert again["chunks_reused"] == again["chunks_total"] == first["chunks_total"]
+    assert again["chunks_embedded"] == 0
+
+
+def test_reupload_does_not_duplicate_chunks(main, tmp_path):
+    first = ingest(main, tmp_path, seed=1)
+    changed = ingest(main, tmp_path, seed=2)
+
+    chunks = live_chunks(main)
+    assert len(chunks) == changed["chunks_total"]
+    assert len({c["chunk_id"] for c in chunks}) == len(chunks)
+    assert changed["pages_reused"] == 0 and changed["chunks_reused"] < first["chunks_total"]
+
+
+def test_known_scanned_pages_skip_ocr_on_reingest(main, tmp_path, monkeypatch):
+    calls = []
+
+    def fake_ocr(png_bytes, mime_type="image/png"):
+        calls.append(mime_type)
+        return "Chloroplasts capture light energy for photosynthesis."
+
+    monkeypatch.setattr(main, "extract_text_from_image_bytes", fake_ocr)
+    ingest(main, tmp_path, pages=6, scanned_every=3)
+    assert len(calls) == 2
+
+    again = ingest(main, tmp_path, pages=6, scanned_every=3)
+
+    assert len(calls) == 2
+    assert again["pages_reused"] == 6
+    assert any("Chloroplasts" in c["text"] for c in live_chunks(main))
+
+
+def test_migrated_legacy_source_is_replaced(main, tmp_path):
+    os.makedirs(main.INDEX_DIR, exist_ok=True)
+    legacy = [{"chunk_id": "notes.pdf_0", "page": 1, "source": "notes.pdf", "citation": "notes.pdf | page 1",
+               "text": "Legacy text about ribosomes.", "embedding": main.get_embedding("Legacy text about ribosomes.")}]
+    with open(main._json_index_path("bio"), "w", encoding="utf-8") as f:
+        json.dump(legacy, f)
+    main.migrate_json_indexes()
+    assert main.source_is_indexed("bio", "notes.pdf")
+
+    result = ingest(main, tmp_path)
+
+    assert result["replaced"] is True
+    assert not any("ribosomes" in c["text"] for c in live_chunks(main))
+    assert len(live_chunks(main)) == result["chunks_total"]
@@ -0,0 +1,77 @@
+"""Append-only index segments: tombstones, compaction and reader retries."""
+import os
+
+from conftest import add_notes
+
+
+def sources(main, subject):
+    return sorted({c["source"] for c in main.get_subject_index(subject)["chunks"]})
+
+
+def index_files(main, subject):
+    return set(os.listdir(main._subject_index_dir(subject))) - {"manifest.json"}
+
+
+def referenced_files(manifest):
+    names = {info["manifest"] for info in manifest["sources"].values() if info.get("manifest")}
+    for segment in manifest["segments"]:
+        names.update(n for n in (segment["embeddings"], segment["meta"], segment.get("ann"), segment.get("terms")) if n)
+    return names
+
+
+def test_delete_hides_source_and_readding_it_works(main):
+    add_notes(main, "bio", ["Mitochondria produce ATP."], source="a.pdf")
+    add_notes(main, "bio", ["Ribosomes build proteins."], source="b.pdf")
+
+    assert main.remove_source_from_index("bio", "a.pdf") == 1
+    assert sources(main, "bio") == ["b.pdf"]
+    hits = main.rank_chunks("mitochondria ATP", main.get_subject_index("bio"), 5, "vector")
+    assert all(c["source"] == "b.pdf" for _, c in hits)
+
+    add_notes(main, "bio", ["Mitochondria produce ATP, revised."], source="a.pdf")
+
+    index = main.get_subject_index("bio")
+    assert sources(main, "bio") == ["a.pdf", "b.pdf"]
+    assert [c["text"] for c in index["chunks"] if c["source"] == "a.pdf"] == ["Mitochondria produce ATP, revised."]
+    assert index["matrix"].shape[0] == 2
+
+
+def test_compaction_keeps_live_chunks_and_removes_unreferenced_files(main):
+    for name in ("a", "b", "c"):
+        add_notes(main, "bio", [f"{name} note one.", f"{name} note two."], source=f"{name}.pdf")
+    main.remove_source_from_index("bio", "b.pdf")
+    before = main.get_subject_index("bio")
+    live = sorted(c["chunk_id"] for c in before["chunks"])
+
+    assert main.compact_subject_index("bio") == 4
+
+    manifest = main._read_manifest("bio")
+    index = main.get_subject_index("bio")
+    assert len(manifest["segments"]) == 1 and manifest["tombstones"] == []
+    assert sorted(c["chunk_id"] for c in index["chunks"]) == live
+    assert index["matrix"].shape[0] == 4
+    assert index_files(main, "bio") == referenced_files(manifest)
+    assert main.rank_chunks("a note one", index, 1, "lexical")[0][1]["source"] == "a.pdf"
+
+
+def test_reader_retries_when_segments_vanish_under_it(main, monkeypatch):
+    add_notes(main, "bio", ["Mitochondria produce ATP."], source="a.pdf")
+    add_notes(main, "bio", ["Ribosomes build proteins."], source="b.pdf")
+    main.invalidate_subject_index("bio")
+    read = main._read_binary_index
+    calls = []
+
+    def compact_underneath(subject, manifest, **kwargs):
+        calls.append(manifest["generation"])
+        if len(calls) == 1:
+            # a compaction publishes and deletes the old segments after this
+            # reader has read its (now stale) manifest
+            main.compact_subject_index(subject)
+        return read(subject, manifest, **kwargs)
+
+    monkeypatch.setattr(main, "_read_binary_index", compact_underneath)
+
+    index = main.get_subject_index("bio")
+
+    assert sorted(c["source"] for c in index["chunks"]) == ["a.pdf", "b.pdf"]
+    assert calls[-1] > calls[0]  # the retry read the compacted generation
@@ -0,0 +1,89 @@
+"""SSE answer streaming: /ask_v2/stream and /teacher_ask/stream."""
+from conftest import STUB_ANSWER, add_notes, post, sse_events
+
+NOTES = [
+    "Mitochondria produce ATP through oxidative phosphorylation in the cell.",
+    "The cell membrane controls transport with receptor proteins.",
+]
+
+
+def failing_groq(main):
+    def create(**kwargs):
+        raise ConnectionError("groq unavailable")
+
+    main.groq_client.chat.completions.create = create
+
+
+def assert_stream_shape(events):
+    names = [name for name, _ in events]
+    assert names[0] == "evidence"
+    assert names[-1] == "confidence"
+    assert len(names) > 2 and set(names[1:-1]) == {"token"}
+
+
+def test_ask_v2_stream_emits_evidence_tokens_confidence(main):
+    add_notes(main, "bio", NOTES)
+
+    response = post(main, "/ask_v2/stream", {"subject": "bio", "question": "How do mitochondria produce ATP?"})
+
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = sse_events(response.text)
+    assert_stream_shape(events)
+    assert len(events) - 2 == len(STUB_ANSWER.split())  # one event per streamed token
+    assert "".join(data["text"] for name, data in events if name == "token") == STUB_ANSWER
+    assert events[0][1]["evidence"]
+    assert events[-1][1]["cached"] is False
+
+
+def test_ask_v2_stream_caches_streamed_answer(main):
+    add_notes(main, "bio", NOTES)
+    question = {"subject": "bio", "question": "How do mitochondria produce ATP?"}
+
+    post(main, "/ask_v2/stream", question)
+    failing_groq(main)  # a cache hit must not reach the LLM
+    events = sse_events(post(main, "/ask_v2/stream", question).text)
+
+    assert [name for name, _ in events] == ["evidence", "token", "confidence"]
+    assert events[1][1]["text"] == STUB_ANSWER
+    assert events[-1][1]["cached"] is True
+    assert post(main, "/ask_v2", question).json()["answer"] == STUB_ANSWER
+
+
+def test_ask_v2_stream_falls_back_when_llm_fails_before_first_token(main):
+    add_notes(main, "bio", NOTES)
+    failing_groq(main)
+    question = {"subject": "bio", "question": "How do mitochondria produce ATP?"}
+
+    events = sse_events(post(main, "/ask_v2/stream", question).text)
+
+    assert_stream_shape(events)
+    tokens = [data["text"] for name, data in events if name == "token"]
+    assert len(tokens) == 1 and tokens[0] in NOTES
+    # fallback answers are not cached, so the next request retries the LLM
+    assert all(key[0] != "bio" for key in main.answer_cache._data)
+
+
+def test_teacher_ask_stream_emits_evidence_tokens_confidence(main):
+    add_notes(main, "bio", NOTES)
+
+    events = sse_events(post(main, "/teacher_ask/stream", {
+        "subject": "bio", "question": "How do mitochondria produce ATP?", "session_id": "s1",
+    }).text)
+
+    assert_stream_shape(events)
+    assert "".join(data["text"] for name, data in events if name == "token") == STUB_ANSWER
+    assert events[0][1]["evidence"]
+
+
+def test_teacher_ask_stream_falls_back_when_llm_fails_before_first_token(main):
+    add_notes(main, "bio", NOTES)
+    failing_groq(main)
+
+    events = sse_events(post(main, "/teacher_ask/stream", {
+        "subject": "bio", "question": "How do mitochondria produce ATP?", "session_id": "s1",
+    }).text)
+
+    assert_stream_shape(events)
+    tokens = [data["text"] for name, data in events if name == "token"]
+    assert len(tokens) == 1
+    assert tokens[0] == main.TEACHER_UNAVAILABLE or tokens[0].startswith("Here's what I found:")
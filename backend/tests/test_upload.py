@@ -0,0 +1,72 @@
+"""/upload: queued ingestion, the "replaces" flag and re-uploads during a running job."""
+import os
+import random
+import threading
+import time
+
+from bench_suite import write_synthetic_pdf
+from conftest import post_files
+
+
+def pdf_bytes(tmp_path, seed):
+    path = str(tmp_path / f"source-{seed}.pdf")
+    write_synthetic_pdf(path, 2, random.Random(seed))
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def wait_for_jobs(main, results, timeout=10):
+    deadline = time.monotonic() + timeout
+    for result in results:
+        while main.get_job(result["job_id"])["status"] not in ("done", "failed"):
+            assert time.monotonic() < deadline, "ingest job did not finish"
+            time.sleep(0.01)
+
+
+def test_replaces_flag_reflects_state_before_the_upload(main, tmp_path, monkeypatch):
+    enqueue = main.enqueue_ingest_job
+
+    def enqueue_and_finish(*args, **kwargs):
+        # the fastest possible job: published before the response is built
+        job_id = enqueue(*args, **kwargs)
+        wait_for_jobs(main, [{"job_id": job_id}])
+        return job_id
+
+    monkeypatch.setattr(main, "enqueue_ingest_job", enqueue_and_finish)
+
+    first = post_files(main, "bio", {"notes.pdf": pdf_bytes(tmp_path, 1)}).json()
+    second = post_files(main, "bio", {"notes.pdf": pdf_bytes(tmp_path, 2)}).json()
+
+    assert first["files"][0]["status"] == "queued"
+    assert first["files"][0]["replaces"] is False
+    assert second["files"][0]["replaces"] is True
+    assert main.get_job(second["files"][0]["job_id"])["status"] == "done"
+
+
+def test_reupload_does_not_overwrite_the_file_a_running_job_reads(main, tmp_path, monkeypatch):
+    ingest = main.ingest_saved_file
+    release, read = threading.Event(), []
+
+    def slow_ingest(subject, file_path, filename, **kwargs):
+        if not read:
+            assert release.wait(10)
+        with open(file_path, "rb") as f:
+            read.append(f.read())
+        return ingest(subject, file_path, filename, **kwargs)
+
+    monkeypatch.setattr(main, "ingest_saved_file", slow_ingest)
+    old, new = pdf_bytes(tmp_path, 1), pdf_bytes(tmp_path, 2)
+    path = os.path.join(main.UPLOAD_DIR, "bio", "notes.pdf")
+
+    try:
+        first = post_files(main, "bio", {"notes.pdf": old}).json()["files"][0]
+        second = post_files(main, "bio", {"notes.pdf": new}).json()["files"][0]
+        with open(path, "rb") as f:
+            assert f.read() == old  # the second upload waits in its spool file
+    finally:
+        release.set()
+    wait_for_jobs(main, [first, second])
+
+    assert read == [old, new]
+    assert main.get_job(second["job_id"])["status"] == "done"
+    assert os.listdir(os.path.dirname(path)) == ["notes.pdf"]
@@ -109,6 +109,8 @@ export default function AIVoiceInterface() {
     // Web Speech API references
     const recognitionRef = useRef<any>(null)
     const synthRef = useRef<SpeechSynthesis | null>(null)
+    // Scopes the tutor's conversation memory on the backend to this tab
+    const sessionIdRef = useRef<string>(typeof crypto !== "undefined" && crypto.randomUUID ? crypto.randomUUID() : `${Date.now()}-${Math.random()}`)
 
     useEffect(() => {
         // Initialize Speech Synthesis
@@ -230,6 +232,7 @@ export default function AIVoiceInterface() {
                 body: JSON.stringify({
                     message: trimmed,
                     subject: selectedSubject.id,
+                    sessionId: sessionIdRef.current,
                     history: newMessages.map(m => ({ role: m.role, content: m.content }))
                 })
             })